@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Benchmark the single-pass metadata extractor (``--fast-parse``) against the
+voevent-parse path, converting packets to bulk-load row-tuples.
+
+Needs no database: times the parse / convert step only, over the packets
+from the test resources.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import os
+import sys
+
+import voeventparse as vp
+
+from benchmarks.synthetic import median_runtime
+from voeventdb.server.database import bulk, extract
+from voeventdb.server.tests.resources import datapaths
+
+resource_filepaths = [
+    datapaths.assasn_non_ascii_packet_filepath,
+    datapaths.gaia_16bsf_filepath,
+    datapaths.konus_lc_filepath,
+    datapaths.swift_bat_grb_pos_v2_filepath,
+    datapaths.swift_bat_grb_655721_filepath,
+    datapaths.swift_xrt_grb_655721_filepath,
+]
+
+
+def run_etree(packets):
+    for xml in packets:
+        bulk.packet_rows_from_etree(vp.loads(xml, check_version=False))
+
+
+def run_fast_parse(packets):
+    for xml in packets:
+        bulk.packet_rows_from_metadata(extract.extract_metadata(xml))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-packets', type=int, default=10000,
+                        help="Packets converted per timing run")
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    resources = []
+    for path in resource_filepaths:
+        with open(path, 'rb') as f:
+            resources.append(f.read())
+
+    print("{:>40} {:>10} {:>12} {:>8}".format(
+        'packet', 'etree (s)', 'fast (s)', 'speedup'))
+    for path, xml in zip(resource_filepaths, resources):
+        packets = [xml] * args.n_packets
+        etree_time = median_runtime(lambda: run_etree(packets), args.repeats)
+        fast_time = median_runtime(lambda: run_fast_parse(packets),
+                                   args.repeats)
+        print("{:>40} {:>10.3f} {:>12.3f} {:>8.2f}".format(
+            os.path.basename(path)[-40:], etree_time, fast_time,
+            etree_time / fast_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Benchmark IVORN prefix searches (the ``ivorn_prefix`` filter and
+``convenience.ivorn_prefix_present``) against corpus size, with and without
+index scans.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import sys
+
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+from benchmarks.synthetic import (grow_corpus, median_runtime, parse_sizes,
+                                  scratch_session)
+from voeventdb.server.database.convenience import ivorn_prefix_present
+from voeventdb.server.database.models import Voevent
+from voeventdb.server.restapi.v1.filter_base import apply_filters
+
+prefixes = [
+    'ivo://bench.voeventdb/stream_07#Event_0000012',
+    'ivo://bench.voeventdb/stream_07#',
+    'ivo://no.such.stream',
+]
+
+
+def _disable_index_scans(session):
+    session.execute(text('SET LOCAL enable_indexscan = off'))
+    session.execute(text('SET LOCAL enable_indexonlyscan = off'))
+    session.execute(text('SET LOCAL enable_bitmapscan = off'))
+
+
+def run_filter(session, prefix, use_index):
+    if not use_index:
+        _disable_index_scans(session)
+    q = apply_filters(session.query(Voevent.ivorn),
+                      MultiDict([('ivorn_prefix', prefix)]))
+    q.limit(100).all()
+    session.rollback()
+
+
+def run_present(session, prefix, use_index):
+    if not use_index:
+        _disable_index_scans(session)
+    ivorn_prefix_present(session, prefix)
+    session.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sizes', default='1e3,1e4,1e5,1e6',
+                        help="Comma-separated corpus sizes")
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    session = scratch_session()
+    print("{:>10} {:>8} {:>46} {:>11} {:>10}".format(
+        'n_packets', 'query', 'prefix', 'index (ms)', 'scan (ms)'))
+    for size in parse_sizes(args.sizes):
+        grow_corpus(session, size)
+        for name, func in (('filter', run_filter), ('present', run_present)):
+            for prefix in prefixes:
+                timings = [
+                    1e3 * median_runtime(
+                        lambda: func(session, prefix, use_index),
+                        args.repeats)
+                    for use_index in (True, False)]
+                print("{:>10} {:>8} {:>46} {:>11.2f} {:>10.2f}".format(
+                    size, name, prefix, *timings))
+    session.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Benchmark the ``ivorn_contains`` / ``ref_contains`` filters against corpus
+size, with and without the trigram indexes.
+
+'Without' is emulated by disabling index / bitmap scans for the query, so
+the planner falls back to sequential scans as it would with no index.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import sys
+
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+from benchmarks.synthetic import (grow_corpus, median_runtime, parse_sizes,
+                                  scratch_session)
+from voeventdb.server.database.models import Voevent
+from voeventdb.server.restapi.v1.filter_base import apply_filters
+
+queries = [
+    ('ivorn_contains', 'Event_000001234'),
+    ('ivorn_contains', 'stream_07#Event_0000099'),
+    ('ref_contains', 'Event_000001234'),
+]
+
+
+def run_query(session, key, value, use_index):
+    if not use_index:
+        session.execute(text('SET LOCAL enable_indexscan = off'))
+        session.execute(text('SET LOCAL enable_bitmapscan = off'))
+    q = apply_filters(session.query(Voevent.ivorn), MultiDict([(key, value)]))
+    q.all()
+    session.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sizes', default='1e3,1e4,1e5,1e6',
+                        help="Comma-separated corpus sizes")
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    session = scratch_session()
+    print("{:>10} {:>16} {:>26} {:>10} {:>10}".format(
+        'n_packets', 'filter', 'value', 'trgm (ms)', 'scan (ms)'))
+    for size in parse_sizes(args.sizes):
+        grow_corpus(session, size)
+        for key, value in queries:
+            timings = [
+                1e3 * median_runtime(
+                    lambda: run_query(session, key, value, use_index),
+                    args.repeats)
+                for use_index in (True, False)]
+            print("{:>10} {:>16} {:>26} {:>10.2f} {:>10.2f}".format(
+                size, key, value, *timings))
+    session.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Shared helpers for the benchmark scripts: a scratch database, filled with a
+synthetic corpus of (tiny) packets that can be grown in stages.
+
+NB the scratch database is dropped and re-created on each run.
+"""
+from __future__ import absolute_import, print_function
+import time
+from datetime import datetime, timedelta
+
+import pytz
+import voeventparse as vp
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+import voeventdb.server.database.config as dbconfig
+from voeventdb.server.database import db_utils
+from voeventdb.server.database.bulk import (PacketRows, voevent_columns,
+                                            write_packet_rows)
+from voeventdb.server.database.models import Voevent, xml_digest
+
+scratch_url = dbconfig.testdb_scratch_url
+
+_start_dt = datetime(2010, 1, 1, tzinfo=pytz.UTC)
+
+
+def scratch_session():
+    """
+    (Re)create the scratch database, returning a session bound to it.
+    """
+    if db_utils.check_database_exists(scratch_url):
+        db_utils.delete_database(dbconfig.default_admin_db_url,
+                                 scratch_url.database)
+    db_utils.create_empty_database(dbconfig.default_admin_db_url,
+                                   scratch_url.database)
+    engine = create_engine(scratch_url)
+    with engine.begin() as connection:
+        db_utils.create_tables_and_indexes(connection)
+    return Session(bind=engine)
+
+
+def synthetic_ivorn(index, n_streams=50):
+    return 'ivo://bench.voeventdb/stream_{:02d}#Event_{:09d}'.format(
+        index % n_streams, index)
+
+
+def synthetic_packet_rows(index):
+    """
+    Row-tuples for a minimal synthetic packet. Every third packet cites
+    its predecessor.
+    """
+    ivorn = synthetic_ivorn(index)
+    xml = '<voe:VOEvent ivorn="{}"/>'.format(ivorn).encode('utf-8')
+    author_datetime = _start_dt + timedelta(minutes=index)
+    values = dict(received=author_datetime, ivorn=ivorn,
+                  stream=ivorn.split('#')[0][6:],
+                  role=vp.definitions.roles.test, version='2.0',
+                  author_ivorn=None, author_datetime=author_datetime,
+                  xml=xml, xml_sha256=xml_digest(xml))
+    voevent = tuple(values[col] for col in voevent_columns)
+    cites = []
+    if index % 3 == 2:
+        cites.append((synthetic_ivorn(index - 1),
+                      vp.definitions.cite_types.followup, None))
+    coords = [((index * 0.37) % 360., ((index * 0.11) % 180.) - 90., 0.1,
+               author_datetime)]
+    return PacketRows(voevent=voevent, cites=cites, coords=coords)
+
+
+def grow_corpus(session, n_packets, batch_size=10000):
+    """
+    Add synthetic packets until the corpus holds ``n_packets``.
+    """
+    n_current = session.query(Voevent.id).count()
+    while n_current < n_packets:
+        n_batch = min(batch_size, n_packets - n_current)
+        write_packet_rows(session, [synthetic_packet_rows(i) for i in
+                                    range(n_current, n_current + n_batch)])
+        session.commit()
+        n_current += n_batch
+    session.execute(text('ANALYZE'))
+    session.commit()
+    return n_current
+
+
+def median_runtime(func, repeats=5):
+    """
+    Median wall-clock time of ``func()``, in seconds.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def parse_sizes(sizes_str):
+    return sorted(int(float(s)) for s in sizes_str.split(','))
@@ -1,57 +1,123 @@
 # Defines a plugin for the Comet broker.
 # If top-level directory 'comet_plugin' is added to $PYTHONPATH then comet
 # will detect this module at import-time.
+#
+# Database writes happen on a pool of writer threads (see
+# voeventdb.server.database.ingestd.PacketBatcher), so a slow database never
+# blocks the reactor. Packets arriving close together are committed in a single
+# transaction. Tuning is via environment variables:
+#
+#   VOEVENTDB_COMET_QUEUE_DEPTH: Max packets waiting to be written (default
+#       1000). When the queue is full, new packets are rejected immediately
+#       (logged, and the returned Deferred errbacks with QueueFull) rather than
+#       stalling the broker.
+#   VOEVENTDB_COMET_MAX_BATCH: Max packets per transaction (default 100).
+#   VOEVENTDB_COMET_MAX_WAIT: Max seconds to hold a packet while a batch
+#       fills (default 0.05).
+#   VOEVENTDB_COMET_WRITERS: Number of writer threads / pooled connections
+#       (default 2).
+#
+# The writer threads are only started when the first packet arrives, since
+# Comet imports (and instantiates) every plugin it finds, enabled or not.
 
 
 from zope.interface import implementer
+from twisted.internet import defer, reactor
 from twisted.plugin import IPlugin
 from comet.icomet import IHandler
 import comet.log as log
 import os
 import voeventparse
+from six.moves import queue
 from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import sessionmaker
 import voeventdb.server.database.config as dbconfig
-from voeventdb.server.database import db_utils
-import voeventdb.server.database.convenience as dbconv
+from voeventdb.server.database import db_utils, migrations
+from voeventdb.server.database.ingestd import PacketBatcher
 
 voeventdb_dbname = os.environ.get("VOEVENTDB_DBNAME",
                                   dbconfig.testdb_corpus_url.database)
+queue_depth = int(os.environ.get("VOEVENTDB_COMET_QUEUE_DEPTH", 1000))
+max_batch = int(os.environ.get("VOEVENTDB_COMET_MAX_BATCH", 100))
+max_wait = float(os.environ.get("VOEVENTDB_COMET_MAX_WAIT", 0.05))
+n_writers = int(os.environ.get("VOEVENTDB_COMET_WRITERS", 2))
 
 dburl = dbconfig.make_db_url(dbconfig.default_admin_db_params, voeventdb_dbname)
+dbengine = create_engine(dburl, pool_size=n_writers)
 if not db_utils.check_database_exists(dburl):
     log.warn("voeventdb database not found: {}".format(
         voeventdb_dbname))
-dbengine = create_engine(dburl)
+else:
+    try:
+        migrations.check_schema(dbengine)
+    except RuntimeError as e:
+        log.warn("voeventdb database {}: {}".format(voeventdb_dbname, e))
+
+
+class QueueFull(Exception):
+    """
+    Raised (via errback) when a packet is dropped due to a full write-queue.
+    """
+    pass
 
 
 @implementer(IPlugin, IHandler)
 class VoeventdbInserter(object):
     name = "voeventdb-insert"
 
+    def __init__(self):
+        self.batcher = None
+
+    def _get_batcher(self):
+        # Only ever called from the reactor thread, so no locking required.
+        if self.batcher is None:
+            self.batcher = PacketBatcher(sessionmaker(bind=dbengine),
+                                         max_batch=max_batch,
+                                         max_wait=max_wait,
+                                         max_queued=queue_depth,
+                                         n_writers=n_writers)
+            self.batcher.start()
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          self.batcher.stop)
+        return self.batcher
+
     # When the handler is called, it is passed an instance of
     # comet.utility.xml.xml_document.
     def __call__(self, event):
         """
-        Add an event to the celery processing queue
+        Queue an event for insertion into the database.
+
+        Returns a Deferred which fires once the packet has been committed
+        (or errbacks, if it could not be inserted).
         """
-        v = None
         try:
-            session = Session(bind=dbengine)
             v = voeventparse.loads(event.raw_bytes)
-            dbconv.safe_insert_voevent(session, v)
-            session.commit()
         except Exception as e:
-            if v is None:
-                log.warn("Could not parse event-bytes as voevent")
+            log.warn("Could not parse event-bytes as voevent")
+            return defer.fail(e)
+        ivorn = v.attrib['ivorn']
+
+        d = defer.Deferred()
+
+        def inserted(error):
+            # Called from a writer thread, so hand back to the reactor:
+            if error is None:
+                log.info("Loaded {} into database {}".format(
+                    ivorn, voeventdb_dbname))
+                reactor.callFromThread(d.callback, ivorn)
             else:
                 log.warn(
                     "Could not insert packet with ivorn {} into database {}".format(
-                        v.attrib['ivorn'], voeventdb_dbname))
-            self.deferred.errback(e)
+                        ivorn, voeventdb_dbname))
+                reactor.callFromThread(d.errback, error)
 
-        log.info("Loaded {} into database {}".format(
-            v.attrib['ivorn'], voeventdb_dbname))
+        try:
+            self._get_batcher().submit_async(v, inserted)
+        except queue.Full:
+            log.warn("voeventdb write-queue full ({} packets), "
+                     "dropping packet with ivorn {}".format(queue_depth, ivorn))
+            return defer.fail(QueueFull(ivorn))
+        return d
 
 
 # This instance of the handler is what actually constitutes our plugin.
@@ -22,11 +22,21 @@ test_requires = [
     'pytest>3',
 ]
 
+zstd_requires = [
+    'zstandard',
+]
+
+redis_requires = [
+    'redis',
+]
+
 extras_require = {
     'test': test_requires,
-    'all': test_requires,
+    'zstd': zstd_requires,
+    'redis': redis_requires,
+    'all': test_requires + zstd_requires + redis_requires,
 }
-packages = find_packages()
+packages = find_packages(exclude=['benchmarks'])
 print()
 print("FOUND PACKAGES: ", packages)
 
@@ -13,6 +13,7 @@ import voeventdb.server.database.config as dbconfig
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 from voeventdb.server.database import db_utils
+from voeventdb.server.database.query import keyset_batches
 from voeventdb.server.database.models import Voevent
 from voeventdb.server.utils.filestore import (
     write_tarball,
@@ -47,6 +48,9 @@ def handle_args():
 
             start <= author_datetime < end
 
+        Time-bounded dumps are written in author_datetime order, which
+        allows an index range-scan; `--all` dumps are in database-id order.
+
         NB when writing compressed tarballs in Python, the entire file is
         composed in memory before writing to file. This means that setting
         `nsplit` too large will result in very high memory usage! The default
@@ -129,15 +133,12 @@ def main():
         else:
             logger.info("Fetching packets from beginning of time")
         logger.info("...until: {}".format(args.end))
-    qry = qry.order_by(Voevent.id)
 
     n_matching = qry.count()
     logger.info("Dumping {} packets".format(n_matching))
     start_time = datetime.datetime.now()
-    while n_packets_written < n_matching:
-        logger.debug("Fetching batch of up to {} packets".format(args.nsplit))
-        voevents = qry.limit(args.nsplit).offset(n_packets_written).all()
-
+    for voevents in keyset_batches(qry, args.nsplit,
+                                   by_author_datetime=not args.all):
         n_packets_written += write_tarball(voevents,
                                            get_tarfile_path())
         elapsed = (datetime.datetime.now() - start_time).total_seconds()
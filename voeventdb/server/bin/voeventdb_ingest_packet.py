@@ -4,16 +4,16 @@ import argparse
 import logging
 import logging.handlers
 import os
+import socket
 import sys
 
 import six
-import voeventparse
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
 
-import voeventdb.server.database.config as dbconfig
-import voeventdb.server.database.convenience as conv
-from voeventdb.server.database import db_utils
+from voeventdb.server.utils import ingest_client
+
+# NB database-related modules are imported lazily (see `direct_insert`),
+# since they are slow to import and not needed when forwarding a packet
+# to the ingest daemon.
 
 
 def handle_args():
@@ -21,9 +21,7 @@ def handle_args():
     Default values are defined here.
     """
 
-    default_database_name = os.environ.get(
-        'VOEVENTDB_DBNAME',
-        dbconfig.testdb_corpus_url.database)
+    default_database_name = os.environ.get('VOEVENTDB_DBNAME')
     default_logfile_path = os.path.expanduser("~/voeventdb_packet_ingest.log")
 
     parser = argparse.ArgumentParser(
@@ -37,16 +35,33 @@ def handle_args():
 
       cat test.xml | voeventdb_ingest_packet.py -d mydb -l /tmp/my.log
 
+    If an ingest-daemon socket is given (or set via VOEVENTDB_INGEST_SOCKET),
+    the packet is forwarded to the daemon (see voeventdb_ingestd.py),
+    falling back to direct insertion if the daemon is not running. The
+    daemon writes to its own database, so '--dbname' can't be combined with
+    '--socket'; set VOEVENTDB_DBNAME to the daemon's database for fallback.
+
     """
 
     parser.add_argument('-d', '--dbname', nargs='?',
-                        default=str(default_database_name),
-                        help='Database name')
+                        help='Database name (default: $VOEVENTDB_DBNAME, '
+                             'else the test-corpus database)')
+
+    parser.add_argument('-s', '--socket', nargs='?',
+                        default=os.environ.get('VOEVENTDB_INGEST_SOCKET'),
+                        help='Ingest-daemon socket path')
 
     parser.add_argument('-l', '--logfile_path', nargs='?',
                         default=default_logfile_path,
                         )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.dbname is not None and args.socket:
+        parser.error("'--dbname' cannot be used with '--socket' (or "
+                     "$VOEVENTDB_INGEST_SOCKET): the ingest daemon "
+                     "writes to its own database.")
+    if args.dbname is None:
+        args.dbname = default_database_name
+    return args
 
 
 def setup_logging(logfile_path):
@@ -82,29 +97,62 @@ def setup_logging(logfile_path):
     return logger
 
 
-def main():
-    args = handle_args()
-    logger = setup_logging(args.logfile_path)
-    dburl = dbconfig.make_db_url(dbconfig.default_admin_db_params, args.dbname)
+def direct_insert(dbname, xml, logger):
+    """
+    Insert the packet directly into the database.
+    """
+    import voeventparse
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    import voeventdb.server.database.config as dbconfig
+    import voeventdb.server.database.convenience as conv
+    from voeventdb.server.database import db_utils, migrations
+
+    if dbname is None:
+        dbname = str(dbconfig.testdb_corpus_url.database)
+    dburl = dbconfig.make_db_url(dbconfig.default_admin_db_params, dbname)
     if not db_utils.check_database_exists(dburl):
         raise RuntimeError("Database not found")
-    if six.PY3:
-        stdin = sys.stdin.buffer.read()
-    else:
-        stdin = sys.stdin.read()  # Py2
 
-    v = voeventparse.loads(stdin)
+    engine = create_engine(dburl)
+    migrations.check_schema(engine)
 
-    session = Session(bind=create_engine(dburl))
+    v = voeventparse.loads(xml)
+
+    session = Session(bind=engine)
     try:
         conv.safe_insert_voevent(session, v)
         session.commit()
     except:
         logger.exception("Could not insert packet with ivorn {} into {}".format(
-            v.attrib['ivorn'], args.dbname))
+            v.attrib['ivorn'], dbname))
 
     logger.info("Loaded packet with ivorn {} into {}".format(
-        v.attrib['ivorn'], args.dbname))
+        v.attrib['ivorn'], dbname))
+
+
+def main():
+    args = handle_args()
+    logger = setup_logging(args.logfile_path)
+    if six.PY3:
+        stdin = sys.stdin.buffer.read()
+    else:
+        stdin = sys.stdin.read()  # Py2
+
+    if args.socket:
+        try:
+            ivorn = ingest_client.send_packet(stdin, args.socket)
+            logger.info("Loaded packet with ivorn {} via ingest daemon".format(
+                ivorn))
+            return 0
+        except ingest_client.IngestRejected:
+            logger.exception("Ingest daemon rejected packet")
+            return 0
+        except (socket.error, IOError):
+            logger.warning("Ingest daemon unavailable at {}, "
+                           "falling back to direct insert".format(args.socket))
+
+    direct_insert(args.dbname, stdin, logger)
     return 0
 
 
@@ -4,12 +4,14 @@ import sys
 import os
 import argparse
 import logging
+import time
 
 from sqlalchemy.engine.url import make_url
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
-from voeventdb.server.database import ingest, db_utils
+from voeventdb.server.database import ingest, db_utils, migrations
+from voeventdb.server.database.models import TarballCheckpoint
 import voeventdb.server.database.config as dbconfig
 
 import click
@@ -20,6 +22,48 @@ logging.getLogger('iso8601').setLevel(
 logger = logging.getLogger("voeventdb-ingest")
 
 
+def report_status(dburl, tarballs):
+    """
+    Print the ingest-checkpoint status of each tarball.
+    """
+    session = Session(bind=create_engine(dburl))
+    n_complete = 0
+    for tbpath in tarballs:
+        checkpoint = ingest.get_checkpoint(session, tbpath)
+        if checkpoint is None:
+            state = "not started"
+        elif checkpoint.complete:
+            state = "complete ({} packets loaded)".format(checkpoint.n_loaded)
+            n_complete += 1
+        else:
+            state = "partial ({} members, {} packets loaded)".format(
+                checkpoint.n_members, checkpoint.n_loaded)
+        click.echo("{}: {}".format(tbpath, state))
+    click.echo("{} of {} tarballs complete.".format(n_complete, len(tarballs)))
+    session.close()
+
+
+def verify_tarballs(dburl, tarballs):
+    """
+    Print a comparison of each tarball's packets against the database.
+
+    Returns:
+        bool: True if all packets were found, with matching content.
+    """
+    session = Session(bind=create_engine(dburl))
+    all_ok = True
+    for tbpath in tarballs:
+        result = ingest.verify_tarball(session, tbpath)
+        click.echo("{}: {} matched, {} missing, {} mismatched".format(
+            tbpath, result.n_matched, result.n_missing, len(result.mismatched)))
+        for ivorn in result.mismatched:
+            click.echo("  MISMATCH: {}".format(ivorn))
+        if result.n_missing or result.mismatched:
+            all_ok = False
+    session.close()
+    return all_ok
+
+
 @click.command()
 @click.option('-d', '--dbname',
               default=str(dbconfig.testdb_corpus_url.database),
@@ -27,26 +71,106 @@ logger = logging.getLogger("voeventdb-ingest")
                   dbconfig.testdb_corpus_url.database
               ))
 @click.option('--check/--no-check', default=False,
-              help="Check for (and ignore) duplicate packets. Default behaviour "
-                   "is to ingest in batches without checking first - this is "
-                   "faster but may fail part-way through if it hits a duplicate "
-                   "entry.")
+              help="Check for (and ignore) duplicate packets. Duplicates are "
+                   "detected a batch at a time, so this is cheap. Without "
+                   "checking, ingest may fail part-way through if it hits a "
+                   "duplicate entry.")
+@click.option('--bulk/--no-bulk', default=False,
+              help="Bulk-load packets using 'COPY', bypassing the ORM. "
+                   "Much faster for large archives.")
+@click.option('-w', '--workers', type=int, default=0,
+              help="Parse packets in a pool of N worker processes, feeding "
+                   "a single bulk-loading writer. Implies '--bulk'. "
+                   "Default (0) parses in-process.")
+@click.option('--resume/--no-resume', default=False,
+              help="Record a checkpoint with every commit, and resume "
+                   "previously interrupted loads from their last checkpoint. "
+                   "Tarballs already loaded to completion are skipped.")
+@click.option('--status', is_flag=True, default=False,
+              help="Report the checkpoint status of each tarball, then exit "
+                   "without loading anything.")
+@click.option('--verify', is_flag=True, default=False,
+              help="Compare each tarball against the database by "
+                   "content-hash, then exit without loading anything.")
+@click.option('-j', '--jobs', type=int, default=1,
+              help="Load up to N tarballs concurrently, each in its own "
+                   "process with its own database connection. "
+                   "Cannot be combined with '--workers'.")
+@click.option('--fast-parse/--no-fast-parse', default=False,
+              help="Extract packet metadata with a single streaming pass "
+                   "over the raw XML, rather than via voevent-parse. "
+                   "Packet XML is stored exactly as found in the tarball.")
 @click.argument('tarballs', nargs=-1, type=click.Path())
-def main(dbname, check, tarballs):
+def main(dbname, check, bulk, workers, resume, status, verify, jobs,
+         fast_parse, tarballs):
     dburl = dbconfig.make_db_url(dbconfig.default_admin_db_params, dbname)
     if not db_utils.check_database_exists(dburl):
         raise RuntimeError("Database not found")
+    migrations.check_schema(create_engine(dburl))
+    if workers and jobs > 1:
+        raise click.UsageError("'--workers' and '--jobs' are mutually exclusive.")
+    if resume or status:
+        # Ensure the bookkeeping table exists, for databases created with
+        # earlier versions of voeventdb:
+        TarballCheckpoint.__table__.create(create_engine(dburl),
+                                           checkfirst=True)
+    if status:
+        report_status(dburl, tarballs)
+        return 0
+    if verify:
+        if not verify_tarballs(dburl, tarballs):
+            sys.exit(1)
+        return 0
+
+    if workers:
+        loader = ingest.pipelined_load_from_tarfile
+        loader_kwargs = dict(n_workers=workers)
+    elif bulk:
+        loader = ingest.bulk_load_from_tarfile
+        loader_kwargs = {}
+    else:
+        loader = ingest.load_from_tarfile
+        loader_kwargs = {}
+    results = ingest.load_tarballs(dburl, tarballs,
+                                   loader=loader,
+                                   n_jobs=jobs,
+                                   check_for_duplicates=check,
+                                   resume=resume,
+                                   fast_parse=fast_parse,
+                                   **loader_kwargs)
 
-    with click.progressbar(tarballs) as tarball_bar:
-        for tbpath in tarball_bar:
-            session = Session(bind=create_engine(dburl))
-            n_parsed, n_loaded = ingest.load_from_tarfile(
-                    session,
-                    tarfile_path=tbpath,
-                    check_for_duplicates=check)
-            logger.info("Loaded {} packets into {} from {}".format(
-                    n_loaded, dbname, tbpath))
-            session.close()
+    n_total_parsed = 0
+    n_total_loaded = 0
+    failed = []
+    start_time = time.time()
+    with click.progressbar(length=len(tarballs)) as tarball_bar:
+        for result in results:
+            tarball_bar.update(1)
+            n_total_parsed += result.n_parsed
+            n_total_loaded += result.n_loaded
+            elapsed = time.time() - start_time
+            if result.error is not None:
+                failed.append(result)
+                logger.error("Failed to load {}: {}".format(
+                    result.tarfile_path, result.error))
+            else:
+                logger.info(
+                    "Loaded {} packets into {} from {} ({:.0f} packets/s)".format(
+                        result.n_loaded, dbname, result.tarfile_path,
+                        result.n_loaded / max(result.elapsed, 1e-6)))
+            logger.info("Aggregate: {} packets loaded, {:.0f} packets/s".format(
+                n_total_loaded, n_total_loaded / max(elapsed, 1e-6)))
+    elapsed = time.time() - start_time
+    click.echo(
+        "Parsed {} packets, loaded {}, from {} tarballs ({} failed), "
+        "in {:.1f}s ({:.0f} packets/s)".format(
+            n_total_parsed, n_total_loaded, len(tarballs), len(failed),
+            elapsed, n_total_loaded / max(elapsed, 1e-6)))
+    for result in failed:
+        click.echo("  FAILED: {} ({})".format(result.tarfile_path,
+                                              result.error))
+    if failed:
+        sys.exit(1)
     return 0
 
 
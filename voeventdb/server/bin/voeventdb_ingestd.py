@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import sys
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import voeventdb.server.database.config as dbconfig
+from voeventdb.server.database import db_utils, migrations
+from voeventdb.server.database.ingestd import IngestServer, PacketBatcher
+from voeventdb.server.utils.ingest_client import default_socket_path
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger('iso8601').setLevel(
+        logging.ERROR)  # Suppress iso8601 debug log.
+logger = logging.getLogger("voeventdb-ingestd")
+
+
+@click.command()
+@click.option('-d', '--dbname',
+              default=os.environ.get('VOEVENTDB_DBNAME',
+                                     str(dbconfig.testdb_corpus_url.database)),
+              help="Database to load to.")
+@click.option('-s', '--socket', 'socket_path', default=default_socket_path,
+              help="Path of the Unix socket to listen on, "
+                   "default='{}'".format(default_socket_path))
+@click.option('--max-batch', type=int, default=100,
+              help="Maximum number of packets committed per transaction.")
+@click.option('--max-wait', type=float, default=0.05,
+              help="Maximum time (seconds) a packet is held while waiting "
+                   "for a batch to fill.")
+def main(dbname, socket_path, max_batch, max_wait):
+    """
+    Run a persistent ingest service, listening for packets on a Unix socket.
+
+    Send packets with 'voeventdb_ingest_packet.py --socket <path>'.
+    """
+    dburl = dbconfig.make_db_url(dbconfig.default_admin_db_params, dbname)
+    if not db_utils.check_database_exists(dburl):
+        raise RuntimeError("Database not found")
+    engine = create_engine(dburl)
+    migrations.check_schema(engine)
+    batcher = PacketBatcher(sessionmaker(bind=engine),
+                            max_batch=max_batch, max_wait=max_wait)
+    server = IngestServer(socket_path, batcher)
+    logger.info("Ingesting into {}, listening on {}".format(dbname,
+                                                           socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        server.server_close()
+        engine.dispose()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
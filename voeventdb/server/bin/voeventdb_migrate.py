@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import logging
+import sys
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+import voeventdb.server.database.config as dbconfig
+from voeventdb.server.database import db_utils, migrations, segmentstore
+from voeventdb.server.database.models import XmlDictionary
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger('iso8601').setLevel(
+        logging.ERROR)  # Suppress iso8601 debug log.
+logger = logging.getLogger("voeventdb-migrate")
+
+
+def _open_session(dbname):
+    dburl = dbconfig.make_db_url(dbconfig.default_admin_db_params, dbname)
+    if not db_utils.check_database_exists(dburl):
+        raise RuntimeError("Database not found")
+    engine = create_engine(dburl)
+    # Bookkeeping tables added since the database may have been created:
+    XmlDictionary.__table__.create(engine, checkfirst=True)
+    return Session(bind=engine)
+
+
+def _format_bytes(n_bytes):
+    return "{:.1f}MB".format(n_bytes / 1e6)
+
+
+@click.group()
+@click.option('-d', '--dbname',
+              default=str(dbconfig.testdb_corpus_url.database),
+              help="Database to migrate, default='{}'".format(
+                  dbconfig.testdb_corpus_url.database
+              ))
+@click.pass_context
+def cli(ctx, dbname):
+    """
+    Upgrade the contents of an existing voeventdb database.
+    """
+    ctx.obj = _open_session(dbname)
+
+
+@cli.command('train-dictionary')
+@click.option('-n', '--n-samples', type=int, default=10000,
+              help="Number of packets to sample.")
+@click.option('--dict-size', type=int, default=112640,
+              help="Target dictionary size, in bytes.")
+@click.pass_obj
+def train_dictionary(session, n_samples, dict_size):
+    """
+    Train a zstd dictionary for XML compression, and make it active.
+
+    Once there is an active dictionary, newly inserted packets are stored
+    compressed. Use 'compress-xml' to re-encode existing rows.
+    """
+    row = migrations.train_xml_dictionary(session, n_samples=n_samples,
+                                          dict_size=dict_size)
+    click.echo("Trained dictionary {} ({} bytes)".format(row.id,
+                                                         len(row.data)))
+
+
+@cli.command('compress-xml')
+@click.option('-b', '--batch-size', type=int, default=1000,
+              help="Number of rows re-encoded per transaction.")
+@click.option('--decompress', is_flag=True, default=False,
+              help="Convert all rows back to raw XML instead.")
+@click.pass_obj
+def compress_xml(session, batch_size, decompress):
+    """
+    Re-encode stored packet XML with the active dictionary.
+    """
+    n_updated, bytes_before, bytes_after = migrations.recompress_xml(
+        session, batch_size=batch_size, decompress=decompress)
+    click.echo("Re-encoded {} rows: {} -> {}".format(
+        n_updated, _format_bytes(bytes_before), _format_bytes(bytes_after)))
+    if bytes_before:
+        click.echo("Size reduction: {:.1f}%".format(
+            100. * (bytes_before - bytes_after) / bytes_before))
+
+
+@cli.command('segment-store')
+@click.argument('store_dir', type=click.Path(file_okay=False),
+                default=segmentstore.default_store_dir)
+@click.option('--to-database', is_flag=True, default=False,
+              help="Move packets from the segment store back into the "
+                   "database, rather than vice-versa.")
+@click.option('-b', '--batch-size', type=int, default=1000,
+              help="Number of rows moved per transaction.")
+@click.pass_obj
+def segment_store(session, store_dir, to_database, batch_size):
+    """
+    Move packet XML between the database and a segment store.
+
+    STORE_DIR defaults to $VOEVENTDB_SEGMENT_DIR. After moving packets into
+    the store, the server (and any ingest processes) must be run with
+    VOEVENTDB_SEGMENT_DIR set accordingly.
+    """
+    if not store_dir:
+        raise click.UsageError("No segment store directory given.")
+    store = segmentstore.configure(store_dir)
+    if to_database:
+        result = migrations.move_xml_to_database(session, store, batch_size)
+    else:
+        result = migrations.move_xml_to_segment_store(session, store,
+                                                      batch_size)
+    n_updated, bytes_before, bytes_after = result
+    click.echo("Moved {} packets: {} -> {} held in database".format(
+        n_updated, _format_bytes(bytes_before), _format_bytes(bytes_after)))
+
+
+@cli.command('backfill-digests')
+@click.option('-b', '--batch-size', type=int, default=1000,
+              help="Number of rows updated per transaction.")
+@click.pass_obj
+def backfill_digests(session, batch_size):
+    """
+    Add the XML content-hash column, and fill it in for existing rows.
+    """
+    migrations.add_xml_digest_column(session.connection())
+    session.commit()
+    n_updated = migrations.backfill_xml_digests(session, batch_size=batch_size)
+    click.echo("Backfilled {} digests".format(n_updated))
+
+
+@cli.command('add-indexes')
+@click.pass_obj
+def add_indexes(session):
+    """
+    Create any query-support indexes missing from an older database.
+    """
+    migrations.add_query_indexes(session.connection())
+    session.commit()
+    click.echo("Indexes up to date.")
+
+
+@cli.command('rebuild-rollups')
+@click.pass_obj
+def rebuild_rollups(session):
+    """
+    (Re)build the pre-aggregated counts used by the 'map' endpoints.
+    """
+    n_rows = migrations.rebuild_rollups(session)
+    click.echo("Rebuilt rollups, {} rows".format(n_rows))
+
+
+@cli.command('resolve-cites')
+@click.option('-b', '--batch-size', type=int, default=1000,
+              help="Number of packets processed per transaction.")
+@click.pass_obj
+def resolve_cites(session, batch_size):
+    """
+    Add the resolved-citation column, and fill it in for existing rows.
+    """
+    migrations.add_cite_ref_column(session.connection())
+    session.commit()
+    n_dangling = migrations.backfill_cite_refs(session, batch_size=batch_size)
+    click.echo("Citations resolved, {} dangling".format(n_dangling))
+
+
+@cli.command('compact-dimensions')
+@click.option('-b', '--batch-size', type=int, default=10000,
+              help="Number of rows updated per transaction.")
+@click.pass_obj
+def compact_dimensions(session, batch_size):
+    """
+    Move stream names and cite descriptions into dimension tables.
+    """
+    report = migrations.compact_dimension_columns(session,
+                                                  batch_size=batch_size)
+    if report is None:
+        click.echo("Already using compact dimension tables.")
+        return
+    click.echo("Column data: {} -> {}".format(
+        _format_bytes(report.bytes_before), _format_bytes(report.bytes_after)))
+    click.echo("Stream-counts query: {:.3f}s -> {:.3f}s".format(
+        report.query_secs_before, report.query_secs_after))
+    click.echo("Run 'VACUUM FULL voevent, cite' to reclaim the disk space.")
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
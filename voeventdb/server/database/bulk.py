@@ -0,0 +1,337 @@
+"""
+Bulk-loading routines which bypass the ORM unit-of-work.
+
+Rather than building a :class:`.Voevent` object-graph per packet and flushing
+every row through the session, we reduce each packet to plain row-tuples
+and stream whole batches of rows to Postgres with ``COPY ... FROM STDIN``.
+
+Voevent ids are reserved up-front from the table's id-sequence, so the child
+(``cite``, ``coord``) rows can be assigned their foreign-key values client-side
+and streamed in the same fashion.
+"""
+from __future__ import absolute_import, unicode_literals
+import binascii
+import logging
+from collections import namedtuple
+from datetime import datetime
+from io import BytesIO
+
+import pytz
+import six
+from sqlalchemy import select, text
+
+from voeventdb.server.database.models import (Voevent, Cite, CiteDescription,
+                                              Coord, Stream, intern_values,
+                                              resolve_cites, update_rollups,
+                                              xml_digest)
+from voeventdb.server.database import xmlcodec
+
+logger = logging.getLogger(__name__)
+
+# Column ordering used for the plain row-tuples.
+# NB these exclude the primary-key ``id`` column of each table, and the
+# ``voevent_id`` foreign-key of the child tables - those are assigned at
+# write-time, see :func:`write_packet_rows`. (Likewise the cite
+# ``ref_voevent_id``, which is looked up from the ``ref_ivorn``.)
+voevent_columns = ('received', 'ivorn', 'stream', 'role', 'version',
+                   'author_ivorn', 'author_datetime', 'xml', 'xml_sha256')
+cite_columns = ('ref_ivorn', 'cite_type', 'description')
+coord_columns = ('ra', 'dec', 'error', 'time')
+
+# Columns held as dimension-table keys, see :func:`.models.intern_values`.
+# The row-tuples carry the plain values; these are swapped for keys when
+# the rows are written.
+_interned_columns = {
+    'stream': ('stream_id', Stream),
+    'description': ('description_id', CiteDescription),
+}
+
+
+class PacketRows(namedtuple('PacketRows', 'voevent cites coords')):
+    """
+    A namedtuple holding the plain row-tuples derived from a single packet.
+
+    Attributes:
+        voevent (tuple): Values for the columns listed in ``voevent_columns``.
+        cites (list): Tuples of values for the columns in ``cite_columns``.
+        coords (list): Tuples of values for the columns in ``coord_columns``.
+    """
+    pass  # Just wrapping a namedtuple so we can assign a docstring.
+
+
+def packet_rows_from_etree(root, received=None):
+    """
+    Reduce a packet to plain row-tuples, ready for bulk-loading.
+
+    We re-use :meth:`.Voevent.from_etree` to do the actual data extraction,
+    so the rows are guaranteed to match those produced by a regular ORM insert.
+
+    Args:
+        root: Root of an lxml.etree loaded with voevent-parse.
+        received (datetime.datetime): Timestamp for the 'received' column.
+            Defaults to the current time.
+    Returns:
+        PacketRows: The row-tuples for the voevent, cite and coord tables.
+    """
+    if received is None:
+        received = pytz.UTC.localize(datetime.utcnow())
+    row = Voevent.from_etree(root, received=received)
+    return PacketRows(
+        voevent=tuple(getattr(row, col) for col in voevent_columns),
+        cites=[tuple(getattr(c, col) for col in cite_columns)
+               for c in row.cites],
+        coords=[tuple(getattr(c, col) for col in coord_columns)
+                for c in row.coords],
+    )
+
+
+def packet_rows_from_metadata(metadata, received=None):
+    """
+    Reduce a :class:`.extract.PacketMetadata` tuple to plain row-tuples.
+
+    Equivalent to :func:`packet_rows_from_etree`, for packets processed
+    with the single-pass extractor (:func:`.extract.extract_metadata`).
+    """
+    if received is None:
+        received = pytz.UTC.localize(datetime.utcnow())
+    values = dict(metadata._asdict(), received=received,
+                  xml_sha256=xml_digest(metadata.xml))
+    return PacketRows(
+        voevent=tuple(values[col] for col in voevent_columns),
+        cites=list(metadata.cites),
+        coords=list(metadata.coords),
+    )
+
+
+def _escape_copy_text(value):
+    """
+    Escape a text value for the Postgres ``COPY`` text format.
+    """
+    return (value.replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def _format_text(value):
+    if isinstance(value, six.binary_type):
+        value = value.decode('utf-8')
+    return _escape_copy_text(value).encode('utf-8')
+
+
+def _format_number(value):
+    return repr(value).encode('ascii')
+
+
+def _format_datetime(value):
+    return value.isoformat().encode('ascii')
+
+
+def _format_bytea(value):
+    # Hex-format bytea, with the leading backslash escaped for the COPY parser.
+    return b'\\\\x' + binascii.hexlify(value)
+
+
+def _format_xml(value):
+    # COPY bypasses the column-type, so apply any compression here.
+    return _format_bytea(xmlcodec.encode(value))
+
+
+_copy_null = b'\\N'
+
+_column_formatters = {
+    'id': _format_number,
+    'voevent_id': _format_number,
+    'received': _format_datetime,
+    'ivorn': _format_text,
+    'stream_id': _format_number,
+    'role': _format_text,
+    'version': _format_text,
+    'author_ivorn': _format_text,
+    'author_datetime': _format_datetime,
+    'xml': _format_xml,
+    'xml_sha256': _format_text,
+    'ref_ivorn': _format_text,
+    'ref_voevent_id': _format_number,
+    'cite_type': _format_text,
+    'description_id': _format_number,
+    'ra': _format_number,
+    'dec': _format_number,
+    'error': _format_number,
+    'time': _format_datetime,
+}
+
+
+def copy_rows(dbapi_cursor, table_name, columns, rows):
+    """
+    Stream row-tuples into a table using ``COPY ... FROM STDIN``.
+
+    Args:
+        dbapi_cursor: A psycopg2 cursor.
+        table_name (str): Name of the table to load into.
+        columns (tuple): Column names, in the same order as the row values.
+        rows (iterable): Iterable of row-tuples.
+    Returns:
+        int: Number of rows copied.
+    """
+    formatters = [_column_formatters[col] for col in columns]
+    buf = BytesIO()
+    n_rows = 0
+    for row in rows:
+        buf.write(b'\t'.join(
+            _copy_null if value is None else fmt(value)
+            for fmt, value in zip(formatters, row)))
+        buf.write(b'\n')
+        n_rows += 1
+    if n_rows:
+        buf.seek(0)
+        dbapi_cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN'.format(table_name, ', '.join(columns)),
+            buf)
+    return n_rows
+
+
+def _intern_rows(connection, columns, rows):
+    """
+    Swap interned values for their dimension-table keys.
+
+    Args:
+        connection: SQLAlchemy connection.
+        columns (tuple): Column names for the row-tuples.
+        rows (list): Row-tuples.
+    Returns:
+        tuple: (columns, rows) - as stored in the database.
+    """
+    rows = [list(row) for row in rows]
+    stored_columns = list(columns)
+    for idx, col in enumerate(columns):
+        if col in _interned_columns:
+            key_name, dimension = _interned_columns[col]
+            ids = intern_values(connection, dimension,
+                                (row[idx] for row in rows))
+            for row in rows:
+                row[idx] = ids[row[idx]]
+            stored_columns[idx] = key_name
+    return tuple(stored_columns), [tuple(row) for row in rows]
+
+
+def reserve_voevent_ids(connection, n_ids):
+    """
+    Pull a block of ids from the voevent id-sequence.
+
+    Returns:
+        list: ``n_ids`` unused voevent ids.
+    """
+    seq_name = Voevent.__tablename__ + '_id_seq'
+    result = connection.execute(
+        text("SELECT nextval(:seq_name) FROM generate_series(1, :n_ids)"),
+        seq_name=seq_name, n_ids=n_ids)
+    return [r[0] for r in result]
+
+
+def _ref_voevent_ids(connection, ref_ivorns):
+    """
+    Look up the ids of any cited packets present in the database.
+
+    Returns:
+        dict: Mapping of ref_ivorn -> voevent id.
+    """
+    ref_ivorns = set(ref_ivorns)
+    if not ref_ivorns:
+        return {}
+    voevent_table = Voevent.__table__
+    result = connection.execute(
+        select([voevent_table.c.ivorn, voevent_table.c.id]).where(
+            voevent_table.c.ivorn.in_(ref_ivorns)))
+    return dict((ivorn, vid) for ivorn, vid in result)
+
+
+_staging_table_name = '_voevent_staging'
+
+
+def _insert_via_staging_table(connection, dbapi_cursor, columns,
+                              voevent_rows):
+    """
+    Insert voevent rows, silently dropping any with a pre-existing IVORN.
+
+    The rows are COPY'd into a temporary staging table, then moved into the
+    voevent table with a single ``INSERT ... ON CONFLICT (ivorn) DO NOTHING``.
+    This also handles duplicates within the batch itself.
+
+    Returns:
+        set: ids of the rows which were actually inserted.
+    """
+    connection.execute(
+        'CREATE TEMPORARY TABLE IF NOT EXISTS {} '
+        '(LIKE {} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'.format(
+            _staging_table_name, Voevent.__tablename__))
+    copy_rows(dbapi_cursor, _staging_table_name, columns, voevent_rows)
+    col_list = ', '.join(columns)
+    result = connection.execute(
+        'INSERT INTO {target} ({cols}) SELECT {cols} FROM {staging} '
+        'ON CONFLICT (ivorn) DO NOTHING RETURNING id'.format(
+            target=Voevent.__tablename__, cols=col_list,
+            staging=_staging_table_name))
+    inserted_ids = set(r[0] for r in result)
+    connection.execute('TRUNCATE {}'.format(_staging_table_name))
+    return inserted_ids
+
+
+def write_packet_rows(session, packet_rows, skip_duplicates=False):
+    """
+    Bulk-load a batch of :class:`PacketRows` via the session's connection.
+
+    The rows are written as part of the session's current transaction;
+    it is up to the caller to commit.
+
+    Args:
+        session: SQLAlchemy session.
+        packet_rows (list): :class:`PacketRows` to load.
+        skip_duplicates (bool): If True, packets whose IVORN is already in
+            the database (or repeated within the batch) are skipped,
+            rather than causing an IntegrityError. Costs one extra
+            server-side pass over the batch, rather than a query per packet.
+    Returns:
+        list: The voevent id assigned to each packet, in order - or None
+        for any packets skipped as duplicates.
+    """
+    connection = session.connection()
+    voevent_ids = reserve_voevent_ids(connection, len(packet_rows))
+    voevent_cols, voevent_rows = _intern_rows(
+        connection, ('id',) + voevent_columns,
+        [(vid,) + p.voevent for vid, p in zip(voevent_ids, packet_rows)])
+    dbapi_cursor = connection.connection.cursor()
+    try:
+        if skip_duplicates:
+            inserted_ids = _insert_via_staging_table(
+                connection, dbapi_cursor, voevent_cols, voevent_rows)
+            voevent_ids = [vid if vid in inserted_ids else None
+                           for vid in voevent_ids]
+        else:
+            copy_rows(dbapi_cursor, Voevent.__tablename__,
+                      voevent_cols, voevent_rows)
+        cites = [(vid,) + c
+                 for vid, p in zip(voevent_ids, packet_rows)
+                 if vid is not None
+                 for c in p.cites]
+        # Resolve the new cites as we load them (the voevent rows above
+        # included, so this covers references within the batch):
+        ref_idx = cite_columns.index('ref_ivorn') + 1
+        ref_ids = _ref_voevent_ids(connection,
+                                   (c[ref_idx] for c in cites))
+        cite_cols, cite_rows = _intern_rows(
+            connection, ('voevent_id',) + cite_columns + ('ref_voevent_id',),
+            [c + (ref_ids.get(c[ref_idx]),) for c in cites])
+        copy_rows(dbapi_cursor, Cite.__tablename__, cite_cols, cite_rows)
+        copy_rows(dbapi_cursor, Coord.__tablename__,
+                  ('voevent_id',) + coord_columns,
+                  ((vid,) + c
+                   for vid, p in zip(voevent_ids, packet_rows)
+                   if vid is not None
+                   for c in p.coords))
+    finally:
+        dbapi_cursor.close()
+    inserted_ids = [vid for vid in voevent_ids if vid is not None]
+    resolve_cites(connection, inserted_ids, resolve_outgoing=False)
+    update_rollups(connection, inserted_ids)
+    return voevent_ids
@@ -1,7 +1,12 @@
 from __future__ import absolute_import
-from voeventdb.server.database.models import Voevent
-from sqlalchemy import func
+import json
+
+import six
+from voeventdb.server.database.models import (Voevent, VoeventRollup,
+                                              xml_digest)
+from sqlalchemy import exists, func
 import voeventdb.server.database.query as query
+from voeventdb.server.database import extract
 
 import logging
 
@@ -15,30 +20,129 @@ def ivorn_present(session, ivorn):
     return bool(
         session.query(Voevent.id).filter(Voevent.ivorn == ivorn).count())
 
+
+def ivorns_present(session, ivorns):
+    """
+    Return the subset of the given IVORNs which are already in the database.
+
+    Checks the whole collection with a single query, so is much faster than
+    calling :func:`ivorn_present` repeatedly.
+
+    Returns:
+        set: IVORN strings found in the database.
+    """
+    ivorns = list(ivorns)
+    if not ivorns:
+        return set()
+    return set(r[0] for r in session.query(Voevent.ivorn).filter(
+        Voevent.ivorn.in_(ivorns)))
+
+
+def xml_digests(session, ivorns):
+    """
+    Fetch the XML content-hashes for the given IVORNs.
+
+    Uses the stored ``xml_sha256`` column, only falling back to fetching
+    (and hashing) the XML for any rows which have not been backfilled.
+
+    Returns:
+        dict: Mapping of IVORN -> SHA-256 hex-digest, for those IVORNs
+        present in the database.
+    """
+    ivorns = list(ivorns)
+    if not ivorns:
+        return {}
+    digests = dict(session.query(Voevent.ivorn, Voevent.xml_sha256).filter(
+        Voevent.ivorn.in_(ivorns)))
+    missing = [ivorn for ivorn, digest in digests.items() if digest is None]
+    if missing:
+        for ivorn, xml in session.query(Voevent.ivorn, Voevent.xml).filter(
+                Voevent.ivorn.in_(missing)):
+            digests[ivorn] = xml_digest(xml)
+    return digests
+
+
 def ivorn_prefix_present(session, ivorn_prefix):
     """
     Predicate, returns whether there is an entry in the database with matching
     IVORN prefix.
     """
-    n_matches = session.query(Voevent.ivorn).filter(
-            Voevent.ivorn.like('{}%'.format(ivorn_prefix))).count()
-    return bool(n_matches)
+    # EXISTS, so the scan stops at the first match:
+    return session.query(
+        exists().where(query.ivorn_prefix_clause(ivorn_prefix))).scalar()
+
+
+def ingest_watermark(session):
+    """
+    Returns a value which changes whenever packets are ingested or deleted.
+
+    This is the total packet count according to the rollup table
+    (:class:`.VoeventRollup`), which is updated within each insert / delete
+    transaction - so the watermark changes as soon as the packets become
+    visible, whatever order concurrent writers commit in. (Unlike e.g. the
+    max voevent id, which is assigned before commit.)
+
+    NB if equal numbers of packets are inserted and deleted between two
+    calls, the value is unchanged.
+    """
+    return session.query(func.sum(VoeventRollup.n_packets)).scalar() or 0
+
+
+def estimate_row_count(query):
+    """
+    Return the query-planner's estimate of the number of rows a query returns.
+
+    Costs a single ``EXPLAIN``, rather than executing the query.
+    """
+    compiled = query.statement.compile(
+        dialect=query.session.get_bind().dialect)
+    plan = query.session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def stored_xml_matches(session, ivorn, stored_digest, xml):
+    """
+    Check whether the stored copy of a packet matches the given XML.
+
+    Compares content-hashes first. Packets loaded via the fast-parse path
+    are stored exactly as received though, so on a hash mismatch we fetch
+    the stored XML and compare the normalised forms
+    (see :func:`.extract.normalised_xml`).
+
+    Args:
+        ivorn (str): IVORN of the stored packet.
+        stored_digest (str): Its ``xml_sha256``, e.g. from
+            :func:`xml_digests`.
+        xml (bytes): XML of the new copy.
+    Returns:
+        bool
+    """
+    if stored_digest == xml_digest(xml):
+        return True
+    stored_xml = session.query(Voevent.xml).filter(
+        Voevent.ivorn == ivorn).scalar()
+    return (stored_xml is not None and
+            extract.normalised_xml(stored_xml) == extract.normalised_xml(xml))
 
 
 def safe_insert_voevent(session, etree):
     """
     Insert a VOEvent, or skip with a warning if it's a duplicate.
 
-    NB XML contents are checked to confirm duplication - if there's a mismatch,
-    we raise a ValueError.
+    NB XML contents are checked to confirm duplication (see
+    :func:`stored_xml_matches`) - if there's a mismatch, we raise a
+    ValueError.
     """
     new_row = Voevent.from_etree(etree)
     if not ivorn_present(session, new_row.ivorn):
         session.add(new_row)
     else:
-        old_xml = session.query(Voevent.xml).filter(
-            Voevent.ivorn == new_row.ivorn).scalar()
-        if old_xml != new_row.xml:
+        old_digest = xml_digests(session, [new_row.ivorn])[new_row.ivorn]
+        if not stored_xml_matches(session, new_row.ivorn, old_digest,
+                                  new_row.xml):
             raise ValueError('Tried to load a VOEvent with duplicate IVORN,'
                              'but XML contents differ - not clear what to do.')
         else:
@@ -46,6 +150,35 @@ def safe_insert_voevent(session, etree):
                         'XML matches OK.')
 
 
+def safe_insert_voevents(session, etrees):
+    """
+    Batch equivalent of :func:`safe_insert_voevent`.
+
+    Duplicates (whether already in the database, or repeated within
+    ``etrees``) are checked with a single query for the whole batch, and
+    skipped with a warning if the XML matches.
+
+    Raises:
+        ValueError: If any packet duplicates an IVORN but the XML differs.
+            In this case nothing is added to the session.
+    """
+    new_rows = [Voevent.from_etree(etree) for etree in etrees]
+    existing_digests = xml_digests(session, (r.ivorn for r in new_rows))
+    to_add = []
+    for row in new_rows:
+        if row.ivorn not in existing_digests:
+            existing_digests[row.ivorn] = row.xml_sha256
+            to_add.append(row)
+        elif not stored_xml_matches(session, row.ivorn,
+                                    existing_digests[row.ivorn], row.xml):
+            raise ValueError('Tried to load a VOEvent with duplicate IVORN,'
+                             'but XML contents differ - not clear what to do.')
+        else:
+            logger.warning('Skipping insert for packet with duplicate IVORN, '
+                           'XML matches OK.')
+    session.add_all(to_add)
+
+
 
 def to_nested_dict(bi_grouped_rowset):
     nested = {}
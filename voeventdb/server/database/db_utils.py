@@ -40,8 +40,16 @@ def load_q3c(connection):
     with connection.begin_nested():
         connection.execute(q3c_batch)
 
+def load_pg_trgm(connection):
+    """
+    Load the trigram extension, used to index substring searches.
+    """
+    with connection.begin_nested():
+        connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
 def create_tables_and_indexes(connection):
     load_q3c(connection)
+    load_pg_trgm(connection)
     Base.metadata.create_all(connection)
 
 
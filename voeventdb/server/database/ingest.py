@@ -1,62 +1,693 @@
 from __future__ import absolute_import
 import voeventparse as vp
 from voeventdb.server.utils.filestore import tarfile_xml_generator
-from voeventdb.server.database.models import Voevent
-from voeventdb.server.database.convenience import ivorn_present
+from voeventdb.server.database.models import (Voevent, TarballCheckpoint,
+                                              xml_digest)
+import voeventdb.server.database.convenience as convenience
+import voeventdb.server.database.bulk as bulk
+import voeventdb.server.database.extract as extract
+from collections import namedtuple
+from datetime import datetime
+import multiprocessing
+import os
 import sys
+import threading
+import time
+
+import pytz
+from six.moves import queue
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def load_from_tarfile(session, tarfile_path, check_for_duplicates,
-                      pkts_per_commit=1000):
+def _parse_tarxml(tarinf):
     """
-    Iterate through xml files in a tarball and attempt to load into database.
+    Parse a TarXML entry, returning the etree or None if parsing fails.
+    """
+    try:
+        v = vp.loads(tarinf.xml, check_version=False)
+        if v.attrib['version'] != '2.0':
+            logger.debug(
+                'Packet: {} is not VO-schema version 2.0.'.format(
+                    tarinf.name))
+        return v
+    except:
+        logger.exception('Error loading file {}, skipping'.format(
+            tarinf.name))
+        return None
+
+
+def _scan_tarxml(tarinf):
+    """
+    As :func:`_parse_tarxml`, but using the single-pass extractor.
+
+    Returns a :class:`.extract.PacketScan`, or None if parsing fails.
+    """
+    try:
+        scan = extract.scan_packet(tarinf.xml)
+        if scan.root_attrib['version'] != '2.0':
+            logger.debug(
+                'Packet: {} is not VO-schema version 2.0.'.format(
+                    tarinf.name))
+        return scan
+    except:
+        logger.exception('Error loading file {}, skipping'.format(
+            tarinf.name))
+        return None
+
+
+def _orm_row_from_scan(scan):
+    return Voevent.from_metadata(extract.metadata_from_scan(scan))
+
+
+def _packet_rows_from_scan(scan):
+    return bulk.packet_rows_from_metadata(extract.metadata_from_scan(scan))
+
+
+def _member_digest(xml):
+    return xml_digest(xml)
+
+
+def get_checkpoint(session, tarfile_path):
+    """
+    Fetch the ingest checkpoint for a tarball, or None if never loaded.
+    """
+    return session.query(TarballCheckpoint).filter(
+        TarballCheckpoint.tarball_path == os.path.abspath(tarfile_path)
+    ).one_or_none()
+
+
+def _open_checkpoint(session, tarfile_path):
+    checkpoint = get_checkpoint(session, tarfile_path)
+    if checkpoint is None:
+        checkpoint = TarballCheckpoint(
+            tarball_path=os.path.abspath(tarfile_path),
+            n_members=0, n_parsed=0, n_loaded=0, complete=False)
+        session.add(checkpoint)
+    return checkpoint
 
-    .. warning::
-        Very slow with duplicate checking enabled.
+
+class _TarballProgress(object):
+    """
+    Tracks how far through a tarball we have got, for checkpointing purposes.
+
+    Members may finish out of order (see :func:`pipelined_load_from_tarfile`),
+    so we only advance the checkpoint past member N once every member up to
+    and including N has been committed (or found to be unloadable).
+
+    If ``checkpoint`` is None, this is a no-op.
+    """
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.n_complete = checkpoint.n_members if checkpoint else 0
+        self._base_parsed = checkpoint.n_parsed if checkpoint else 0
+        self._base_loaded = checkpoint.n_loaded if checkpoint else 0
+        self._resume_digest = checkpoint.last_member_digest if checkpoint else None
+        self._member_info = {}
+        self._finished = set()
+        self._last_member = (None, None)
+
+    def iter_members(self, tarfile_path):
+        """
+        Yield (index, TarXML) for the members not covered by the checkpoint.
+
+        Skipped members are not parsed, but we check the digest of the last
+        one against the checkpoint, to catch a tarball which has changed.
+        """
+        for index, tarinf in enumerate(tarfile_xml_generator(tarfile_path)):
+            if index < self.n_complete:
+                if index == self.n_complete - 1:
+                    digest = _member_digest(tarinf.xml)
+                    if digest != self._resume_digest:
+                        raise RuntimeError(
+                            "Tarball {} does not match its ingest checkpoint "
+                            "(member {}, '{}'), cannot resume.".format(
+                                tarfile_path, index, tarinf.name))
+                continue
+            if self.checkpoint is not None:
+                self._member_info[index] = (tarinf.name,
+                                            _member_digest(tarinf.xml))
+            yield index, tarinf
+
+    def finish(self, indices):
+        """
+        Mark members as dealt with (i.e. committed, or skipped as unloadable).
+        """
+        if self.checkpoint is None:
+            return
+        self._finished.update(indices)
+        while self.n_complete in self._finished:
+            self._finished.remove(self.n_complete)
+            self._last_member = self._member_info.pop(self.n_complete)
+            self.n_complete += 1
+
+    def commit(self, session, n_parsed, n_loaded, complete=False):
+        """
+        Record the checkpoint (if any) and commit the session.
+
+        The checkpoint is written in the same transaction as the packets, so
+        it is always consistent with the database contents.
+        """
+        cp = self.checkpoint
+        if cp is not None:
+            if cp.n_members != self.n_complete:
+                cp.n_members = self.n_complete
+                cp.last_member_name, cp.last_member_digest = self._last_member
+            cp.n_parsed = self._base_parsed + n_parsed
+            cp.n_loaded = self._base_loaded + n_loaded
+            cp.complete = complete
+            cp.updated = pytz.UTC.localize(datetime.utcnow())
+        session.commit()
+
+
+def _start_progress(session, tarfile_path, resume):
+    """
+    Returns a _TarballProgress, or None if the tarball is already complete.
+    """
+    if not resume:
+        return _TarballProgress(None)
+    checkpoint = _open_checkpoint(session, tarfile_path)
+    if checkpoint.complete:
+        logger.info("Skipping {}, already loaded.".format(tarfile_path))
+        return None
+    if checkpoint.n_members:
+        logger.info("Resuming {} after {} members.".format(
+            tarfile_path, checkpoint.n_members))
+    return _TarballProgress(checkpoint)
+
+
+# Times to re-check a batch for duplicates, after losing a race to insert:
+_max_duplicate_retries = 3
+
+
+def _drop_duplicate_rows(session, new_rows):
+    """
+    Drop rows with an IVORN already in the database, or earlier in the batch.
+
+    Uses a single query for the whole batch.
+    """
+    seen = convenience.ivorns_present(session, (r.ivorn for r in new_rows))
+    unique_rows = []
+    for row in new_rows:
+        if row.ivorn in seen:
+            logger.debug("Ignoring duplicate ivorn: {}".format(row.ivorn))
+            continue
+        seen.add(row.ivorn)
+        unique_rows.append(row)
+    return unique_rows
+
+
+def _add_batch(session, batch, convert, check_for_duplicates):
+    """
+    Add a batch of Voevent rows to the session.
+
+    ``batch`` holds ``(packet, row)`` pairs, where ``row = convert(packet)``.
+
+    If ``check_for_duplicates``, rows with an IVORN already present in the
+    database (or earlier in the batch) are dropped, and the rest flushed
+    in a savepoint. Should another process insert one of the same IVORNs
+    in between (e.g. a parallel tarball load), the savepoint is rolled back
+    and the check repeated - with freshly converted rows, since rolled-back
+    rows retain state from the failed flush.
 
     Returns:
-        tuple: (n_parsed, n_loaded) - Total number of packets parsed from
-            tarbar, and number successfully loaded.
+        int: Number of rows added.
+    """
+    new_rows = [row for _, row in batch]
+    if not check_for_duplicates:
+        session.add_all(new_rows)
+        return len(new_rows)
+    n_attempts = 0
+    while True:
+        unique_rows = _drop_duplicate_rows(session, new_rows)
+        try:
+            with session.begin_nested():
+                session.add_all(unique_rows)
+            return len(unique_rows)
+        except IntegrityError:
+            n_attempts += 1
+            if n_attempts >= _max_duplicate_retries:
+                raise
+            logger.warning("Packet in batch inserted concurrently, "
+                           "re-checking for duplicates")
+            new_rows = [convert(packet) for packet, _ in batch]
+
 
+def _write_bulk_batch(session, batch, check_for_duplicates):
     """
-    tf_stream = tarfile_xml_generator(tarfile_path)
-    logger.info("Loading: " + tarfile_path)
+    Bulk-load a batch of PacketRows, returns number of packets loaded.
+    """
+    voevent_ids = bulk.write_packet_rows(session, batch,
+                                         skip_duplicates=check_for_duplicates)
+    return sum(1 for vid in voevent_ids if vid is not None)
+
+
+def _log_load_summary(n_parsed, n_loaded, check_for_duplicates):
+    logger.info("Successfully parsed {} packets, of which loaded {}.".format(n_parsed, n_loaded))
+    if check_for_duplicates and n_parsed != n_loaded:
+        logger.info("(Skipped {} packets as duplicates or unloadable.)".format(
+            n_parsed - n_loaded))
+
+
+def _serial_load(session, tarfile_path, parse, convert, write_batch,
+                 pkts_per_commit, resume):
+    """
+    Shared loop for :func:`load_from_tarfile` / :func:`bulk_load_from_tarfile`.
+
+    Args:
+        parse: Function mapping a TarXML entry to a parsed packet, or None.
+        convert: Function mapping a parsed packet to a batch-entry.
+        write_batch: Function(session, batch) writing a batch of entries,
+            returns the number loaded.
+    """
+    progress = _start_progress(session, tarfile_path, resume)
+    if progress is None:
+        return 0, 0
     n_parsed = 0
     n_loaded = 0
-    for tarinf in tf_stream:
-        try:
-            v = vp.loads(tarinf.xml, check_version=False)
-            if v.attrib['version'] != '2.0':
-                logger.debug(
-                    'Packet: {} is not VO-schema version 2.0.'.format(
-                        tarinf.name))
-            n_parsed += 1
-        except:
-            logger.exception('Error loading file {}, skipping'.format(
-                tarinf.name))
+    batch = []
+    batch_members = []
+    for index, tarinf in progress.iter_members(tarfile_path):
+        batch_members.append(index)
+        v = parse(tarinf)
+        if v is None:
             continue
+        n_parsed += 1
         try:
-            new_row = Voevent.from_etree(v)
-            if check_for_duplicates:
-                if ivorn_present(session, new_row.ivorn):
-                    logger.debug(
-                        "Ignoring duplicate ivorn: {} in file {}".format(
-                            new_row.ivorn, tarinf.name))
-                    continue
-            session.add(new_row)
-            n_loaded += 1
+            batch.append(convert(v))
         except:
             logger.exception(
                 'Error converting file {} to database row, skipping'.
                     format(tarinf.name))
             continue
 
-        if n_loaded % pkts_per_commit == 0:
-            session.commit()
-    session.commit()
-    logger.info("Successfully parsed {} packets, of which loaded {}.".format(n_parsed, n_loaded))
+        if len(batch) >= pkts_per_commit:
+            n_loaded += write_batch(session, batch)
+            progress.finish(batch_members)
+            progress.commit(session, n_parsed, n_loaded)
+            batch = []
+            batch_members = []
+    if batch:
+        n_loaded += write_batch(session, batch)
+    progress.finish(batch_members)
+    progress.commit(session, n_parsed, n_loaded, complete=True)
+    return n_parsed, n_loaded
+
+
+def load_from_tarfile(session, tarfile_path, check_for_duplicates,
+                      pkts_per_commit=1000, resume=False, fast_parse=False):
+    """
+    Iterate through xml files in a tarball and attempt to load into database.
+
+    Packets are committed in batches of ``pkts_per_commit``. If
+    ``check_for_duplicates`` is set, each batch is checked against the
+    database with a single query and any duplicate IVORNs are skipped
+    (including those inserted concurrently, e.g. by other jobs of
+    :func:`load_tarballs`).
+
+    If ``resume`` is set, a :class:`.TarballCheckpoint` is recorded with each
+    commit, and a previously interrupted load will pick up where it left off
+    (or be skipped entirely, if it completed).
+
+    If ``fast_parse`` is set, packets are processed with the single-pass
+    extractor (:mod:`voeventdb.server.database.extract`) rather than
+    voevent-parse. In that case packet XML is stored exactly as found in the
+    tarball, rather than re-serialized; duplicate checks and
+    :func:`verify_tarball` compare normalised XML where hashes differ.
+
+    Returns:
+        tuple: (n_parsed, n_loaded) - Total number of packets parsed from
+            tarbar, and number successfully loaded.
+
+    """
+    logger.info("Loading: " + tarfile_path)
+
+    if fast_parse:
+        parse, convert = _scan_tarxml, _orm_row_from_scan
+    else:
+        parse, convert = _parse_tarxml, Voevent.from_etree
+
+    def write_batch(session, batch):
+        return _add_batch(session, batch, convert, check_for_duplicates)
+
+    n_parsed, n_loaded = _serial_load(session, tarfile_path,
+                                      parse=parse,
+                                      convert=lambda v: (v, convert(v)),
+                                      write_batch=write_batch,
+                                      pkts_per_commit=pkts_per_commit,
+                                      resume=resume)
+    _log_load_summary(n_parsed, n_loaded, check_for_duplicates)
     return n_parsed, n_loaded
+
+
+def bulk_load_from_tarfile(session, tarfile_path, check_for_duplicates=False,
+                           pkts_per_commit=1000, resume=False,
+                           fast_parse=False):
+    """
+    Load the xml files in a tarball using ``COPY``, bypassing the ORM.
+
+    Much faster than :func:`load_from_tarfile` for large archives. Packets are
+    reduced to plain row-tuples (see :mod:`voeventdb.server.database.bulk`)
+    and written in batches of ``pkts_per_commit``, one transaction per batch.
+
+    If ``check_for_duplicates`` is set, packets with an IVORN already present
+    are skipped via ``INSERT ... ON CONFLICT DO NOTHING``, at little extra cost.
+    Otherwise, a duplicate IVORN will cause the whole batch to fail.
+
+    Checkpointing (``resume``) and ``fast_parse`` work as for
+    :func:`load_from_tarfile`.
+
+    Returns:
+        tuple: (n_parsed, n_loaded) - Total number of packets parsed from
+            tarbar, and number successfully loaded.
+    """
+    logger.info("Bulk loading: " + tarfile_path)
+
+    def write_batch(session, batch):
+        return _write_bulk_batch(session, batch, check_for_duplicates)
+
+    if fast_parse:
+        parse, convert = _scan_tarxml, _packet_rows_from_scan
+    else:
+        parse, convert = _parse_tarxml, bulk.packet_rows_from_etree
+    n_parsed, n_loaded = _serial_load(session, tarfile_path,
+                                      parse=parse,
+                                      convert=convert,
+                                      write_batch=write_batch,
+                                      pkts_per_commit=pkts_per_commit,
+                                      resume=resume)
+    _log_load_summary(n_parsed, n_loaded, check_for_duplicates)
+    return n_parsed, n_loaded
+
+
+def _parse_worker(tarxml_queue, rows_queue, fast_parse=False):
+    """
+    Worker-process loop for :func:`pipelined_load_from_tarfile`.
+
+    Pulls ``(index, TarXML)`` entries from ``tarxml_queue`` and pushes
+    ``(index, parsed, rows)`` tuples onto ``rows_queue``, where ``parsed``
+    flags whether the XML was parsed successfully and ``rows`` is a
+    :class:`.PacketRows` instance, or None if conversion failed.
+    A ``None`` entry on the input queue signals shutdown, and is passed on
+    down the line.
+    """
+    if fast_parse:
+        parse, convert = _scan_tarxml, _packet_rows_from_scan
+    else:
+        parse, convert = _parse_tarxml, bulk.packet_rows_from_etree
+    while True:
+        entry = tarxml_queue.get()
+        if entry is None:
+            rows_queue.put(None)
+            return
+        index, tarinf = entry
+        v = parse(tarinf)
+        rows = None
+        if v is not None:
+            try:
+                rows = convert(v)
+            except:
+                logger.exception(
+                    'Error converting file {} to database rows, skipping'.
+                        format(tarinf.name))
+        rows_queue.put((index, v is not None, rows))
+
+
+def pipelined_load_from_tarfile(session, tarfile_path, n_workers,
+                                check_for_duplicates=False,
+                                pkts_per_commit=1000, queue_size=None,
+                                resume=False, fast_parse=False):
+    """
+    Bulk-load a tarball, with packet-parsing spread over worker processes.
+
+    The pipeline consists of:
+
+    - A reader thread, streaming TarXML entries from the tarball.
+    - A pool of ``n_workers`` processes, which reduce the raw XML to plain
+      row-tuples (see :func:`.bulk.packet_rows_from_etree`).
+    - A single writer (the calling thread), which batches up rows and
+      writes them using :func:`.bulk.write_packet_rows`,
+      one transaction per ``pkts_per_commit`` packets.
+
+    The stages are connected by bounded queues (``queue_size`` entries each,
+    defaulting to ``pkts_per_commit``), so memory usage stays flat regardless
+    of tarball size.
+
+    Duplicates are handled as for :func:`bulk_load_from_tarfile`, and
+    checkpointing (``resume``) and ``fast_parse`` work as for
+    :func:`load_from_tarfile`.
+
+    Returns:
+        tuple: (n_parsed, n_loaded) - Total number of packets parsed from
+            tarbar, and number successfully loaded.
+    """
+    progress = _start_progress(session, tarfile_path, resume)
+    if progress is None:
+        return 0, 0
+    if queue_size is None:
+        queue_size = pkts_per_commit
+    tarxml_queue = multiprocessing.Queue(maxsize=queue_size)
+    rows_queue = multiprocessing.Queue(maxsize=queue_size)
+    reader_errors = []
+
+    def read_tarball():
+        try:
+            for entry in progress.iter_members(tarfile_path):
+                tarxml_queue.put(entry)
+        except Exception as e:
+            logger.exception('Error reading tarball {}'.format(tarfile_path))
+            reader_errors.append(e)
+        finally:
+            for _ in range(n_workers):
+                tarxml_queue.put(None)
+
+    logger.info("Pipelined loading ({} workers): {}".format(n_workers,
+                                                            tarfile_path))
+    workers = [multiprocessing.Process(target=_parse_worker,
+                                       args=(tarxml_queue, rows_queue,
+                                             fast_parse))
+               for _ in range(n_workers)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    reader = threading.Thread(target=read_tarball)
+    reader.daemon = True
+    reader.start()
+
+    n_parsed = 0
+    n_loaded = 0
+    n_workers_running = n_workers
+    batch = []
+    batch_members = []
+    try:
+        while n_workers_running:
+            try:
+                entry = rows_queue.get(timeout=5)
+            except queue.Empty:
+                if not any(w.is_alive() for w in workers):
+                    raise RuntimeError(
+                        "Parse workers exited unexpectedly while loading "
+                        "{}".format(tarfile_path))
+                continue
+            if entry is None:
+                n_workers_running -= 1
+                continue
+            index, parsed, rows = entry
+            batch_members.append(index)
+            n_parsed += int(parsed)
+            if rows is None:
+                continue
+            batch.append(rows)
+            if len(batch) >= pkts_per_commit:
+                n_loaded += _write_bulk_batch(session, batch,
+                                              check_for_duplicates)
+                progress.finish(batch_members)
+                progress.commit(session, n_parsed, n_loaded)
+                batch = []
+                batch_members = []
+        if reader_errors:
+            raise reader_errors[0]
+        if batch:
+            n_loaded += _write_bulk_batch(session, batch,
+                                          check_for_duplicates)
+        progress.finish(batch_members)
+        progress.commit(session, n_parsed, n_loaded, complete=True)
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
+        for q in (tarxml_queue, rows_queue):
+            q.cancel_join_thread()
+    _log_load_summary(n_parsed, n_loaded, check_for_duplicates)
+    return n_parsed, n_loaded
+
+
+class TarballVerification(namedtuple('TarballVerification',
+                                     'n_matched n_missing mismatched')):
+    """
+    A namedtuple summarising the comparison of a tarball against the database.
+
+    Attributes:
+        n_matched (int): Packets present in the database, with identical XML.
+        n_missing (int): Packets not present in the database.
+        mismatched (list): IVORNs present in the database, but with
+            differing XML.
+    """
+    pass  # Just wrapping a namedtuple so we can assign a docstring.
+
+
+def verify_tarball(session, tarfile_path, batch_size=1000):
+    """
+    Check the packets in a tarball against the database, by content-hash.
+
+    Useful for verifying a dump / ingest round-trip, or comparing instances
+    (dump from one, verify against the other), without transferring XML.
+    Where the hashes differ, the stored XML is fetched and compared after
+    normalisation (see :func:`.convenience.stored_xml_matches`), so an
+    original archive verifies against the packets loaded from it by either
+    ingest path. Unparseable members are ignored.
+
+    Returns:
+        TarballVerification
+    """
+    n_matched = 0
+    n_missing = 0
+    mismatched = []
+
+    def check(batch):
+        stored = convenience.xml_digests(session, batch)
+        matched = 0
+        for ivorn, xml in batch.items():
+            if ivorn not in stored:
+                continue
+            if convenience.stored_xml_matches(session, ivorn,
+                                              stored[ivorn], xml):
+                matched += 1
+            else:
+                mismatched.append(ivorn)
+        return matched, len(batch) - len(stored)
+
+    batch = {}
+    for tarinf in tarfile_xml_generator(tarfile_path):
+        scan = _scan_tarxml(tarinf)
+        if scan is None:
+            continue
+        batch[scan.root_attrib['ivorn']] = scan.xml
+        if len(batch) >= batch_size:
+            matched, missing = check(batch)
+            n_matched += matched
+            n_missing += missing
+            batch = {}
+    if batch:
+        matched, missing = check(batch)
+        n_matched += matched
+        n_missing += missing
+    return TarballVerification(n_matched, n_missing, mismatched)
+
+
+class TarballLoadResult(namedtuple('TarballLoadResult',
+                                   'tarfile_path n_parsed n_loaded elapsed error')):
+    """
+    A namedtuple summarising the load of a single tarball.
+
+    Attributes:
+        tarfile_path (str): Path of the tarball.
+        n_parsed (int): Number of packets parsed.
+        n_loaded (int): Number of packets loaded.
+        elapsed (float): Wall-clock time taken, in seconds.
+        error (str): Description of the exception which aborted the load,
+            or None if it completed successfully.
+    """
+    pass  # Just wrapping a namedtuple so we can assign a docstring.
+
+
+# Per-process engine, used by :func:`_load_job` in job-pool processes.
+_job_engine = None
+
+
+def _init_load_job(dburl):
+    global _job_engine
+    # Each job-process runs one load at a time, so needs a single connection.
+    _job_engine = create_engine(dburl, pool_size=1, max_overflow=0)
+
+
+def _load_job(job):
+    """
+    Load a single tarball, catching and reporting any error.
+
+    ``job`` is a tuple ``(tarfile_path, loader, loader_kwargs)``.
+    """
+    tarfile_path, loader, loader_kwargs = job
+    session = Session(bind=_job_engine)
+    start_time = time.time()
+    n_parsed, n_loaded, error = 0, 0, None
+    try:
+        n_parsed, n_loaded = loader(session, tarfile_path=tarfile_path,
+                                    **loader_kwargs)
+    except Exception as e:
+        logger.exception('Error loading tarball {}'.format(tarfile_path))
+        session.rollback()
+        error = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        session.close()
+    return TarballLoadResult(tarfile_path, n_parsed, n_loaded,
+                             time.time() - start_time, error)
+
+
+def load_tarballs(dburl, tarfile_paths, loader=load_from_tarfile, n_jobs=1,
+                  **loader_kwargs):
+    """
+    Load a series of tarballs, optionally spread over a pool of processes.
+
+    Each job-process holds its own database connection and loads whole
+    tarballs, committing at the cadence set by the loader (``pkts_per_commit``).
+    This overlaps the decompression and parsing of one archive with the
+    database writes for another, so throughput scales with ``n_jobs`` until
+    the database itself becomes the bottleneck.
+
+    A failure loading one tarball does not abort the others; it is recorded
+    in the corresponding :class:`TarballLoadResult`. (Combine with
+    ``resume=True`` to retry just the failures later.)
+
+    Args:
+        dburl: SQLAlchemy database URL.
+        tarfile_paths (list): Paths of the tarballs to load.
+        loader: One of :func:`load_from_tarfile`,
+            :func:`bulk_load_from_tarfile` or
+            :func:`pipelined_load_from_tarfile`. Note that the pipelined
+            loader starts its own worker processes, and so can only be used
+            with ``n_jobs=1``.
+        n_jobs (int): Number of tarballs to load concurrently.
+        **loader_kwargs: Passed on to ``loader``.
+    Returns:
+        iterator: :class:`TarballLoadResult` for each tarball, yielded in
+        order of completion.
+    """
+    jobs = [(path, loader, loader_kwargs) for path in tarfile_paths]
+    if n_jobs <= 1:
+        _init_load_job(dburl)
+        try:
+            for job in jobs:
+                yield _load_job(job)
+        finally:
+            _job_engine.dispose()
+        return
+    if loader is pipelined_load_from_tarfile:
+        raise ValueError("Pipelined loading cannot be combined with n_jobs > 1")
+    pool = multiprocessing.Pool(processes=min(n_jobs, len(jobs)) or 1,
+                                initializer=_init_load_job,
+                                initargs=(dburl,))
+    try:
+        for result in pool.imap_unordered(_load_job, jobs, chunksize=1):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
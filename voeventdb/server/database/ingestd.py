@@ -0,0 +1,228 @@
+"""
+A long-running ingest service, listening for packets on a local Unix socket.
+
+Intended to replace one-process-per-packet ingest (``voeventdb_ingest_packet.py``)
+for brokers receiving packets at high rates: the daemon keeps a warm
+connection pool, and coalesces packets arriving close together into a single
+transaction.
+
+See :mod:`voeventdb.server.utils.ingest_client` for the wire protocol.
+The :class:`PacketBatcher` is also used by the Comet broker plugin.
+"""
+from __future__ import absolute_import, unicode_literals
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+
+import voeventparse as vp
+from six.moves import queue, socketserver
+
+import voeventdb.server.database.convenience as conv
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingPacket(object):
+    def __init__(self, etree, callback=None):
+        self.etree = etree
+        self.callback = callback
+        self.error = None
+        self.done = threading.Event()
+
+
+class PacketBatcher(object):
+    """
+    Micro-batches packet inserts on dedicated writer threads.
+
+    Packets submitted from any thread are queued; a writer collects up to
+    ``max_batch`` packets, or as many as arrive within ``max_wait`` seconds of
+    the first, and inserts them in a single transaction. If the batch fails
+    (e.g. due to a conflicting duplicate), it is retried packet-by-packet so
+    that only the offending packets are rejected.
+
+    Args:
+        session_factory: Callable returning a new SQLAlchemy session.
+        max_batch (int): Maximum number of packets per transaction.
+        max_wait (float): Maximum time (seconds) to hold a packet while
+            waiting for the batch to fill.
+        max_queued (int): Maximum number of packets waiting to be written,
+            or 0 for no limit. See :meth:`submit_async`.
+        n_writers (int): Number of writer threads (and hence, concurrent
+            transactions).
+    """
+
+    def __init__(self, session_factory, max_batch=100, max_wait=0.05,
+                 max_queued=0, n_writers=1):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._threads = [threading.Thread(target=self._run)
+                         for _ in range(n_writers)]
+        for t in self._threads:
+            t.daemon = True
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        """
+        Write any queued packets, then stop the writer threads.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+    def submit(self, etree):
+        """
+        Queue a packet for insertion, blocking until it has been committed.
+
+        Raises:
+            Exception: Whatever prevented the packet from being inserted.
+        """
+        pending = _PendingPacket(etree)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+    def submit_async(self, etree, callback=None):
+        """
+        Queue a packet for insertion, without waiting.
+
+        Args:
+            etree: Packet root, as loaded by voevent-parse.
+            callback: Function called (from a writer thread) once the packet
+                has been dealt with, as ``callback(error)`` - where ``error``
+                is None if the packet was committed successfully.
+        Raises:
+            six.moves.queue.Full: If ``max_queued`` packets are already
+                waiting, in which case the packet is not queued.
+        """
+        self._queue.put_nowait(_PendingPacket(etree, callback))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            self._write(batch)
+
+    def _write(self, batch):
+        session = self.session_factory()
+        try:
+            try:
+                conv.safe_insert_voevents(session, [p.etree for p in batch])
+                session.commit()
+                logger.debug("Committed batch of {} packets".format(len(batch)))
+            except Exception:
+                session.rollback()
+                if len(batch) == 1:
+                    raise
+                logger.warning("Batch insert of {} packets failed, "
+                               "retrying individually".format(len(batch)))
+                for pending in batch:
+                    try:
+                        conv.safe_insert_voevent(session, pending.etree)
+                        session.commit()
+                    except Exception as e:
+                        session.rollback()
+                        pending.error = e
+        except Exception as e:
+            batch[0].error = e
+        finally:
+            session.close()
+            for pending in batch:
+                pending.done.set()
+                if pending.callback is not None:
+                    try:
+                        pending.callback(pending.error)
+                    except Exception:
+                        logger.exception("Error in packet-insert callback")
+
+
+class _IngestRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        xml = self.rfile.read()
+        try:
+            v = vp.loads(xml)
+            ivorn = v.attrib['ivorn']
+            self.server.batcher.submit(v)
+            logger.info("Loaded packet with ivorn {}".format(ivorn))
+            reply = 'OK ' + ivorn
+        except Exception as e:
+            logger.exception("Could not insert packet")
+            reply = 'ERROR ' + ' '.join(str(e).split())
+        self.wfile.write((reply + '\n').encode('utf-8'))
+
+
+class IngestServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Unix-socket server, passing received packets to a :class:`PacketBatcher`.
+
+    Each connection is handled in its own thread, which waits until its
+    packet has been committed before replying - so a client receiving ``OK``
+    knows the packet is safely stored.
+
+    A stale socket file (left over from a previous, crashed, instance) is
+    removed on start-up; a live one raises an error.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher):
+        self.batcher = batcher
+        _remove_stale_socket(socket_path)
+        socketserver.ThreadingUnixStreamServer.__init__(
+            self, socket_path, _IngestRequestHandler)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.batcher.start()
+        try:
+            socketserver.ThreadingUnixStreamServer.serve_forever(
+                self, poll_interval)
+        finally:
+            self.batcher.stop()
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except socket.error as e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.unlink(socket_path)
+    else:
+        raise RuntimeError(
+            "Ingest daemon already listening on {}".format(socket_path))
+    finally:
+        probe.close()
@@ -0,0 +1,462 @@
+"""
+Routines for upgrading the contents of an existing database in-place.
+
+These back the ``voeventdb_migrate.py`` command; each works through the
+relevant table in batches (keyed on ``id``), committing after every batch so
+that long-running migrations can be interrupted and re-run safely.
+"""
+from __future__ import absolute_import, unicode_literals
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import pytz
+import sqlalchemy as sql
+from sqlalchemy import bindparam, func
+
+from voeventdb.server.database import segmentstore, xmlcodec
+from voeventdb.server.database.models import (Cite, CiteDescription, Stream,
+                                              Voevent, VoeventRollup,
+                                              XmlDictionary,
+                                              resolve_cites, xml_digest)
+from voeventdb.server.database.query import stream_counts_q
+
+logger = logging.getLogger(__name__)
+
+
+# Schema changes which the code relies upon, as
+# (``voeventdb_migrate.py`` command, table, column, data-type or None),
+# in the order the commands should be run. (``add-indexes`` only affects
+# performance, so isn't enforced.)
+_required_columns = (
+    ('backfill-digests', 'voevent', 'xml_sha256', None),
+    ('resolve-cites', 'cite', 'ref_voevent_id', None),
+    ('compact-dimensions', 'voevent', 'stream_id', None),
+    ('compact-dimensions', 'cite', 'description_id', None),
+    ('rebuild-rollups', 'voevent_rollup', 'role', 'character varying'),
+)
+
+
+def check_schema(connectable):
+    """
+    Check that an existing database has been migrated to the current schema.
+
+    Call this on startup (the REST app and the ingest tools do), rather than
+    failing later on with obscure SQL errors. Databases without a
+    ``voevent`` table (i.e. not yet created) pass.
+
+    Args:
+        connectable: SQLAlchemy engine or connection.
+    Raises:
+        RuntimeError: Listing the ``voeventdb_migrate.py`` commands still to
+            be run, if any.
+    """
+    tables = sorted(set(table for _, table, _, _ in _required_columns))
+    rows = connectable.execute(
+        'SELECT table_name, column_name, data_type '
+        'FROM information_schema.columns '
+        'WHERE table_name IN ({})'.format(
+            ', '.join("'{}'".format(table) for table in tables)))
+    data_types = dict(((table, column), data_type)
+                      for table, column, data_type in rows)
+    if not any(table == 'voevent' for table, _ in data_types):
+        return
+    pending = []
+    for command, table, column, data_type in _required_columns:
+        found = data_types.get((table, column))
+        if found is None or (data_type is not None and found != data_type):
+            if command not in pending:
+                pending.append(command)
+    if pending:
+        raise RuntimeError(
+            "Database schema is out of date, run these 'voeventdb_migrate.py' "
+            "commands (in this order, with ingest stopped): {} "
+            "- see the upgrade notes in CHANGES.rst.".format(
+                ', '.join(pending)))
+
+
+def _iter_id_batches(session, column_query, batch_size):
+    """
+    Keyset-paginate over the voevent table, yielding lists of result-rows.
+
+    ``column_query`` should be a query whose first column is ``Voevent.id``.
+    """
+    last_id = 0
+    while True:
+        batch = column_query.filter(Voevent.id > last_id).order_by(
+            Voevent.id).limit(batch_size).all()
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1][0]
+
+
+def train_xml_dictionary(session, n_samples=10000, dict_size=112640):
+    """
+    Train a new XML-compression dictionary on a random sample of packets.
+
+    The new dictionary is stored and made the active dictionary, so that
+    subsequently inserted packets are compressed with it. Existing rows are
+    unaffected, see :func:`recompress_xml`.
+
+    Returns:
+        XmlDictionary: The new dictionary row.
+    """
+    samples = [xml for xml, in session.query(Voevent.xml).order_by(
+        func.random()).limit(n_samples)]
+    logger.info("Training dictionary on {} packets".format(len(samples)))
+    trained = xmlcodec.train_dictionary(samples, dict_size=dict_size)
+    session.query(XmlDictionary).update({XmlDictionary.active: False})
+    row = XmlDictionary(id=trained.dict_id(),
+                        data=trained.as_bytes(),
+                        active=True,
+                        created=pytz.UTC.localize(datetime.utcnow()))
+    session.add(row)
+    session.commit()
+    xmlcodec.registry.register(row.id, row.data, active=True)
+    return row
+
+
+def _reencode_xml(session, reencode, batch_size):
+    """
+    Apply ``reencode`` to the stored (i.e. encoded) bytes of every packet.
+
+    Returns:
+        tuple: (n_updated, bytes_before, bytes_after) - number of rows
+        changed, and their total stored size before and after.
+    """
+    voevent_table = Voevent.__table__
+    # Fetch / write the stored bytes as-is, bypassing the PacketXml type:
+    stored_xml = sql.type_coerce(voevent_table.c.xml, sql.LargeBinary)
+    update = voevent_table.update().where(
+        voevent_table.c.id == bindparam('_id')).values(
+        xml=bindparam('_xml', type_=sql.LargeBinary))
+
+    n_updated = 0
+    bytes_before = 0
+    bytes_after = 0
+    for batch in _iter_id_batches(session,
+                                  session.query(Voevent.id, stored_xml),
+                                  batch_size):
+        updates = []
+        for voevent_id, stored in batch:
+            stored = bytes(stored)
+            new = reencode(stored)
+            if new != stored:
+                updates.append({'_id': voevent_id, '_xml': new})
+                bytes_before += len(stored)
+                bytes_after += len(new)
+        if updates:
+            session.execute(update, updates)
+            n_updated += len(updates)
+        session.commit()
+        logger.info("Re-encoded {} rows so far".format(n_updated))
+    return n_updated, bytes_before, bytes_after
+
+
+def recompress_xml(session, batch_size=1000, decompress=False):
+    """
+    Re-encode stored packet XML with the active dictionary.
+
+    Rows which are stored raw, or compressed with an older dictionary (or at
+    the lower level used on insert), are compressed with the active one, at
+    ``xmlcodec.recompress_level``. If ``decompress`` is set, all rows are
+    instead converted back to raw XML. (Rows held in a segment store are
+    re-encoded there.)
+
+    Returns:
+        tuple: (n_updated, bytes_before, bytes_after) - number of rows
+        re-encoded, and their total stored size before and after.
+    """
+    session.connection()  # Begin transaction, loading the dictionary registry.
+    if not decompress and xmlcodec.registry.active_id is None:
+        raise RuntimeError("No active compression dictionary, "
+                           "train one first.")
+
+    def reencode(stored):
+        return xmlcodec.encode(xmlcodec.decode(stored),
+                               compress=not decompress,
+                               use_store=segmentstore.is_locator(stored),
+                               level=xmlcodec.recompress_level)
+
+    return _reencode_xml(session, reencode, batch_size)
+
+
+def move_xml_to_segment_store(session, store, batch_size=1000):
+    """
+    Move stored packet bytes out of the database, into a segment store.
+
+    The bytes are moved verbatim (compressed or not), and replaced with
+    locators.
+
+    Returns:
+        tuple: As for :func:`recompress_xml`.
+    """
+
+    def reencode(stored):
+        if segmentstore.is_locator(stored):
+            return stored
+        return store.put(stored)
+
+    return _reencode_xml(session, reencode, batch_size)
+
+
+def move_xml_to_database(session, store, batch_size=1000):
+    """
+    Move packet bytes from a segment store back into the database.
+
+    Returns:
+        tuple: As for :func:`recompress_xml`.
+    """
+
+    def reencode(stored):
+        if segmentstore.is_locator(stored):
+            return store.get(stored)
+        return stored
+
+    return _reencode_xml(session, reencode, batch_size)
+
+
+def add_xml_digest_column(connection):
+    """
+    Add the ``voevent.xml_sha256`` column and index, if not already present.
+    """
+    connection.execute(
+        'ALTER TABLE voevent ADD COLUMN IF NOT EXISTS xml_sha256 varchar(64)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_voevent_xml_sha256 '
+        'ON voevent (xml_sha256)')
+
+
+def backfill_xml_digests(session, batch_size=1000):
+    """
+    Compute the ``xml_sha256`` content-hash for rows where it is missing.
+
+    Returns:
+        int: Number of rows updated.
+    """
+    voevent_table = Voevent.__table__
+    update = voevent_table.update().where(
+        voevent_table.c.id == bindparam('_id')).values(
+        xml_sha256=bindparam('_digest'))
+    query = session.query(Voevent.id, Voevent.xml).filter(
+        Voevent.xml_sha256 == None)
+    n_updated = 0
+    # NB rows drop out of the filter as they're updated, but we still use
+    # keyset pagination so unhashable rows can't stall the loop.
+    for batch in _iter_id_batches(session, query, batch_size):
+        session.execute(update, [{'_id': voevent_id, '_digest': xml_digest(xml)}
+                                 for voevent_id, xml in batch])
+        session.commit()
+        n_updated += len(batch)
+        logger.info("Backfilled {} digests so far".format(n_updated))
+    return n_updated
+
+
+def add_query_indexes(connection):
+    """
+    Create any query-support indexes missing from an older database.
+    """
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_voevent_author_datetime_id '
+        'ON voevent (author_datetime, id)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_voevent_ivorn_pattern '
+        'ON voevent (ivorn varchar_pattern_ops)')
+    connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_voevent_ivorn_trgm '
+        'ON voevent USING gin (ivorn gin_trgm_ops)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_cite_ref_ivorn_trgm '
+        'ON cite USING gin (ref_ivorn gin_trgm_ops)')
+
+
+def rebuild_rollups(session):
+    """
+    (Re)build the rollup table from scratch, in a single transaction.
+
+    Concurrent inserts wait for the rebuild to finish (they need to update
+    the rollups too), so their counts are neither lost nor double-counted.
+
+    Also brings an older rollup table (with an enum ``role`` column and
+    the original unique index) up to date.
+
+    Returns:
+        int: Number of rollup rows.
+    """
+    connection = session.connection()
+    VoeventRollup.__table__.create(connection, checkfirst=True)
+    connection.execute('LOCK TABLE voevent_rollup IN ACCESS EXCLUSIVE MODE')
+    connection.execute('DELETE FROM voevent_rollup')
+    connection.execute('DROP INDEX IF EXISTS ix_voevent_rollup_key')
+    connection.execute(
+        'ALTER TABLE voevent_rollup ALTER COLUMN role TYPE varchar '
+        'USING role::text')
+    for index in VoeventRollup.__table__.indexes:
+        if index.name == 'ix_voevent_rollup_key':
+            index.create(connection)
+    connection.execute(
+        "INSERT INTO voevent_rollup (stream_id, role, month, n_packets) "
+        "SELECT stream_id, role::text, "
+        "date_trunc('month', timezone('UTC', author_datetime)), count(*) "
+        "FROM voevent GROUP BY 1, 2, 3")
+    n_rows = session.query(VoeventRollup).count()
+    session.commit()
+    return n_rows
+
+
+def add_cite_ref_column(connection):
+    """
+    Add the ``cite.ref_voevent_id`` column and indexes, if not already present.
+
+    (Also indexes ``cite.voevent_id``, used to resolve a new packet's
+    references.)
+    """
+    connection.execute(
+        'ALTER TABLE cite ADD COLUMN IF NOT EXISTS ref_voevent_id integer '
+        'REFERENCES voevent (id) ON DELETE SET NULL')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_cite_ref_voevent_id '
+        'ON cite (ref_voevent_id)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_cite_unresolved_ref_ivorn '
+        'ON cite (ref_ivorn) WHERE ref_voevent_id IS NULL')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_cite_voevent_id ON cite (voevent_id)')
+
+
+def backfill_cite_refs(session, batch_size=1000):
+    """
+    Resolve ``cite.ref_voevent_id`` for all existing rows.
+
+    Returns:
+        int: Number of cites which remain unresolved (i.e. dangling).
+    """
+    n_processed = 0
+    for batch in _iter_id_batches(session, session.query(Voevent.id),
+                                  batch_size):
+        resolve_cites(session.connection(), [row[0] for row in batch])
+        session.commit()
+        n_processed += len(batch)
+        logger.info("Resolved cites for {} packets so far".format(n_processed))
+    return session.query(func.count(Cite.id)).filter(
+        Cite.ref_voevent_id == None).scalar()
+
+
+class CompactionReport(namedtuple('CompactionReport',
+                                  'bytes_before bytes_after '
+                                  'query_secs_before query_secs_after')):
+    """
+    Before / after figures for :func:`compact_dimension_columns`.
+
+    Attributes:
+        bytes_before (int): Data size of the ``voevent.stream`` and
+            ``cite.description`` columns.
+        bytes_after (int): Data size of the replacement key columns, plus
+            the dimension tables.
+        query_secs_before (float): Run time of the stream-counts query.
+        query_secs_after (float): Ditto, against the compact schema.
+    """
+    pass  # Just wrapping a namedtuple so we can assign a docstring.
+
+
+def _has_column(connection, table_name, column_name):
+    return connection.execute(
+        sql.text('SELECT count(*) FROM information_schema.columns '
+                 'WHERE table_name = :table AND column_name = :column'),
+        table=table_name, column=column_name).scalar() > 0
+
+
+def _backfill_keys(session, table_name, value_column, dimension, batch_size):
+    """
+    Fill in dimension-table keys for a table, in batches of ``id``.
+    """
+    key_column = '{}_id'.format(value_column)
+    max_id = session.execute(
+        'SELECT max(id) FROM {}'.format(table_name)).scalar() or 0
+    for lower in range(0, max_id, batch_size):
+        session.execute(sql.text(
+            'UPDATE {table} SET {key} = dim.id FROM {dim} dim '
+            'WHERE {table}.{value} = dim.value '
+            'AND {table}.id > :lower AND {table}.id <= :upper'.format(
+                table=table_name, key=key_column, value=value_column,
+                dim=dimension.__tablename__)),
+            dict(lower=lower, upper=lower + batch_size))
+        session.commit()
+        logger.info("Back-filled {}.{} up to id {}".format(
+            table_name, key_column, lower + batch_size))
+
+
+def compact_dimension_columns(session, batch_size=10000):
+    """
+    Convert a database to the compact, dimension-table schema.
+
+    Stream names and citation descriptions are moved into the ``stream``
+    and ``cite_description`` tables, and replaced by integer keys. (Roles
+    and cite-types are already stored as Postgres enums, i.e. 4-byte codes.)
+
+    NB the space taken up by the dropped columns is only returned to the
+    operating system once the tables are rewritten, e.g. by
+    ``VACUUM FULL``.
+
+    Returns:
+        CompactionReport: Before / after figures, or None if the database
+        already has the compact schema.
+    """
+    connection = session.connection()
+    if not _has_column(connection, 'voevent', 'stream'):
+        logger.info("Database already has compact dimension columns")
+        return None
+    bytes_before = connection.execute(
+        'SELECT (SELECT coalesce(sum(pg_column_size(stream)), 0) '
+        'FROM voevent) + (SELECT coalesce(sum(pg_column_size(description)), '
+        '0) FROM cite)').scalar()
+    start = time.time()
+    connection.execute(
+        'SELECT stream, count(id) FROM voevent GROUP BY stream').fetchall()
+    query_secs_before = time.time() - start
+
+    Stream.__table__.create(connection, checkfirst=True)
+    CiteDescription.__table__.create(connection, checkfirst=True)
+    connection.execute(
+        'ALTER TABLE voevent ADD COLUMN IF NOT EXISTS stream_id integer '
+        'REFERENCES stream (id)')
+    connection.execute(
+        'ALTER TABLE cite ADD COLUMN IF NOT EXISTS description_id integer '
+        'REFERENCES cite_description (id)')
+    connection.execute(
+        'INSERT INTO stream (value) SELECT DISTINCT stream FROM voevent '
+        'WHERE stream IS NOT NULL ON CONFLICT DO NOTHING')
+    connection.execute(
+        'INSERT INTO cite_description (value) SELECT DISTINCT description '
+        'FROM cite WHERE description IS NOT NULL ON CONFLICT DO NOTHING')
+    session.commit()
+
+    _backfill_keys(session, 'voevent', 'stream', Stream, batch_size)
+    _backfill_keys(session, 'cite', 'description', CiteDescription,
+                   batch_size)
+
+    connection = session.connection()
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_voevent_stream_id '
+        'ON voevent (stream_id)')
+    connection.execute('ALTER TABLE voevent DROP COLUMN stream')
+    connection.execute('ALTER TABLE cite DROP COLUMN description')
+    session.commit()
+    connection = session.connection()
+    connection.execute('ANALYZE voevent')
+    connection.execute('ANALYZE stream')
+
+    bytes_after = connection.execute(
+        "SELECT (SELECT coalesce(sum(pg_column_size(stream_id)), 0) "
+        "FROM voevent) + (SELECT coalesce(sum(pg_column_size(description_id)), "
+        "0) FROM cite) + pg_total_relation_size('stream') "
+        "+ pg_total_relation_size('cite_description')").scalar()
+    start = time.time()
+    stream_counts_q(session).all()
+    query_secs_after = time.time() - start
+    session.commit()
+    return CompactionReport(bytes_before, bytes_after,
+                            query_secs_before, query_secs_after)
@@ -1,14 +1,21 @@
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
 from sqlalchemy.orm import (backref, deferred, relationship,
                             )
-from sqlalchemy import Column, ForeignKey, Index, func
+from sqlalchemy import Column, ForeignKey, Index, event, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
 import sqlalchemy as sql
+import six
 import voeventparse as vp
 from datetime import datetime
+import hashlib
+import itertools
 import iso8601
 import pytz
 from collections import OrderedDict
 import logging
+from voeventdb.server.database.xmlcodec import PacketXml, dictionary_tablename
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +32,18 @@ def _grab_xpath(root, xpath, converter=lambda x: x):
     else:
         return None
 
+def xml_digest(xml):
+    """
+    Content-hash of a packet, as stored in the ``xml_sha256`` column.
+
+    Args:
+        xml (bytes): Raw packet XML.
+    Returns:
+        str: SHA-256 hex-digest.
+    """
+    return hashlib.sha256(xml).hexdigest()
+
+
 def _has_bad_coords(root, stream):
     """
     Predicate function encapsulating 'data clean up' filter code.
@@ -59,17 +78,162 @@ def _has_bad_coords(root, stream):
 
 
 class OdictMixin(object):
+    # Interned columns, which are represented by their value rather
+    # than their dimension-table key - see :func:`_interned_property`.
+    _odict_substitutions = {}
+
     def to_odict(self, exclude=None):
         """
         Returns an OrderedDict representation of the SQLalchemy table row.
         """
         if exclude is None:
             exclude = tuple()
-        colnames = [c.name for c in self.__table__.columns
-                    if c.name not in exclude]
+        colnames = [self._odict_substitutions.get(c.name, c.name)
+                    for c in self.__table__.columns]
+        colnames = [col for col in colnames if col not in exclude]
         return OrderedDict(((col, getattr(self, col)) for col in colnames))
 
 
+class DimensionMixin(OdictMixin):
+    """
+    Dimension-table of distinct (string) values, keyed by a small integer.
+
+    Values are looked up (or inserted) in batches via :func:`intern_values`.
+    NB the uniqueness constraint is on ``md5(value)``, so arbitrarily long
+    values can be interned.
+    """
+    id = Column(sql.Integer, primary_key=True)
+    value = Column(sql.String, nullable=False)
+
+
+class Stream(Base, DimensionMixin):
+    """
+    Distinct VOEvent stream names, cf :attr:`Voevent.stream`.
+    """
+    __tablename__ = 'stream'
+
+
+class CiteDescription(Base, DimensionMixin):
+    """
+    Distinct citation descriptions, cf :attr:`Cite.description`.
+    """
+    __tablename__ = 'cite_description'
+
+
+Index('ix_stream_value_md5', func.md5(Stream.value), unique=True)
+Index('ix_cite_description_value_md5', func.md5(CiteDescription.value),
+      unique=True)
+
+
+def _md5_hex(value):
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return hashlib.md5(value).hexdigest()
+
+
+def intern_values(connection, dimension, values):
+    """
+    Look up the dimension-table ids for some values, inserting if required.
+
+    Args:
+        connection: SQLAlchemy connection (or session).
+        dimension: Dimension model-class, e.g. :class:`Stream`.
+        values (iterable): Values to look up (may include None).
+    Returns:
+        dict: Mapping value -> id (and None -> None).
+    """
+    table = dimension.__table__
+    values = set(values)
+    values.discard(None)
+    ids = {None: None}
+
+    def lookup(to_find):
+        rows = connection.execute(
+            sql.select([table.c.id, table.c.value]).where(
+                func.md5(table.c.value).in_([_md5_hex(v) for v in to_find])))
+        ids.update((value, dim_id) for dim_id, value in rows)
+
+    if values:
+        lookup(values)
+    missing = values.difference(ids)
+    if missing:
+        # (Sorted, so concurrent inserters take row-locks in the same order.)
+        connection.execute(pg_insert(table).values(
+            [{'value': v} for v in sorted(missing)]).on_conflict_do_nothing())
+        lookup(missing)
+    return ids
+
+
+class _InternedComparator(Comparator):
+    """
+    Class-level behaviour of an interned attribute, see
+    :func:`_interned_property`.
+
+    Comparisons are rewritten as a test of the key column against an
+    (uncorrelated) sub-select on the dimension table, e.g.
+    ``stream_id IN (SELECT id FROM stream WHERE value = :value)``, which is
+    evaluated once per query rather than once per row. Used as a plain
+    expression (in a select-list or ``order_by``), it still resolves to a
+    correlated scalar-select - join the dimension table instead where that
+    matters.
+    """
+
+    def __init__(self, dimension, key):
+        self.dimension = dimension
+        self.key = key
+        super(_InternedComparator, self).__init__(
+            sql.select([dimension.value]).where(
+                dimension.id == key).as_scalar())
+
+    def operate(self, op, *other, **kwargs):
+        if not other:
+            # Unary, e.g. ``desc()``:
+            return op(self.expression, **kwargs)
+        if other[0] is None:
+            # ``== None`` etc - no dimension entry, i.e. a NULL key.
+            return op(self.key, *other, **kwargs)
+        return self.key.in_(sql.select([self.dimension.id]).where(
+            op(self.dimension.value, *other, **kwargs)))
+
+
+def _interned_property(dimension, key_name, entry_name):
+    """
+    Attribute-proxy for a value stored in a dimension-table.
+
+    Reads / writes the plain value at instance level - writes are converted
+    to dimension-table keys on flush, see :func:`_intern_flushed_values`.
+    Reads go via the ``entry_name`` relationship, which should be
+    eager-loaded (``lazy='joined'``), so that reading the value doesn't
+    cost a query per row.
+    At class level, provides an :class:`_InternedComparator`, so the
+    attribute can be used in query filters as if it were a regular column.
+    """
+    pending_name = '_pending_' + key_name
+
+    def fget(self):
+        if pending_name in self.__dict__:
+            return self.__dict__[pending_name]
+        entry = getattr(self, entry_name)
+        return entry.value if entry is not None else None
+
+    def fset(self, value):
+        self.__dict__[pending_name] = value
+        setattr(self, key_name, None)  # Flag as modified, key set on flush.
+
+    def comparator(cls):
+        return _InternedComparator(dimension, getattr(cls, key_name))
+
+    return hybrid_property(fget, fset).comparator(comparator)
+
+
+roles_enum = sql.Enum(vp.definitions.roles.observation,
+                     vp.definitions.roles.prediction,
+                     vp.definitions.roles.utility,
+                     vp.definitions.roles.test,
+                     name="roles_enum",
+                     )
+
+
 class Voevent(Base, OdictMixin):
     """
     Define the core VOEvent table.
@@ -86,6 +250,17 @@ class Voevent(Base, OdictMixin):
         http://justatheory.com/computers/databases/postgresql/use-timestamptz.html
         http://www.postgresql.org/docs/9.1/static/ddl-partitioning.html
 
+    .. NOTE::
+        On partitioning:
+        Native range-partitioning by ``author_datetime`` would require the
+        partition key to be part of every unique constraint - i.e. we'd lose
+        the global uniqueness of ``ivorn``, and the foreign keys from
+        ``cite`` / ``coord`` onto ``id``. Instead, time-bounded queries are
+        served by a composite ``(author_datetime, id)`` index, which gives
+        the same 'cost scales with the range, not the archive' property for
+        range filters, author_datetime ordering and keyset pagination
+        (see :func:`.query.keyset_batches`).
+
     """
     __tablename__ = 'voevent'
     # Basics: Attributes or associated metadata present for almost every VOEvent:
@@ -95,29 +270,35 @@ class Voevent(Base, OdictMixin):
         doc="Records when the packet was loaded into the database"
     )
     ivorn = Column(sql.String, nullable=False, unique=True, index=True)
-    stream = Column(sql.String, index=True)
-    role = Column(sql.Enum(vp.definitions.roles.observation,
-                           vp.definitions.roles.prediction,
-                           vp.definitions.roles.utility,
-                           vp.definitions.roles.test,
-                           name="roles_enum",
-                           ),
-                  index=True
-                  )
+    stream_id = Column(sql.Integer, ForeignKey(Stream.id), index=True)
+    stream_entry = relationship(Stream, lazy='joined')
+    # Stream name, stored in the ``stream`` dimension-table:
+    stream = _interned_property(Stream, 'stream_id', 'stream_entry')
+    role = Column(roles_enum, index=True)
     version = Column(sql.String)
     # Who
     author_ivorn = Column(sql.String)
     author_datetime = Column(sql.DateTime(timezone=True))
     # Finally, the raw XML. Mark this for lazy-loading, cf:
     # http://docs.sqlalchemy.org/en/latest/orm/loading_columns.html
-    xml = deferred(Column(sql.LargeBinary))
+    # (May be stored compressed, but always reads back as raw XML -
+    # see :mod:`voeventdb.server.database.xmlcodec`.)
+    xml = deferred(Column(PacketXml))
+    xml_sha256 = Column(
+        sql.String(64), index=True,
+        doc="SHA-256 hex-digest of the raw XML, see :func:`xml_digest`. "
+            "Allows duplicate-checks / comparisons without fetching the XML."
+    )
 
     cites = relationship("Cite", backref=backref('voevent', order_by=id),
+                         foreign_keys="Cite.voevent_id",
                          cascade="all, delete, delete-orphan")
 
     coords = relationship('Coord', backref=backref('voevent', order_by=id),
                           cascade="all, delete, delete-orphan")
 
+    _odict_substitutions = {'stream_id': 'stream'}
+
     @staticmethod
     def from_etree(root, received=pytz.UTC.localize(datetime.utcnow())):
         """
@@ -127,11 +308,13 @@ class Voevent(Base, OdictMixin):
         # Stream- Everything except before the '#' separator,
         # with the prefix 'ivo://' removed:
         stream = ivorn.split('#')[0][6:]
+        xml = vp.dumps(root)
         row = Voevent(ivorn=ivorn,
                       role=root.attrib['role'],
                       version=root.attrib['version'],
                       stream=stream,
-                      xml=vp.dumps(root),
+                      xml=xml,
+                      xml_sha256=xml_digest(xml),
                       received=received,
                       )
         row.author_datetime = _grab_xpath(root, 'Who/Date',
@@ -149,6 +332,34 @@ class Voevent(Base, OdictMixin):
                 )
         return row
 
+    @staticmethod
+    def from_metadata(metadata, received=None):
+        """
+        Init a Voevent row from a :class:`.extract.PacketMetadata` tuple.
+
+        This is the counterpart of :meth:`from_etree` for use with the
+        single-pass extractor, :func:`.extract.extract_metadata`.
+        """
+        if received is None:
+            received = pytz.UTC.localize(datetime.utcnow())
+        row = Voevent(ivorn=metadata.ivorn,
+                      role=metadata.role,
+                      version=metadata.version,
+                      stream=metadata.stream,
+                      xml=metadata.xml,
+                      xml_sha256=xml_digest(metadata.xml),
+                      received=received,
+                      author_ivorn=metadata.author_ivorn,
+                      author_datetime=metadata.author_datetime,
+                      )
+        row.cites = [Cite(ref_ivorn=ref_ivorn,
+                          cite_type=cite_type,
+                          description=description)
+                     for ref_ivorn, cite_type, description in metadata.cites]
+        row.coords = [Coord(ra=ra, dec=dec, error=error, time=time)
+                      for ra, dec, error, time in metadata.coords]
+        return row
+
     def _reformatted_prettydict(self, valformat=str):
         pd = self.prettydict()
         return '\n'.join(
@@ -198,6 +409,14 @@ class Cite(Base, OdictMixin):
         with a flag-bit set accordingly. Or we could create a separate 'cited
         IVORNS' table. But probably you ain't gonna need it.
 
+        Update: Turns out we did need it, at least for the citation queries.
+        We now also store ``ref_voevent_id``, the id of the cited Voevent,
+        if present. This is kept up to date on insert (see
+        :func:`resolve_cites`), including when a previously dangling IVORN
+        finally arrives - hence the partial index on unresolved ref_ivorns.
+        So cited-by queries are integer joins, and 'missing cites' queries
+        are just ``ref_voevent_id IS NULL``.
+
 
     .. note:: On descriptions
 
@@ -205,13 +424,18 @@ class Cite(Base, OdictMixin):
         really modelling are the EventIVORN entries in the Citations section of
         the VOEvent, which typically share a description between them. This may
         result in duplicated descriptions (but most packets only have a single
-        reference anyway).
+        reference anyway). To keep this cheap, descriptions are interned in a
+        dimension-table, see :class:`CiteDescription`.
 
     """
     __tablename__ = 'cite'
     id = Column(sql.Integer, primary_key=True)
-    voevent_id = Column(sql.Integer, ForeignKey(Voevent.id))
+    voevent_id = Column(sql.Integer, ForeignKey(Voevent.id), index=True)
     ref_ivorn = Column(sql.String, nullable=False, index=True)
+    ref_voevent_id = Column(
+        sql.Integer, ForeignKey(Voevent.id, ondelete='SET NULL'), index=True,
+        doc="Id of the cited Voevent, or NULL if not (yet) in the database"
+    )
     cite_type = Column(sql.Enum(vp.definitions.cite_types.followup,
                                 vp.definitions.cite_types.retraction,
                                 vp.definitions.cite_types.supersedes,
@@ -219,7 +443,13 @@ class Cite(Base, OdictMixin):
                                 ),
                        nullable=False
                        )
-    description = Column(sql.String)
+    description_id = Column(sql.Integer, ForeignKey(CiteDescription.id))
+    description_entry = relationship(CiteDescription, lazy='joined')
+    # Stored in the ``cite_description`` dimension-table:
+    description = _interned_property(CiteDescription, 'description_id',
+                                     'description_entry')
+
+    _odict_substitutions = {'description_id': 'description'}
 
     @staticmethod
     def from_etree(root):
@@ -361,5 +591,226 @@ class Coord(Base, OdictMixin):
                 )
         return position_list
 
+
+class TarballCheckpoint(Base, OdictMixin):
+    """
+    Bookkeeping table, recording progress of tarball ingest.
+
+    One row per tarball (keyed by absolute path). The row is updated in the
+    same transaction as each batch of packets is committed, so it always
+    reflects what is actually in the database. This allows an interrupted
+    load to be resumed, and a large collection of tarballs to be re-run
+    idempotently.
+    """
+    __tablename__ = 'tarball_checkpoint'
+    id = Column(sql.Integer, primary_key=True)
+    tarball_path = Column(sql.String, nullable=False, unique=True)
+    n_members = Column(
+        sql.Integer, nullable=False, default=0,
+        doc="Number of XML members (in tarball order) dealt with so far"
+    )
+    last_member_name = Column(sql.String)
+    last_member_digest = Column(
+        sql.String,
+        doc="SHA-256 hex-digest of the last member dealt with, used to "
+            "verify the tarball is unchanged when resuming"
+    )
+    n_parsed = Column(sql.Integer, nullable=False, default=0)
+    n_loaded = Column(sql.Integer, nullable=False, default=0)
+    complete = Column(sql.Boolean, nullable=False, default=False)
+    updated = Column(sql.DateTime(timezone=True))
+
+
+class VoeventRollup(Base, OdictMixin):
+    """
+    Pre-aggregated packet counts, by stream, role and authored month.
+
+    Kept up to date on insert (in the same transaction, see
+    :func:`update_rollups`), so that the 'Map' endpoints can be answered
+    without re-aggregating the whole voevent table. Rebuild from scratch
+    with :func:`.migrations.rebuild_rollups`.
+
+    There is exactly one row per (stream, role, month); ``role`` is stored
+    as plain text, rather than ``roles_enum``, so that NULL roles can be
+    coalesced in the unique index (enum-to-text casts are not immutable).
+    Reads should still use ``sum(n_packets)``, to aggregate over months etc.
+    """
+    __tablename__ = 'voevent_rollup'
+    id = Column(sql.Integer, primary_key=True)
+    stream_id = Column(sql.Integer, ForeignKey(Stream.id))
+    stream_entry = relationship(Stream, lazy='joined')
+    role = Column(sql.String)
+    month = Column(
+        sql.DateTime,
+        doc="Month of author_datetime (UTC, truncated), or NULL if none"
+    )
+    n_packets = Column(sql.Integer, nullable=False)
+
+
+Index('ix_voevent_rollup_key',
+      func.coalesce(VoeventRollup.stream_id, 0),
+      func.coalesce(VoeventRollup.role, sql.literal_column("''")),
+      func.coalesce(VoeventRollup.month,
+                    sql.literal_column("'-infinity'::timestamp")),
+      unique=True)
+
+# NB the ORDER BY means concurrent writers lock any rollup rows they share
+# in the same order, so they may queue on the hot (current month) rows, but
+# can't deadlock.
+_rollup_upsert = sql.text("""
+INSERT INTO voevent_rollup (stream_id, role, month, n_packets)
+SELECT stream_id, role::text,
+       date_trunc('month', timezone('UTC', author_datetime)),
+       :sign * count(*)
+FROM voevent WHERE id = ANY(:voevent_ids)
+GROUP BY 1, 2, 3
+ORDER BY 1, 2, 3
+ON CONFLICT ((coalesce(stream_id, 0)), (coalesce(role, '')),
+             (coalesce(month, '-infinity'::timestamp)))
+DO UPDATE SET n_packets = voevent_rollup.n_packets + excluded.n_packets
+""")
+
+
+def update_rollups(connection, voevent_ids, sign=1):
+    """
+    Add (or with ``sign=-1``, subtract) some Voevents to the rollup counts.
+
+    Args:
+        connection: SQLAlchemy connection (or session).
+        voevent_ids (list): Ids of the Voevent rows, which must be present
+            in the database (i.e. call after insert, or before delete).
+        sign (int): +1 or -1.
+    """
+    voevent_ids = list(voevent_ids)
+    if voevent_ids:
+        connection.execute(_rollup_upsert, dict(sign=sign,
+                                                voevent_ids=voevent_ids))
+
+
+class XmlDictionary(Base, OdictMixin):
+    """
+    Compression dictionaries for packet XML.
+
+    See :mod:`voeventdb.server.database.xmlcodec`.
+    """
+    __tablename__ = dictionary_tablename
+    id = Column(sql.BigInteger, primary_key=True, autoincrement=False,
+                doc="zstd dictionary id, as recorded in each compressed frame")
+    data = Column(sql.LargeBinary, nullable=False)
+    active = Column(
+        sql.Boolean, nullable=False, default=False,
+        doc="Whether newly inserted packets are compressed with this "
+            "dictionary (at most one active dictionary)"
+    )
+    created = Column(sql.DateTime(timezone=True), nullable=False)
+
+
 # Q3C indexes for spatial queries:
-Index('q3c_coord_idx', func.q3c_ang2ipix(Coord.ra, Coord.dec))
\ No newline at end of file
+Index('q3c_coord_idx', func.q3c_ang2ipix(Coord.ra, Coord.dec))
+# Time-bounded queries / author_datetime ordering:
+Index('ix_voevent_author_datetime_id', Voevent.author_datetime, Voevent.id)
+
+# Prefix (``LIKE 'prefix%'``) searches on IVORNs:
+Index('ix_voevent_ivorn_pattern', Voevent.ivorn,
+      postgresql_ops={'ivorn': 'varchar_pattern_ops'})
+
+# Trigram indexes for substring (``LIKE '%...%'``) searches on IVORNs.
+# (Requires the pg_trgm extension, see :func:`.db_utils.load_pg_trgm`.)
+Index('ix_voevent_ivorn_trgm', Voevent.ivorn, postgresql_using='gin',
+      postgresql_ops={'ivorn': 'gin_trgm_ops'})
+Index('ix_cite_ref_ivorn_trgm', Cite.ref_ivorn, postgresql_using='gin',
+      postgresql_ops={'ref_ivorn': 'gin_trgm_ops'})
+
+# Cites not yet resolved to a Voevent, looked up by IVORN on each insert:
+Index('ix_cite_unresolved_ref_ivorn', Cite.ref_ivorn,
+      postgresql_where=Cite.ref_voevent_id == None)
+
+
+def resolve_cites(connection, voevent_ids, resolve_outgoing=True):
+    """
+    Fill in ``Cite.ref_voevent_id`` after inserting some Voevents.
+
+    Resolves both the references made by the new packets, and any
+    previously dangling references to them.
+
+    Args:
+        connection: SQLAlchemy connection (or session).
+        voevent_ids (list): Ids of the newly inserted Voevent rows.
+        resolve_outgoing (bool): Set False to skip the references made by
+            the new packets, e.g. if they were resolved as they were loaded.
+    """
+    voevent_ids = list(voevent_ids)
+    if not voevent_ids:
+        return
+    cite_table = Cite.__table__
+    voevent_table = Voevent.__table__
+    resolve = cite_table.update().values(
+        ref_voevent_id=voevent_table.c.id).where(
+        cite_table.c.ref_voevent_id == None).where(
+        cite_table.c.ref_ivorn == voevent_table.c.ivorn)
+    if resolve_outgoing:
+        # References made by the new packets:
+        connection.execute(
+            resolve.where(cite_table.c.voevent_id.in_(voevent_ids)))
+    # References to the new packets:
+    connection.execute(resolve.where(voevent_table.c.id.in_(voevent_ids)))
+
+
+@event.listens_for(Session, 'before_flush')
+def _remove_flushed_rollups(session, flush_context, instances):
+    voevent_ids = [obj.id for obj in session.deleted
+                   if isinstance(obj, Voevent)]
+    update_rollups(session.connection(), voevent_ids, sign=-1)
+
+
+@event.listens_for(Session, 'after_flush')
+def _add_flushed_rollups(session, flush_context):
+    voevent_ids = [obj.id for obj in session.new
+                   if isinstance(obj, Voevent)]
+    update_rollups(session.connection(), voevent_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _resolve_flushed_cites(session, flush_context):
+    voevent_ids = set()
+    for obj in session.new:
+        if isinstance(obj, Voevent):
+            voevent_ids.add(obj.id)
+        elif isinstance(obj, Cite):
+            voevent_ids.add(obj.voevent_id)
+    voevent_ids.discard(None)
+    if voevent_ids:
+        resolve_cites(session.connection(), voevent_ids)
+
+
+# Interned attributes, as (model-class, dimension-class, key-column):
+_interned_attributes = (
+    (Voevent, Stream, 'stream_id', 'stream_entry'),
+    (Cite, CiteDescription, 'description_id', 'description_entry'),
+)
+
+
+def _intern_pending_values(session, instances):
+    """
+    Set dimension-table keys for any interned values assigned to instances.
+    """
+    for model, dimension, key_name, entry_name in _interned_attributes:
+        pending_name = '_pending_' + key_name
+        pending = [(obj, obj.__dict__[pending_name]) for obj in instances
+                   if isinstance(obj, model) and pending_name in obj.__dict__]
+        if pending:
+            ids = intern_values(session.connection(), dimension,
+                                [value for _, value in pending])
+            for obj, value in pending:
+                setattr(obj, key_name, ids[value])
+                # Interned, so from now on reads go via the entry - and later
+                # flushes mustn't overwrite any key assigned directly:
+                del obj.__dict__[pending_name]
+                if sql.inspect(obj).persistent:
+                    session.expire(obj, [entry_name])
+
+
+@event.listens_for(Session, 'before_flush')
+def _intern_flushed_values(session, flush_context, instances):
+    _intern_pending_values(session,
+                           list(itertools.chain(session.new, session.dirty)))
@@ -1,7 +1,8 @@
 from __future__ import absolute_import
-from voeventdb.server.database.models import Voevent, Cite, Coord
-from sqlalchemy import func, exists
-from sqlalchemy.orm import aliased
+from voeventdb.server.database.models import (Voevent, Cite, Coord, Stream,
+                                              VoeventRollup)
+from sqlalchemy import and_, func, or_, tuple_
+from sqlalchemy.orm import aliased, joinedload
 
 
 def authored_month_counts_q(session):
@@ -16,6 +17,30 @@ def authored_month_counts_q(session):
     ).select_from(Voevent).group_by('month_id')
     return month_counts_qry
 
+def escape_like(value):
+    """
+    Escape the ``LIKE`` wildcards in a value, so it matches literally.
+
+    (Underscores are common in IVORNs - left unescaped, they act as
+    single-character wildcards, which also prevents a trigram index from
+    narrowing the search.)
+    """
+    return (value.replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def ivorn_prefix_clause(ivorn_prefix):
+    """
+    Filter-clause matching IVORNs which begin with the given prefix.
+
+    Served by the ``varchar_pattern_ops`` index, ix_voevent_ivorn_pattern, as
+    an index range-scan (the plain ivorn index can't be used for ``LIKE``
+    under a non-C collation).
+    """
+    return Voevent.ivorn.like('{}%'.format(escape_like(ivorn_prefix)))
+
+
 def coord_cone_search_clause(ra, dec, radius):
     cone_search = func.q3c_radial_query(
                 Coord.ra, Coord.dec,
@@ -23,11 +48,95 @@ def coord_cone_search_clause(ra, dec, radius):
             )
     return cone_search
 
+def keyset_batches(query, batch_size, by_author_datetime=False):
+    """
+    Iterate over the results of a query in batches, using keyset pagination.
+
+    Unlike LIMIT / OFFSET, fetching each batch costs the same however far
+    through the results we are.
+
+    Args:
+        query: A query on (or on columns of) the Voevent table.
+        batch_size (int): Max number of rows per batch.
+        by_author_datetime (bool): Order by ``(author_datetime, id)``,
+            rather than ``id``. This makes use of the composite index when
+            the query is also time-bounded. NB rows with a NULL
+            ``author_datetime`` are excluded.
+    Yields:
+        list: Batches of query-result rows. (For multi-column queries, the
+        rows have the key-columns appended.)
+    """
+    if by_author_datetime:
+        keys = (Voevent.author_datetime, Voevent.id)
+    else:
+        keys = (Voevent.id,)
+    n_cols = len(query.column_descriptions)
+    keyed_query = query.add_columns(*keys).order_by(*keys)
+    last_key = None
+    while True:
+        batch_query = keyed_query
+        if last_key is not None:
+            batch_query = batch_query.filter(tuple_(*keys) > tuple_(*last_key))
+        rows = batch_query.limit(batch_size).all()
+        if not rows:
+            return
+        last_key = tuple(rows[-1][n_cols:])
+        if n_cols == 1:
+            yield [row[0] for row in rows]
+        else:
+            yield rows
+
+
+def keyset_after_clause(column, last_value, last_id, descending=False):
+    """
+    Select rows following ``(last_value, last_id)``, in ``(column, id)`` order.
+
+    Used to resume an ordered listing from the last row seen, rather than
+    skipping rows with OFFSET.
+
+    Args:
+        column: The Voevent column results are ordered by (then by id).
+        last_value: Value of ``column`` for the last row seen (may be None).
+        last_id (int): Voevent.id for the last row seen.
+        descending (bool): Whether the ordering is descending.
+    Returns:
+        A filter clause.
+    """
+    if column is Voevent.id:
+        return Voevent.id < last_id if descending else Voevent.id > last_id
+    # NB Postgres sorts NULLs as if larger than any other value, and
+    # row-comparisons involving a NULL are never true, so we have to
+    # treat them separately.
+    if last_value is None:
+        if descending:
+            return or_(and_(column == None, Voevent.id < last_id),
+                       column != None)
+        return and_(column == None, Voevent.id > last_id)
+    if descending:
+        return tuple_(column, Voevent.id) < tuple_(last_value, last_id)
+    return or_(tuple_(column, Voevent.id) > tuple_(last_value, last_id),
+               column == None)
+
+
+def packet_synopsis_q(session):
+    """
+    Query Voevent rows, with all the data for a synopsis eager-loaded.
+
+    I.e. stream, citations (and their descriptions) and coords are fetched
+    in the same query, rather than lazy-loaded per packet.
+    """
+    return session.query(Voevent).options(
+        joinedload(Voevent.stream_entry),
+        joinedload(Voevent.cites).joinedload(Cite.description_entry),
+        joinedload(Voevent.coords),
+    )
+
+
 def ivorn_cites_to_others_count_q(session):
     cites_to_others_count_qry = session.query(
         Voevent.ivorn.label('ivorn'),
         func.count(Cite.id).label('ref_count')
-    ).outerjoin(Cite).group_by(Voevent.id)
+    ).outerjoin(Voevent.cites).group_by(Voevent.id)
     return cites_to_others_count_qry
 
 
@@ -36,14 +145,13 @@ def ivorn_cited_from_others_count_q(session):
     cites_from_others_count_qry = session.query(
         Voevent.ivorn.label('ivorn'),
         func.count(cite2.id).label('citation_count')
-    ).outerjoin(cite2, cite2.ref_ivorn == Voevent.ivorn).group_by(Voevent.id)
+    ).outerjoin(cite2, cite2.ref_voevent_id == Voevent.id).group_by(Voevent.id)
     return cites_from_others_count_qry
 
 
 def _missing_cites_clause():
-    voevent2 = aliased(Voevent)
-    missing_cites_condition = ~exists().where(Cite.ref_ivorn == voevent2.ivorn)
-    return missing_cites_condition
+    # Unresolved cites - see the partial index on Cite.ref_ivorn.
+    return Cite.ref_voevent_id == None
 
 
 def missing_cites_q(session):
@@ -68,21 +176,63 @@ def role_counts_q(session):
 
 def stream_counts_q(session):
     s = session
+    # Group on the integer stream key, then join for the names.
     stream_counts_qry = s.query(
-        Voevent.stream.distinct().label('stream_id'),
-        (func.count(Voevent.ivorn)).label('stream_count'),
-    ).select_from(Voevent). \
-        group_by(Voevent.stream)
+        Stream.value.label('stream_id'),
+        (func.count(Voevent.id)).label('stream_count'),
+    ).select_from(Voevent).outerjoin(Voevent.stream_entry). \
+        group_by(Voevent.stream_id, Stream.value)
     return stream_counts_qry
 
 
 def stream_counts_role_breakdown_q(session):
     s = session
     stream_counts_role_breakdown_qry = s.query(
-        Voevent.stream.distinct().label('stream_id'),
+        Stream.value.label('stream_id'),
         Voevent.role,
-        (func.count(Voevent.ivorn)).label('stream_role_count'),
-    ).select_from(Voevent). \
-        group_by(Voevent.stream, Voevent.role)
+        (func.count(Voevent.id)).label('stream_role_count'),
+    ).select_from(Voevent).outerjoin(Voevent.stream_entry). \
+        group_by(Voevent.stream_id, Stream.value, Voevent.role)
 
     return stream_counts_role_breakdown_qry
+
+
+# Equivalents of the count-queries above, reading from the rollup table.
+# (Groups whose count has dropped to zero, via deletion, are omitted - as
+# they would be from a live aggregation.)
+
+def _rollup_sum():
+    return func.sum(VoeventRollup.n_packets)
+
+
+def authored_month_counts_rollup_q(session):
+    return session.query(
+        VoeventRollup.month.label('month_id'),
+        _rollup_sum().label('month_count'),
+    ).group_by(VoeventRollup.month).having(_rollup_sum() > 0)
+
+
+def role_counts_rollup_q(session):
+    return session.query(
+        VoeventRollup.role.label('role_id'),
+        _rollup_sum().label('role_count'),
+    ).group_by(VoeventRollup.role).having(_rollup_sum() > 0)
+
+
+def stream_counts_rollup_q(session):
+    return session.query(
+        Stream.value.label('stream_id'),
+        _rollup_sum().label('stream_count'),
+    ).select_from(VoeventRollup).outerjoin(VoeventRollup.stream_entry). \
+        group_by(VoeventRollup.stream_id, Stream.value). \
+        having(_rollup_sum() > 0)
+
+
+def stream_counts_role_breakdown_rollup_q(session):
+    return session.query(
+        Stream.value.label('stream_id'),
+        VoeventRollup.role,
+        _rollup_sum().label('stream_role_count'),
+    ).select_from(VoeventRollup).outerjoin(VoeventRollup.stream_entry). \
+        group_by(VoeventRollup.stream_id, Stream.value, VoeventRollup.role). \
+        having(_rollup_sum() > 0)
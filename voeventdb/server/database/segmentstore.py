@@ -0,0 +1,281 @@
+"""
+Content-addressed, append-only on-disk storage for packet XML.
+
+Packet XML is write-once and read rarely, so keeping it in the ``voevent``
+heap bloats vacuum, backups and the buffer cache. With a segment store
+enabled, packet bytes are instead appended to large 'segment' files on local
+disk, and the ``voevent.xml`` column holds only a small *locator*
+(segment number, offset, length and SHA-256 digest). Reads go through
+memory-mapped segments, so serving a packet is a page-cache lookup rather
+than a heap fetch. (We don't de-duplicate records - the database already
+rejects duplicate packets.)
+
+Like the tarballs of :mod:`voeventdb.server.utils.filestore`, segments are
+plain concatenations of packets which can be processed independently of the
+database: each record is a fixed header (record magic, digest, length)
+followed by the packet bytes.
+
+The store is selected per deployment by setting the environment variable
+``VOEVENTDB_SEGMENT_DIR`` (or calling :func:`configure`); it is opened on
+first use. Locators are resolved transparently by the
+:class:`.xmlcodec.PacketXml` column type; ``voeventdb_migrate.py
+segment-store`` moves existing packets between the database and the store,
+in either direction.
+
+.. note::
+
+    Bytes are appended when a row is flushed, but only synced to disk
+    (:meth:`SegmentStore.sync`) just before the database transaction
+    commits - so a rolled-back transaction (or a failed insert) leaves
+    unreferenced records behind. These are harmless, just wasted space:
+    readers only ever follow locators. (To reclaim the space, move the
+    packets back into the database with ``voeventdb_migrate.py
+    segment-store --to-database``, delete the segment files, then move the
+    packets out again.)
+
+The store requires a POSIX system (appends are serialized with ``flock``);
+it's an error to configure one where :mod:`fcntl` is unavailable.
+"""
+from __future__ import absolute_import, unicode_literals
+import glob
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+default_store_dir = os.environ.get('VOEVENTDB_SEGMENT_DIR')
+
+# Locator format: prefix, segment number, offset, length, digest.
+# (The leading null byte can never begin a valid XML document.)
+locator_prefix = b'\x00VSG'
+_locator_struct = struct.Struct('>4sIQI32s')
+# Record header format: magic, digest, length.
+_record_magic = b'VSR1'
+_record_struct = struct.Struct('>4s32sI')
+
+default_max_segment_size = 1 << 30
+
+_segment_filename_template = 'segment-{:06d}.dat'
+_segment_filename_regex = re.compile(r'segment-(\d{6})\.dat$')
+
+
+def is_locator(blob):
+    return blob[:4] == locator_prefix
+
+
+class SegmentStore(object):
+    """
+    A directory of append-only segment files.
+
+    Safe for use from multiple threads, and multiple processes (appends are
+    serialized with an exclusive lock-file in the store directory). A store
+    may be shared with child processes forked after it was opened: each
+    process opens its own lock-file and segment handles on first use, since
+    ``flock`` locks belong to the open file, and so would not exclude
+    processes sharing one.
+
+    Args:
+        store_dir (str): Path to the store directory (created if necessary).
+        max_segment_size (int): Start a new segment once the current one
+            exceeds this size, in bytes.
+    """
+
+    def __init__(self, store_dir, max_segment_size=default_max_segment_size):
+        if fcntl is None:
+            raise RuntimeError("The segment store requires the 'fcntl' "
+                               "module, i.e. a POSIX system")
+        self.store_dir = store_dir
+        self.max_segment_size = max_segment_size
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self._pid = None
+        self._check_pid()
+
+    def _check_pid(self):
+        """
+        (Re)initialize the per-process state, if we're in a new process.
+        """
+        if self._pid == os.getpid():
+            return
+        # Anything inherited from the parent process is just forgotten,
+        # the parent carries on using it.
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._lockfile = None
+        # The segment we're currently appending to, (number, file), and
+        # whether it has been written to since the last sync:
+        self._current = None
+        self._unsynced = False
+
+    def _segment_path(self, segment_no):
+        return os.path.join(self.store_dir,
+                            _segment_filename_template.format(segment_no))
+
+    def _segment_numbers(self):
+        numbers = []
+        for path in glob.glob(os.path.join(self.store_dir, 'segment-*.dat')):
+            match = _segment_filename_regex.search(path)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def put(self, data):
+        """
+        Append packet bytes to the store.
+
+        NB the bytes are not synced to disk until :meth:`sync` is called.
+
+        Returns:
+            bytes: A locator for the stored packet.
+        """
+        digest = hashlib.sha256(data).digest()
+        self._check_pid()
+        with self._lock:
+            segment_no, offset = self._append(digest, data)
+        return _locator_struct.pack(locator_prefix, segment_no, offset,
+                                    len(data), digest)
+
+    def sync(self):
+        """
+        Flush any records appended since the last sync to disk.
+
+        Call before committing a transaction which references them.
+        """
+        self._check_pid()
+        with self._lock:
+            if self._unsynced:
+                os.fsync(self._current[1].fileno())
+                self._unsynced = False
+
+    def _close_current(self):
+        if self._current is not None:
+            if self._unsynced:
+                os.fsync(self._current[1].fileno())
+                self._unsynced = False
+            self._current[1].close()
+            self._current = None
+
+    def _current_segment(self):
+        """
+        Return (segment_no, file) for appending, rolling over if required.
+
+        Must be called with the lock-file held, since other processes may
+        append to (or roll over) the segments too.
+        """
+        if self._current is None:
+            numbers = self._segment_numbers() or [1]
+            self._current = (numbers[-1],
+                             open(self._segment_path(numbers[-1]), 'ab'))
+        # A single stat to check whether another process has rolled over:
+        while os.path.exists(self._segment_path(self._current[0] + 1)):
+            segment_no = self._current[0] + 1
+            self._close_current()
+            self._current = (segment_no,
+                             open(self._segment_path(segment_no), 'ab'))
+        segment_no, f = self._current
+        f.seek(0, os.SEEK_END)
+        if f.tell() >= self.max_segment_size:
+            self._close_current()
+            segment_no += 1
+            f = open(self._segment_path(segment_no), 'ab')
+            self._current = (segment_no, f)
+        return segment_no, f
+
+    def _append(self, digest, data):
+        if self._lockfile is None:
+            self._lockfile = open(os.path.join(self.store_dir, '.lock'), 'a')
+        fcntl.flock(self._lockfile, fcntl.LOCK_EX)
+        try:
+            segment_no, f = self._current_segment()
+            offset = f.tell()
+            f.write(_record_struct.pack(_record_magic, digest, len(data)))
+            f.write(data)
+            f.flush()
+            self._unsynced = True
+        finally:
+            fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+        return segment_no, offset + _record_struct.size
+
+    def _segment_map(self, segment_no, min_size):
+        mapped = self._maps.get(segment_no)
+        if mapped is None or len(mapped) < min_size:
+            # Segment may have grown since we mapped it.
+            if mapped is not None:
+                mapped.close()
+            with open(self._segment_path(segment_no), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment_no] = mapped
+        return mapped
+
+    def get(self, locator):
+        """
+        Fetch the packet bytes for a locator.
+
+        Raises:
+            IOError: If the stored bytes do not match the locator digest.
+        """
+        _, segment_no, offset, length, digest = _locator_struct.unpack(locator)
+        self._check_pid()
+        with self._lock:
+            mapped = self._segment_map(segment_no, offset + length)
+            data = mapped[offset:offset + length]
+        if hashlib.sha256(data).digest() != digest:
+            raise IOError("Segment store digest mismatch for segment {}, "
+                          "offset {}".format(segment_no, offset))
+        return data
+
+    def close(self):
+        self._check_pid()
+        with self._lock:
+            self._close_current()
+            if self._lockfile is not None:
+                self._lockfile.close()
+                self._lockfile = None
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps = {}
+
+
+_store = None
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def configure(store_dir, **kwargs):
+    """
+    Enable the segment store for this process, or disable it (``None``).
+
+    Once enabled, newly inserted packets are written to the store. (A store
+    must also be configured to read back any packets already moved there.)
+    """
+    global _store, _configured
+    if _store is not None:
+        _store.close()
+    _store = SegmentStore(store_dir, **kwargs) if store_dir else None
+    _configured = True
+    return _store
+
+
+def get_store():
+    """
+    Return the configured :class:`SegmentStore`, or None.
+
+    If :func:`configure` has not been called, the store is configured from
+    ``VOEVENTDB_SEGMENT_DIR`` on first use.
+    """
+    if not _configured:
+        with _configure_lock:
+            if not _configured:
+                configure(default_store_dir)
+    return _store
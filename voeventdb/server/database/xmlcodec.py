@@ -0,0 +1,238 @@
+"""
+Optional compressed storage for packet XML.
+
+Packets may be stored either as raw XML bytes, or as zstd frames compressed
+with a dictionary trained on the existing corpus (VOEvent packets are small
+and highly repetitive, so a shared dictionary gives far better compression
+than compressing each packet in isolation).
+
+The two forms are distinguished by the zstd frame 'magic number' prefix,
+which can never begin a valid XML document, and each compressed frame
+records the id of the dictionary it was compressed with. Dictionaries are
+stored in the ``xml_dictionary`` table (see :class:`.XmlDictionary`), and
+loaded into a per-process registry at the start of the first transaction -
+then re-checked at the start of a transaction every
+``dictionary_reload_interval`` seconds, so long-running processes (the web
+app, ingest daemon, etc.) pick up a newly trained dictionary without a
+restart.
+
+Newly inserted packets are compressed at a moderate level
+(``default_compression_level``), to keep bulk loads fast;
+``voeventdb_migrate.py compress-xml`` re-encodes existing packets at
+``recompress_level``, trading CPU time for a better compression ratio.
+
+Compression is switched on by training a dictionary
+(``voeventdb_migrate.py train-dictionary``): while there is an *active*
+dictionary, newly inserted packets are compressed. Reading back is always
+transparent, via the :class:`PacketXml` column type.
+
+Requires the optional ``zstandard`` package.
+
+Packet bytes (compressed or not) may also be moved out of the database
+altogether, into a :mod:`.segmentstore`.
+"""
+from __future__ import absolute_import, unicode_literals
+import logging
+import threading
+import time
+
+import sqlalchemy as sql
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from voeventdb.server.database import segmentstore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+dictionary_tablename = 'xml_dictionary'
+
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+default_compression_level = 3
+recompress_level = 19
+
+# Seconds between checks for newly trained / activated dictionaries:
+dictionary_reload_interval = 60
+
+
+class _DictionaryRegistry(object):
+    """
+    Per-process cache of the compression dictionaries.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.dictionaries = {}
+        self.active_id = None
+        self.loaded = False
+        self.loaded_at = None
+        self._local = threading.local()
+
+    def needs_load(self):
+        return (not self.loaded or
+                time.time() - self.loaded_at > dictionary_reload_interval)
+
+    def register(self, dict_id, data, active=False):
+        self.dictionaries[dict_id] = zstandard.ZstdCompressionDict(data)
+        if active:
+            self.active_id = dict_id
+        self._local = threading.local()  # Invalidate (de)compressors.
+
+    def load(self, connection):
+        """
+        Load any dictionaries not yet registered, and the active setting.
+
+        (Dictionary data is only fetched for new dictionaries, so repeated
+        loads are cheap.)
+        """
+        self.loaded = True
+        self.loaded_at = time.time()
+        if not connection.dialect.has_table(connection, dictionary_tablename):
+            return
+        rows = connection.execute(text(
+            'SELECT id, active FROM {} ORDER BY created'.format(
+                dictionary_tablename))).fetchall()
+        if rows and zstandard is None:
+            logger.error("XML compression dictionaries present, but the "
+                         "'zstandard' package is not installed")
+            return
+        active_id = None
+        for dict_id, active in rows:
+            if dict_id not in self.dictionaries:
+                data = connection.execute(text(
+                    'SELECT data FROM {} WHERE id = :dict_id'.format(
+                        dictionary_tablename)), dict_id=dict_id).scalar()
+                self.register(dict_id, bytes(data))
+            if active:
+                active_id = dict_id
+        self.active_id = active_id
+
+    def compressor(self, level=None):
+        # (De)compressors are not thread-safe, so we keep one per thread.
+        if level is None:
+            level = default_compression_level
+        compressors = getattr(self._local, 'compressors', None)
+        if compressors is None:
+            compressors = self._local.compressors = {}
+        key = (self.active_id, level)
+        if key not in compressors:
+            compressors[key] = zstandard.ZstdCompressor(
+                level=level, dict_data=self.dictionaries[self.active_id])
+        return compressors[key]
+
+    def decompressor(self, dict_id):
+        decompressors = getattr(self._local, 'decompressors', None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        if dict_id not in decompressors:
+            if dict_id not in self.dictionaries:
+                # Maybe trained by another process since we loaded; so
+                # re-check at the start of the next transaction.
+                self.loaded = False
+                raise LookupError(
+                    "Unknown XML compression dictionary: {}".format(dict_id))
+            decompressors[dict_id] = zstandard.ZstdDecompressor(
+                dict_data=self.dictionaries[dict_id])
+        return decompressors[dict_id]
+
+
+registry = _DictionaryRegistry()
+
+
+@event.listens_for(Session, 'after_begin')
+def _load_dictionaries(session, transaction, connection):
+    if registry.needs_load():
+        registry.load(connection)
+
+
+@event.listens_for(Session, 'before_commit')
+def _sync_segment_store(session):
+    # Segment-store records must be durable before the rows referencing them.
+    store = segmentstore.get_store()
+    if store is not None:
+        store.sync()
+
+
+def is_compressed(blob):
+    return blob[:4] == zstd_magic
+
+
+def encode(xml, compress=True, use_store=True, level=None):
+    """
+    Encode packet XML for storage in the ``voevent.xml`` column.
+
+    Compresses with the active dictionary, if there is one (and ``compress``
+    is set); then if a segment store is configured (and ``use_store`` is set),
+    moves the bytes to the store, returning a locator. Already-encoded input
+    is returned unchanged.
+
+    ``level`` is the zstd compression level, default
+    ``default_compression_level``.
+    """
+    if segmentstore.is_locator(xml):
+        return xml
+    if (compress and registry.active_id is not None and
+            not is_compressed(xml)):
+        xml = registry.compressor(level).compress(xml)
+    store = segmentstore.get_store()
+    if use_store and store is not None:
+        return store.put(xml)
+    return xml
+
+
+def decode(blob):
+    """
+    Return the raw XML for a stored blob, fetching / decompressing if required.
+    """
+    if segmentstore.is_locator(blob):
+        store = segmentstore.get_store()
+        if store is None:
+            raise RuntimeError("Packet XML is held in a segment store, but "
+                               "none is configured (VOEVENTDB_SEGMENT_DIR)")
+        blob = store.get(blob)
+    if not is_compressed(blob):
+        return blob
+    if zstandard is None:
+        raise RuntimeError("Compressed XML found, but the 'zstandard' "
+                           "package is not installed")
+    dict_id = zstandard.get_frame_parameters(blob).dict_id
+    return registry.decompressor(dict_id).decompress(blob)
+
+
+def train_dictionary(samples, dict_size=112640):
+    """
+    Train a compression dictionary on a sample of packets.
+
+    Args:
+        samples (list): Raw XML bytestrings.
+        dict_size (int): Target dictionary size in bytes.
+    Returns:
+        zstandard.ZstdCompressionDict
+    """
+    return zstandard.train_dictionary(dict_size, samples)
+
+
+class PacketXml(sql.types.TypeDecorator):
+    """
+    Binary column-type for packet XML, compressing / decompressing on the fly.
+
+    See module docstring for details.
+    """
+    impl = sql.LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decode(bytes(value))
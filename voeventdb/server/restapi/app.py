@@ -7,7 +7,7 @@ from __future__ import absolute_import, print_function
 from sqlalchemy import engine
 from flask import Flask, send_from_directory
 
-from voeventdb.server.database import session_registry
+from voeventdb.server.database import migrations, session_registry
 from voeventdb.server.restapi.v1.views import apiv1
 import voeventdb.server.restapi.v1.filters
 from voeventdb.server.restapi.v1.jsonencoder import IsodatetimeJSONEncoder
@@ -22,6 +22,14 @@ app.register_blueprint(apiv1)
 
 # app.config['DOCS_URL'] = "http://127.0.0.1:5000/docs/"
 
+@app.before_first_request
+def check_database_schema():
+    """
+    Refuse to serve from a database which still needs migrating.
+    """
+    migrations.check_schema(session_registry.get_bind())
+
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     session_registry.remove()
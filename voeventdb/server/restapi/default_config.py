@@ -3,6 +3,43 @@
 DEFAULT_QUERY_LIMIT = 100
 # Maximum number of list-entries returned by a single request:
 MAX_QUERY_LIMIT = 10000
+# Maximum number of IVORNs in a single batch-synopsis request:
+MAX_SYNOPSIS_BATCH = 100
+# Streamed list results (``format=ndjson``) are written out incrementally,
+# so worker memory use doesn't grow with the result size. Deployments may
+# therefore allow a higher cap for them (e.g. 1000000) - but note that applies
+# to all callers, and a large export still costs a long-running query:
+MAX_STREAM_QUERY_LIMIT = MAX_QUERY_LIMIT
+# Rows fetched per round-trip from the server-side cursor when streaming:
+STREAM_BATCH_SIZE = 1000
+
+# With 'count_mode=auto', return the planner's estimate rather than an exact
+# count if the estimate exceeds this:
+COUNT_ESTIMATE_THRESHOLD = 100000
+# Results of count / map queries are cached (per server process), until the
+# next ingest or for at most RESULT_CACHE_TTL seconds:
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL = 3600
+# If non-zero, then after an ingest, results up to this many seconds old
+# are served while an up-to-date result is computed in the background, by
+# a pool of RESULT_CACHE_REFRESH_WORKERS threads (per server process, each
+# taking a database connection while busy):
+RESULT_CACHE_STALE_SECONDS = 0
+RESULT_CACHE_REFRESH_WORKERS = 2
+
+# Packet XML / synopses are cached by IVORN, up to this many bytes per server
+# process:
+PACKET_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Alternatively, share one cache between all the server processes, held in
+# Redis (e.g. 'redis://localhost:6379/0'; requires the 'redis' package):
+PACKET_CACHE_REDIS_URL = None
+
+# Cache-Control headers, so a reverse proxy can serve repeat requests.
+# Query results change as packets are ingested (clients can revalidate
+# cheaply, via the ETag / Last-Modified headers); stored packets never change.
+# Set to None to omit the header.
+QUERY_CACHE_CONTROL = 'public, max-age=60'
+PACKET_CACHE_CONTROL = 'public, max-age=86400'
 
 # Set this to true when serving via Apache / mod_wsgi,
 # and apply the Apache conf setting 'AllowEncodedSlashes NoDecode'.
@@ -27,6 +27,29 @@ class LimitMaxExceeded(Exception):
             """.format(limit_request, limit_max)
 
 
+class BatchSizeExceeded(Exception):
+    code = 413
+    description = "Max batch size exceeded"
+
+    def __init__(self, batch_size, batch_max):
+        Exception.__init__(self)
+        self.message = """
+            You requested too many packets ({}).
+            The maximum allowed per request is {}.
+            """.format(batch_size, batch_max)
+
+
+class InvalidRequestBody(Exception):
+    code = 400
+    description = "Invalid request body"
+
+    def __init__(self, reason):
+        Exception.__init__(self)
+        self.message = """
+            Error parsing request body - {}
+            """.format(reason)
+
+
 class IvornNotFound(Exception):
     code = 422
     description = 'IVORN not found'
@@ -0,0 +1,477 @@
+from __future__ import absolute_import
+
+"""
+Caching of query results and packet data.
+
+Query results are cached in-process, and invalidated on ingest. Stored
+packets never change, so packet data (XML, synopses) is cached by IVORN
+with no invalidation other than on deletion - either in-process, or in a
+backend shared by all the server processes.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import copy_current_request_context, current_app, g
+from six.moves import queue
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import voeventdb.server.database.convenience as convenience
+from voeventdb.server.database.models import Voevent
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+class WatermarkCache(object):
+    """
+    A small LRU cache, where each entry is tagged with an 'ingest watermark'.
+
+    Entries are only returned if the watermark matches the current value
+    (see :func:`.convenience.ingest_watermark`), so cached results are
+    discarded as soon as new packets arrive. Safe for use from multiple
+    threads.
+
+    Args:
+        max_entries (int): Least-recently used entries are evicted beyond
+            this number.
+        ttl (float): Entries also expire after this many seconds, if set.
+            (A backstop, cf the caveat on
+            :func:`.convenience.ingest_watermark`.)
+        stale_ttl (float): Outdated entries may still be returned by
+            :meth:`get_stale` for this many seconds after they were stored,
+            cf :func:`cached_query_result`.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, stale_ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            # Move to most-recently-used position:
+            del self._entries[key]
+            self._entries[key] = entry
+        return entry
+
+    def get(self, key, watermark, default=None):
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None or entry[0] != watermark:
+                return default
+            if self.ttl and time.time() - entry[1] > self.ttl:
+                return default
+            return entry[2]
+
+    def get_stale(self, key, default=None):
+        """
+        Return an entry regardless of watermark, if not older than stale_ttl.
+        """
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None or time.time() - entry[1] > self.stale_ttl:
+                return default
+            return entry[2]
+
+    def put(self, key, watermark, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (watermark, time.time(), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def start_refresh(self, key):
+        """
+        Claim the job of refreshing an entry.
+
+        Returns:
+            bool: False if a refresh is already under way.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def querystring_cache_key(view_name, args, ignore_keys=()):
+    """
+    Cache-key for a request, insensitive to querystring ordering.
+
+    (Both the keys and any repeated values are sorted - multiple values for
+    a query-filter are always OR'd together, so their order is irrelevant.)
+    """
+    return (view_name,) + tuple(sorted(
+        (key, tuple(sorted(values))) for key, values in args.lists()
+        if key not in ignore_keys))
+
+
+def request_watermark(session):
+    """
+    Return the ingest watermark, looked up at most once per request.
+    """
+    if 'ingest_watermark' not in g:
+        g.ingest_watermark = convenience.ingest_watermark(session)
+    return g.ingest_watermark
+
+
+_result_cache = None
+
+
+def result_cache():
+    """
+    Return the (per-process) query-result cache, configured from app config.
+    """
+    global _result_cache
+    if _result_cache is None:
+        config = current_app.config
+        _result_cache = WatermarkCache(
+            max_entries=config['RESULT_CACHE_SIZE'],
+            ttl=config['RESULT_CACHE_TTL'],
+            stale_ttl=config['RESULT_CACHE_STALE_SECONDS'])
+    return _result_cache
+
+
+def reset_result_cache():
+    global _result_cache
+    _result_cache = None
+
+
+class RefreshWorkers(object):
+    """
+    A fixed pool of daemon threads, for refreshing cached results in the
+    background, cf :func:`cached_query_result`.
+
+    Threads are started on first use (and re-started in a forked child
+    process). Jobs wait in a bounded queue; if that is full, they are
+    rejected rather than queued.
+
+    Args:
+        n_workers (int): Number of threads, i.e. the maximum number of
+            refresh queries (and hence database connections) at any time.
+        max_queued (int): Maximum number of jobs waiting for a thread.
+    """
+
+    def __init__(self, n_workers, max_queued=64):
+        self.n_workers = n_workers
+        self.max_queued = max_queued
+        self._pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self.max_queued)
+            for i in range(self.n_workers):
+                thread = threading.Thread(
+                    target=self._run, args=(self._queue,),
+                    name='voeventdb-result-refresh-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+
+    def submit(self, job):
+        """
+        Queue a callable to be run by one of the threads.
+
+        Returns:
+            bool: False if the queue is full, and the job was dropped.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            return False
+        return True
+
+    @staticmethod
+    def _run(job_queue):
+        while True:
+            job = job_queue.get()
+            try:
+                job()
+            except Exception:
+                logger.exception("Background refresh of cached result failed")
+
+
+_refresh_workers = None
+
+
+def refresh_workers():
+    """
+    Return the (per-process) pool of result-refresh threads.
+
+    Sized by ``RESULT_CACHE_REFRESH_WORKERS``.
+    """
+    global _refresh_workers
+    if _refresh_workers is None:
+        _refresh_workers = RefreshWorkers(
+            current_app.config['RESULT_CACHE_REFRESH_WORKERS'])
+    return _refresh_workers
+
+
+def cached_query_result(cache, key, watermark, compute):
+    """
+    Look up a query result, computing (and caching) it if required.
+
+    If the cache allows stale entries (``stale_ttl``), an outdated result is
+    returned immediately, and refreshed in the background by one of the
+    :func:`refresh_workers` - so a popular query isn't re-run by several
+    requests at once after an ingest, and none of them wait for it. At most
+    one refresh per key is under way at a time, cf
+    :meth:`WatermarkCache.start_refresh`. Stale responses are flagged by
+    setting ``g.served_stale``.
+
+    The refresh runs in a copy of the current request context, so ``compute``
+    may use ``request``, ``current_app`` and the scoped database session
+    (a separate session for the worker thread, removed on teardown).
+
+    Args:
+        cache (WatermarkCache): Result cache.
+        key: Cache key, e.g. from :func:`querystring_cache_key`.
+        watermark: Current ingest watermark.
+        compute (callable): Computes the result. Must not return None.
+    """
+    value = cache.get(key, watermark)
+    if value is not None:
+        return value
+    if cache.stale_ttl:
+        value = cache.get_stale(key)
+        if value is not None:
+            if cache.start_refresh(key):
+                refresh = copy_current_request_context(_refresh_result)
+                if not refresh_workers().submit(
+                        lambda: refresh(cache, key, watermark, compute)):
+                    logger.warning("Result refresh queue full, "
+                                   "skipping refresh")
+                    cache.end_refresh(key)
+            g.served_stale = True
+            return value
+        # Nothing to serve in the meantime, so compute it ourselves.
+    value = compute()
+    cache.put(key, watermark, value)
+    return value
+
+
+def _refresh_result(cache, key, watermark, compute):
+    try:
+        cache.put(key, watermark, compute())
+    finally:
+        cache.end_refresh(key)
+
+
+class ByteBoundedCache(object):
+    """
+    An in-process LRU cache of bytestrings, bounded by their total size.
+
+    Safe for use from multiple threads. Keeps count of hits, misses and
+    evictions.
+
+    Args:
+        max_bytes (int): Least-recently used entries are evicted to keep the
+            total size of cached values below this.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries[key] = value  # Now most-recently-used.
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = value
+            self.n_bytes += len(value)
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.n_bytes -= len(evicted)
+                self.evictions += 1
+
+    def _discard(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self.n_bytes -= len(value)
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        return {'backend': 'local', 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'bytes': self.n_bytes,
+                'max_bytes': self.max_bytes}
+
+
+class RedisCache(object):
+    """
+    A cache of bytestrings shared between processes, held in Redis.
+
+    Size-bounding and eviction are left to the Redis server, which should be
+    configured with ``maxmemory`` and ``maxmemory-policy allkeys-lru``.
+    Hit / miss counts are per-process. Requires the optional ``redis``
+    package.
+
+    Args:
+        url (str): Redis server URL, e.g. ``redis://localhost:6379/0``.
+        key_prefix (str): Namespace for our keys.
+    """
+
+    def __init__(self, url, key_prefix='voeventdb:'):
+        if redis is None:
+            raise RuntimeError("A shared packet cache is configured, but "
+                               "the 'redis' package is not installed")
+        self.client = redis.StrictRedis.from_url(url)
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.key_prefix + key)
+        except redis.RedisError:
+            logger.exception("Packet cache lookup failed")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        try:
+            self.client.set(self.key_prefix + key, value)
+        except redis.RedisError:
+            logger.exception("Packet cache store failed")
+
+    def discard(self, key):
+        try:
+            self.client.delete(self.key_prefix + key)
+        except redis.RedisError:
+            logger.exception("Packet cache discard failed")
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.key_prefix + '*'):
+            self.client.delete(key)
+
+    def stats(self):
+        try:
+            evictions = self.client.info('stats').get('evicted_keys')
+        except redis.RedisError:
+            evictions = None
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses,
+                'evictions': evictions}
+
+
+_packet_cache = None
+
+
+def packet_cache():
+    """
+    Return the packet-data cache, configured according to the app config.
+
+    Uses a :class:`RedisCache` if ``PACKET_CACHE_REDIS_URL`` is set, else a
+    per-process :class:`ByteBoundedCache` of ``PACKET_CACHE_MAX_BYTES``.
+    """
+    global _packet_cache
+    if _packet_cache is None:
+        redis_url = current_app.config.get('PACKET_CACHE_REDIS_URL')
+        if redis_url:
+            _packet_cache = RedisCache(redis_url)
+        else:
+            _packet_cache = ByteBoundedCache(
+                current_app.config['PACKET_CACHE_MAX_BYTES'])
+    return _packet_cache
+
+
+def reset_packet_cache():
+    """
+    Discard the packet cache (it will be re-created on next use).
+    """
+    global _packet_cache
+    if _packet_cache is not None:
+        _packet_cache.clear()
+    _packet_cache = None
+
+
+def packet_cache_keys(ivorn):
+    """
+    Return the keys under which data for a packet is cached.
+
+    Returns:
+        tuple: ``(xml_key, synopsis_key, digest_key)``
+    """
+    return 'xml:' + ivorn, 'synopsis:' + ivorn, 'sha256:' + ivorn
+
+
+def packet_digest(session, ivorn):
+    """
+    Return the stored content-hash of a packet, via the packet cache.
+
+    Returns:
+        str: The ``xml_sha256`` hex-digest, or None if the packet is not
+        in the database (which is not cached).
+    """
+    cache = packet_cache()
+    _, _, cache_key = packet_cache_keys(ivorn)
+    digest = cache.get(cache_key)
+    if digest is not None:
+        return digest.decode('ascii')
+    digest = convenience.xml_digests(session, [ivorn]).get(ivorn)
+    if digest is not None:
+        cache.put(cache_key, digest.encode('ascii'))
+    return digest
+
+
+@event.listens_for(Session, 'after_flush')
+def _discard_deleted_packets(session, flush_context):
+    # NB only covers deletions made via the ORM, in this process (or
+    # any process, with a shared backend).
+    if _packet_cache is None:
+        return
+    for obj in session.deleted:
+        if isinstance(obj, Voevent):
+            for key in packet_cache_keys(obj.ivorn):
+                _packet_cache.discard(key)
@@ -89,6 +89,11 @@ class PaginationKeys:
     Note that if no values are supplied, a default limit value is applied.
     (You can still check what it was, by inspecting the relevant value in the
     :ref:`result-dict <returned-content>`.)
+
+    To walk through a long listing, prefer *cursor* to *offset*: a large
+    offset means the database has to generate (and discard) all the skipped
+    rows, whereas a cursor request costs the same however deep into the
+    listing it is.
     """
     # These hardly need soft-defining, but we include them for completeness.
     limit = 'limit'
@@ -104,6 +109,92 @@ class PaginationKeys:
     Controls the ordering of results, before limit and offset are applied.
     Valid values are enumerated by the :class:`.OrderValues` class.
     """
+    cursor = 'cursor'
+    """
+    Continue a listing from where a previous request left off. Supply the
+    ``next`` value from the previous :ref:`result-dict <returned-content>`,
+    along with the same filters and ordering. May not be combined with
+    *offset*.
+    """
+
+
+@add_value_list_attribute
+class OutputKeys:
+    """
+    These query-keys control how results are computed or formatted, rather
+    than which packets are selected.
+    """
+    count_mode = 'count_mode'
+    """
+    How the :ref:`count <apiv1_endpoints>` endpoint computes its result.
+    Valid values are enumerated by the :class:`.CountModeValues` class.
+    """
+    format = 'format'
+    """
+    Output format for list-view endpoints. Valid values are enumerated by
+    the :class:`.FormatValues` class.
+    """
+    compression = 'compression'
+    """
+    Compression applied to archives from the :ref:`export <apiv1_endpoints>`
+    endpoint. Valid values are enumerated by the
+    :class:`.CompressionValues` class.
+    """
+
+
+@add_value_list_attribute
+class CountModeValues:
+    """
+    Values that may be used in a querystring with the 'count_mode' key.
+    """
+    exact = 'exact'
+    """
+    Count every matching row (the default). Repeated queries are answered
+    from a cache until new packets are ingested.
+    """
+    estimate = 'estimate'
+    """
+    Return the query-planner's row-estimate. This takes the same (short)
+    time whatever the number of matching packets, but may be out by an
+    order of magnitude for complex filters. The result-dict is marked
+    ``approximate``.
+    """
+    auto = 'auto'
+    """
+    Return an estimate if it exceeds the server's threshold
+    (``COUNT_ESTIMATE_THRESHOLD``), otherwise an exact count.
+    """
+
+
+@add_value_list_attribute
+class FormatValues:
+    """
+    Values that may be used in a querystring with the 'format' key.
+    """
+    json = 'json'
+    """
+    A single JSON :ref:`result-dict <returned-content>` (the default).
+    """
+    ndjson = 'ndjson'
+    """
+    Newline-delimited JSON: one result-row per line, with no enclosing
+    result-dict. Rows are streamed as they are read from the database, so
+    a deployment may permit larger ``limit`` values
+    (``MAX_STREAM_QUERY_LIMIT``).
+    """
+
+
+@add_value_list_attribute
+class CompressionValues:
+    """
+    Values that may be used in a querystring with the 'compression' key.
+    """
+    none = 'none'
+    "Plain tar archive (the default)."
+    gz = 'gz'
+    "Gzip-compressed tar archive."
+    bz2 = 'bz2'
+    "Bzip2-compressed tar archive (smaller, but slower to produce)."
 
 
 class ResultKeys:
@@ -132,6 +223,13 @@ class ResultKeys:
     (Only applies to list-view endpoints.)
     """
 
+    next = 'next'
+    """
+    A cursor value for fetching the next page of results, or null if there
+    are no more. (Only applies to list-view endpoints,
+    cf :class:`.PaginationKeys`.)
+    """
+
     querystring = 'querystring'
     """
     A dictionary displaying the query-string values applied.
@@ -149,5 +247,11 @@ class ResultKeys:
     See :ref:`endpoint listings <apiv1_endpoints>` for detail.
     """
 
+    approximate = 'approximate'
+    """
+    Present (and True) if the result is an estimate rather than an exact
+    value, cf :class:`.CountModeValues`.
+    """
+
     url = 'url'
     "The complete URL the query was made against."
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 from voeventdb.server.restapi.v1.apierror import InvalidQueryString
-from voeventdb.server.restapi.v1.definitions import PaginationKeys
+from voeventdb.server.restapi.v1.definitions import OutputKeys, PaginationKeys
 
 """
 Define the underlying machinery we'll use to implement query filters.
@@ -57,6 +57,14 @@ class QueryFilter(object):
     def filter(self, filter_value):
         return NotImplementedError
 
+    def rollup_filter(self, filter_value):
+        """
+        Equivalent filter-clause on the rollup table, :class:`.VoeventRollup`.
+
+        Returns None if the rollups can't answer this filter (the default).
+        """
+        return None
+
     def generate_filter_set(self, args):
         return self.combinator(
             self.filter(filter_value)
@@ -82,11 +90,36 @@ def apply_filters(query, args):
         if querystring_key in filter_registry:
             cls_inst = filter_registry[querystring_key]
             query = cls_inst.apply_filter(query, args, pre_joins)
-        elif querystring_key in PaginationKeys._value_list:
+        elif (querystring_key in PaginationKeys._value_list or
+              querystring_key in OutputKeys._value_list):
             pass
         else:
             raise InvalidQueryString(querystring_key, filter_value)
     return query
 
 
+def apply_rollup_filters(query, args):
+    """
+    Apply filters to a query on the rollup table, if possible.
+
+    Returns:
+        The filtered query, or None if any of the filters can't be answered
+        from the rollups (in which case, use :func:`apply_filters` on a
+        live query instead).
+    """
+    for querystring_key in args.keys():
+        if (querystring_key in PaginationKeys._value_list or
+                querystring_key in OutputKeys._value_list):
+            continue
+        if querystring_key not in filter_registry:
+            return None
+        cls_inst = filter_registry[querystring_key]
+        clauses = [cls_inst.rollup_filter(filter_value)
+                   for filter_value in args.getlist(querystring_key)]
+        if any(c is None for c in clauses):
+            return None
+        query = query.filter(cls_inst.combinator(clauses))
+    return query
+
+
 
@@ -1,11 +1,14 @@
 from __future__ import absolute_import, unicode_literals
-from voeventdb.server.database.models import Voevent, Cite, Coord
-from voeventdb.server.database.query import coord_cone_search_clause
+from voeventdb.server.database.models import (Voevent, Cite, Coord, Stream,
+                                              VoeventRollup)
+from voeventdb.server.database.query import (coord_cone_search_clause,
+                                             escape_like,
+                                             ivorn_prefix_clause)
 import voeventdb.server.restapi.v1.apierror as apierror
 from voeventdb.server.restapi.v1.filter_base import (
     add_to_filter_registry, QueryFilter)
 import iso8601
-from sqlalchemy import (or_, and_, exists,
+from sqlalchemy import (or_, and_, exists, select,
                         )
 from sqlalchemy.orm import aliased
 import six
@@ -75,7 +78,7 @@ class CitedByAny(QueryFilter):
 
     def filter(self, filter_value):
         cite2 = aliased(Cite)
-        filter_q = exists().where(Voevent.ivorn == cite2.ref_ivorn)
+        filter_q = exists().where(Voevent.id == cite2.ref_voevent_id)
         if filter_value.lower() == 'true':
             return filter_q
         elif filter_value.lower() == 'false':
@@ -196,7 +199,8 @@ class IvornContains(QueryFilter):
                       'XRT']
 
     def filter(self, filter_value):
-        return Voevent.ivorn.like('%{}%'.format(filter_value))
+        # Served by the trigram index, ix_voevent_ivorn_trgm.
+        return Voevent.ivorn.like('%{}%'.format(escape_like(filter_value)))
 
     def combinator(self, filters):
         """AND"""
@@ -222,7 +226,7 @@ class IvornPrefix(QueryFilter):
     ]
 
     def filter(self, filter_value):
-        return Voevent.ivorn.like('{}%'.format(filter_value))
+        return ivorn_prefix_clause(filter_value)
 
     def combinator(self, filters):
         """OR"""
@@ -267,8 +271,9 @@ class RefContains(QueryFilter):
     ]
 
     def filter(self, filter_value):
+        # Served by the trigram index, ix_cite_ref_ivorn_trgm.
         return Voevent.cites.any(
-            Cite.ref_ivorn.like('%{}%'.format(filter_value))
+            Cite.ref_ivorn.like('%{}%'.format(escape_like(filter_value)))
         )
 
     def combinator(self, filters):
@@ -306,12 +311,19 @@ class RoleEquals(QueryFilter):
         'test'
     ]
 
-    def filter(self, filter_value):
+    def _validate(self, filter_value):
         if filter_value not in self.example_values:
             raise apierror.InvalidQueryString(
                 self.querystring_key, filter_value)
+
+    def filter(self, filter_value):
+        self._validate(filter_value)
         return Voevent.role == filter_value
 
+    def rollup_filter(self, filter_value):
+        self._validate(filter_value)
+        return VoeventRollup.role == filter_value
+
     def combinator(self, filters):
         """OR"""
         return or_(filters)
@@ -326,7 +338,13 @@ class StreamEquals(QueryFilter):
     ]
 
     def filter(self, filter_value):
-        return Voevent.stream == filter_value
+        # Look up the stream key once, rather than the name for every row.
+        return Voevent.stream_id == select([Stream.id]).where(
+            Stream.value == filter_value).as_scalar()
+
+    def rollup_filter(self, filter_value):
+        return VoeventRollup.stream_id == select([Stream.id]).where(
+            Stream.value == filter_value).as_scalar()
 
     def combinator(self, filters):
         """OR"""
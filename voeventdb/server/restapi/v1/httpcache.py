@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+
+"""
+HTTP cache validators (ETag / Last-Modified) and Cache-Control headers.
+
+Query results only change when packets are ingested (or deleted), so query
+endpoints use validators derived from the ingest watermark (see
+:func:`.convenience.ingest_watermark`): a client (or reverse proxy) holding
+a current copy gets a '304 Not Modified' at the cost of summing the small
+rollup table, without running the query. The single-packet endpoints use
+validators derived from the stored packet's content-hash, which is a single
+indexed lookup (or a packet-cache hit).
+"""
+import datetime
+import threading
+
+from flask import current_app, g, make_response, request
+
+from voeventdb.server import __versiondict__ as package_version_dict
+from voeventdb.server.restapi.v1 import caching
+
+# Included in every ETag, so that upgrades invalidate cached responses:
+_release = package_version_dict['version']
+
+
+def _utc_seconds(dt):
+    # HTTP-dates have whole-second resolution.
+    if dt.tzinfo is not None:
+        dt = dt.replace(tzinfo=None) - dt.utcoffset()
+    return dt.replace(microsecond=0)
+
+
+class _WatermarkClock(object):
+    """
+    Records when this process first saw each ingest watermark.
+
+    There's no record of when packets were inserted, but the first time we
+    see a new watermark is (slightly) later than the insert - which is all
+    a Last-Modified date needs to be, to be safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watermark = None
+        self._first_seen = None
+
+    def first_seen(self, watermark):
+        with self._lock:
+            if watermark != self._watermark:
+                self._watermark = watermark
+                self._first_seen = datetime.datetime.utcnow()
+            return self._first_seen
+
+
+_clock = _WatermarkClock()
+
+
+def _client_copy_current(etag, last_modified):
+    if request.if_none_match:
+        # If-None-Match takes precedence, cf RFC 7232.
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return (_utc_seconds(last_modified) <=
+                _utc_seconds(request.if_modified_since))
+    return False
+
+
+def conditional_response(etag, build_response, last_modified=None,
+                         cache_control_key='QUERY_CACHE_CONTROL'):
+    """
+    Respond '304 Not Modified' if the client's copy is current.
+
+    Otherwise call ``build_response`` for the full response. Either way, the
+    validators and (if configured) the Cache-Control header are attached.
+
+    Args:
+        etag (str): Entity-tag (unquoted) for the current response.
+        build_response (callable): Returns the full response (or any return
+            value accepted by a Flask view).
+        last_modified (datetime.datetime): Optional Last-Modified date.
+        cache_control_key (str): App-config key for the Cache-Control value.
+    """
+    if _client_copy_current(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(build_response())
+        if g.get('served_stale'):
+            # Predates the current validators, so must not carry them.
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    cache_control = current_app.config.get(cache_control_key)
+    if cache_control:
+        response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def watermark_conditional(session, build_response):
+    """
+    Conditional response for a query endpoint, see :func:`conditional_response`.
+
+    The validators change whenever new packets are ingested.
+    """
+    watermark = caching.request_watermark(session)
+    etag = '{}-{}'.format(_release, watermark)
+    return conditional_response(etag, build_response,
+                                last_modified=_clock.first_seen(watermark))
+
+
+def packet_conditional(session, ivorn, build_response):
+    """
+    Conditional response for a single-packet endpoint.
+
+    See :func:`conditional_response`. The validator is derived from the
+    stored content-hash (``xml_sha256``, see :func:`.caching.packet_digest`),
+    so it changes if a packet is deleted and re-ingested with different
+    content. If the packet isn't in the database, we never respond '304',
+    but always build the full (i.e. not-found) response.
+    """
+    digest = caching.packet_digest(session, ivorn)
+    if digest is None:
+        return build_response()
+    etag = '{}-{}'.format(_release, digest)
+    return conditional_response(etag, build_response,
+                                cache_control_key='PACKET_CACHE_CONTROL')
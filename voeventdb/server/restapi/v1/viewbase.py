@@ -3,15 +3,26 @@ from __future__ import absolute_import
 """
 Base classes used for generating views
 """
+import base64
+import binascii
+import datetime
+
+import iso8601
 from flask.views import View
 from flask import (
-    jsonify, request, current_app
+    Response, json, jsonify, request, current_app, stream_with_context
 )
 
+from voeventdb.server.database import query
+from voeventdb.server.database import session_registry as db_session
 from voeventdb.server.database.models import Voevent
-from voeventdb.server.restapi.v1.filter_base import apply_filters
+from voeventdb.server.restapi.v1 import caching, httpcache
+from voeventdb.server.restapi.v1.filter_base import (
+    apply_filters, apply_rollup_filters)
 from voeventdb.server.restapi.v1.definitions import (
+    FormatValues,
     OrderValues,
+    OutputKeys,
     order_by_string_to_col_map,
     PaginationKeys,
     ResultKeys,
@@ -38,53 +49,146 @@ class QueryView(View):
     def get_query(self):
         raise NotImplementedError
 
+    def get_rollup_query(self):
+        """
+        Optionally, an equivalent query on the rollup table.
+
+        If provided, this is used whenever the rollups can answer all the
+        querystring filters - see :func:`.apply_rollup_filters`.
+        """
+        return None
+
     def process_query(self, q):
         raise NotImplementedError
 
+    def process_rollup_query(self, q):
+        """
+        By default, rollup queries return the same columns as the live query.
+        """
+        return self.process_query(q)
+
     def dispatch_request(self):
+        return httpcache.watermark_conditional(db_session, self.build_response)
+
+    def build_response(self):
+        """
+        Build the response (if not cached by the client).
+        """
+        return jsonify(make_response_dict(self.cached_result()))
+
+    def cached_result(self):
+        """
+        Return the result of :meth:`compute_result`, via the result cache.
+        """
+        cache_key = caching.querystring_cache_key(
+            self.view_name, request.args,
+            ignore_keys=PaginationKeys._value_list)
+        return caching.cached_query_result(
+            caching.result_cache(), cache_key,
+            caching.request_watermark(db_session), self.compute_result)
+
+    def compute_result(self):
+        """
+        Run the query.
+        """
+        q = self.get_rollup_query()
+        if q is not None:
+            q = apply_rollup_filters(q, request.args)
+        if q is not None:
+            return self.process_rollup_query(q)
         q = self.get_query()
         q = apply_filters(q, request.args)
-        result = self.process_query(q)
-        return jsonify(make_response_dict(result))
+        return self.process_query(q)
+
+
+def _encode_cursor(order_stringval, last_value, last_id):
+    if isinstance(last_value, datetime.datetime):
+        last_value = last_value.isoformat()
+    payload = json.dumps([order_stringval, last_value, last_id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor, order_stringval, ordering_col):
+    """
+    Returns:
+        tuple: ``(last_value, last_id)``
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        cursor_order, last_value, last_id = json.loads(
+            payload.decode('utf-8'))
+        if ordering_col is Voevent.author_datetime and last_value is not None:
+            last_value = iso8601.parse_date(last_value)
+        last_id = int(last_id)
+    except (ValueError, TypeError, UnicodeError, binascii.Error,
+            iso8601.ParseError):
+        raise InvalidQueryString(
+                querystring_key=PaginationKeys.cursor,
+                querystring_value=cursor,
+                reason="Not a valid cursor - please use the '{}' value "
+                       "from a previous result.".format(ResultKeys.next))
+    if cursor_order != order_stringval:
+        raise InvalidQueryString(
+                querystring_key=PaginationKeys.cursor,
+                querystring_value=cursor,
+                reason="Cursor was issued for a different ordering.")
+    return last_value, last_id
 
 
 class ListQueryView(View):
     def get_query(self):
         raise NotImplementedError
 
-    def process_query(self, query):
+    def process_row(self, row):
         """
         By default, simply return all columns.
         """
-        return query.all()
+        return tuple(row)
 
-    def set_ordering(self, query):
-        q = query
-        order_stringval = request.args.get(PaginationKeys.order, None)
-        ordering_func = asc
-        if order_stringval:
-            if order_stringval not in OrderValues._value_list:
-                raise InvalidQueryString(
-                        querystring_key=PaginationKeys.order,
-                        querystring_value=order_stringval,
-                        reason="Not a valid ordering, try one of {}.".format(
-                                OrderValues._value_list))
+    def get_ordering(self):
+        """
+        Parse the ordering requested in the querystring.
 
-            if order_stringval.startswith('-'):
-                ordering_func = desc
-                order_stringval = order_stringval[1:]
+        Returns:
+            tuple: ``(order_stringval, ordering_col, descending)``
+        """
+        order_stringval = request.args.get(PaginationKeys.order, None)
+        if order_stringval and order_stringval not in OrderValues._value_list:
+            raise InvalidQueryString(
+                    querystring_key=PaginationKeys.order,
+                    querystring_value=order_stringval,
+                    reason="Not a valid ordering, try one of {}.".format(
+                            list(OrderValues._value_list)))
+        descending = bool(order_stringval) and order_stringval.startswith('-')
+        col_key = order_stringval[1:] if descending else order_stringval
+        return (order_stringval, order_by_string_to_col_map[col_key],
+                descending)
 
-        ordering_col = order_by_string_to_col_map[order_stringval]
+    def set_ordering(self, query):
+        q = query
+        _, ordering_col, descending = self.get_ordering()
+        ordering_func = desc if descending else asc
         q = q.order_by(ordering_func(ordering_col))
 
-        # Usually append id ordering as a tie-breaker, ensures consistency:
-        if ordering_col != Voevent.id:
-            q = q.order_by(Voevent.id)
+        # Usually append id ordering as a tie-breaker, ensures consistency.
+        # (Same direction, so a composite index can be scanned either way.)
+        if ordering_col is not Voevent.id:
+            q = q.order_by(ordering_func(Voevent.id))
         return q
 
-    def dispatch_request(self):
+    def get_output_format(self):
+        format_stringval = request.args.get(OutputKeys.format,
+                                            FormatValues.json)
+        if format_stringval not in FormatValues._value_list:
+            raise InvalidQueryString(
+                    querystring_key=OutputKeys.format,
+                    querystring_value=format_stringval,
+                    reason="Not a valid format, try one of {}.".format(
+                            list(FormatValues._value_list)))
+        return format_stringval
+
+    def get_limit(self, max_limit):
         limit_str = request.args.get(PaginationKeys.limit, None)
-        max_limit = current_app.config['MAX_QUERY_LIMIT']
         if not limit_str:
             limit = current_app.config['DEFAULT_QUERY_LIMIT']
         else:
@@ -97,19 +201,82 @@ class ListQueryView(View):
                         reason="Please supply an integer-valued row-limit.")
         if limit > max_limit:
             raise LimitMaxExceeded(limit, max_limit)
+        return limit
+
+    def dispatch_request(self):
+        return httpcache.watermark_conditional(db_session, self.build_response)
+
+    def build_response(self):
+        output_format = self.get_output_format()
+        if output_format == FormatValues.ndjson:
+            limit = self.get_limit(
+                current_app.config['MAX_STREAM_QUERY_LIMIT'])
+        else:
+            limit = self.get_limit(current_app.config['MAX_QUERY_LIMIT'])
+
+        order_stringval, ordering_col, descending = self.get_ordering()
+        cursor = request.args.get(PaginationKeys.cursor, None)
+        offset = request.args.get(PaginationKeys.offset, None)
+        if cursor and offset:
+            raise InvalidQueryString(
+                    querystring_key=PaginationKeys.offset,
+                    querystring_value=offset,
+                    reason="Cannot combine '{}' with '{}'.".format(
+                            PaginationKeys.offset, PaginationKeys.cursor))
 
         q = self.get_query()
         q = apply_filters(q, request.args)
+        # Fetch the ordering keys along with each row, to build the cursor.
+        n_cols = len(q.column_descriptions)
+        q = q.add_columns(ordering_col, Voevent.id)
+        if cursor:
+            last_value, last_id = _decode_cursor(cursor, order_stringval,
+                                                 ordering_col)
+            q = q.filter(query.keyset_after_clause(
+                ordering_col, last_value, last_id, descending))
         q = self.set_ordering(q)
         q = q.limit(limit)
-        q = q.offset(request.args.get(PaginationKeys.offset))
-        result = self.process_query(q)
+        q = q.offset(offset)
+
+        if output_format == FormatValues.ndjson:
+            return self.stream_ndjson(q, n_cols)
+
+        rows = q.all()
+        result = [self.process_row(row[:n_cols]) for row in rows]
         resultdict = make_response_dict(result)
         # Also return the query limit-value for ListView
         # This is useful if no limit specified in query, so default applies.
         resultdict[ResultKeys.limit] = limit
+        next_cursor = None
+        if len(rows) == limit and rows:
+            next_cursor = _encode_cursor(order_stringval, *rows[-1][n_cols:])
+        resultdict[ResultKeys.next] = next_cursor
         return jsonify(resultdict)
 
+    def stream_ndjson(self, q, n_cols):
+        """
+        Stream results one row per line, via a server-side cursor.
+
+        Memory use is bounded by the batch size, whatever the row limit.
+        """
+        batch_size = current_app.config['STREAM_BATCH_SIZE']
+        q = q.execution_options(stream_results=True).yield_per(batch_size)
+
+        def generate():
+            lines = []
+            for row in q:
+                lines.append(json.dumps(self.process_row(row[:n_cols])))
+                if len(lines) == batch_size:
+                    lines.append('')
+                    yield '\n'.join(lines)
+                    lines = []
+            if lines:
+                lines.append('')
+                yield '\n'.join(lines)
+
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+
 
 def _add_to_blueprint(queryview_class, blueprint):
     name = queryview_class.view_name
@@ -1,19 +1,29 @@
 from __future__ import absolute_import
+import functools
+
 from flask import (
-    Blueprint, request, make_response, render_template, current_app,
-    jsonify, url_for
+    Blueprint, Response, request, make_response, render_template,
+    current_app, json, jsonify, stream_with_context, url_for
 )
 
 from voeventdb.server import __versiondict__ as package_version_dict
 from voeventdb.server.restapi.annotate import lookup_relevant_urls
 from voeventdb.server.database import session_registry as db_session
-from voeventdb.server.database.models import Voevent, Cite, Coord
+from voeventdb.server.database.models import (Voevent, Cite, Coord,
+                                              VoeventRollup)
 import voeventdb.server.database.convenience as convenience
 import voeventdb.server.restapi.v1.apierror as apierror
 import voeventdb.server.database.query as query
 from voeventdb.server.restapi.v1.viewbase import (
     QueryView, ListQueryView, _add_to_blueprint, make_response_dict
 )
+from voeventdb.server.restapi.v1 import caching, httpcache
+from voeventdb.server.restapi.v1.definitions import (
+    CompressionValues, CountModeValues, OutputKeys, ResultKeys)
+from voeventdb.server.restapi.v1.filter_base import (
+    apply_filters, apply_rollup_filters)
+from voeventdb.server.utils import filestore
+from sqlalchemy import func
 import six
 if six.PY3:
     from urllib.parse import unquote
@@ -27,6 +37,13 @@ import voeventdb.server.restapi.v1.filters
 apiv1 = Blueprint('apiv1', __name__,
                   url_prefix='/apiv1')
 
+# Tarfile stream-mode suffix, mimetype and filename for each compression:
+_export_formats = {
+    CompressionValues.none: ('', 'application/x-tar', 'voevents.tar'),
+    CompressionValues.gz: ('gz', 'application/gzip', 'voevents.tar.gz'),
+    CompressionValues.bz2: ('bz2', 'application/x-bzip2', 'voevents.tar.bz2'),
+}
+
 
 # First define a few helper functions...
 
@@ -60,7 +77,7 @@ def error_to_dict(error):
     }
 
 
-def validate_ivorn(url_encoded_ivorn):
+def decode_ivorn(url_encoded_ivorn):
     if url_encoded_ivorn and current_app.config.get('APACHE_NODECODE'):
         ivorn = unquote(url_encoded_ivorn)
     else:
@@ -68,13 +85,15 @@ def validate_ivorn(url_encoded_ivorn):
     if ivorn is None:
         raise apierror.IvornNotSupplied(
             suggested_ivorn_url=url_for(apiv1.name + '.' + ListIvorn.view_name))
-    if not convenience.ivorn_present(db_session, ivorn):
-        raise apierror.IvornNotFound(
-            ivorn,
-            suggested_ivorn_url=url_for(apiv1.name + '.' + ListIvorn.view_name))
     return ivorn
 
 
+def ivorn_not_found(ivorn):
+    return apierror.IvornNotFound(
+        ivorn,
+        suggested_ivorn_url=url_for(apiv1.name + '.' + ListIvorn.view_name))
+
+
 # Now root url, error handlers:
 
 
@@ -94,7 +113,8 @@ def apiv1_root_view():
         'git_sha': package_version_dict['full-revisionid'][:8],
         'version_tag': package_version_dict['version'],
         'endpoints': [str(r) for r in get_apiv1_rules()],
-        'docs_url': docs_url
+        'docs_url': docs_url,
+        'packet_cache': caching.packet_cache().stats(),
     }
 
     if 'text/html' in request.headers.get("Accept", ""):
@@ -105,6 +125,8 @@ def apiv1_root_view():
         return jsonify(api_details)
 
 @apiv1.errorhandler(apierror.LimitMaxExceeded)
+@apiv1.errorhandler(apierror.BatchSizeExceeded)
+@apiv1.errorhandler(apierror.InvalidRequestBody)
 @apiv1.errorhandler(apierror.InvalidQueryString)
 @apiv1.errorhandler(apierror.IvornNotFound)
 @apiv1.errorhandler(apierror.IvornNotSupplied)
@@ -145,15 +167,58 @@ class Count(QueryView):
         Number of packets matching querystring.
 
     Returns total number of packets in database if the querystring is blank.
+
+    By default the count is exact; pass ``count_mode=estimate`` (or
+    ``count_mode=auto``) for a fast approximate count on large result-sets,
+    see :class:`.CountModeValues`. Approximate results are flagged with
+    the ``approximate`` key in the result-dict.
     """
     view_name = 'count'
 
     def get_query(self):
         return db_session.query(Voevent)
 
+    def get_rollup_query(self):
+        return db_session.query(func.sum(VoeventRollup.n_packets))
+
     def process_query(self, q):
         return q.count()
 
+    def process_rollup_query(self, q):
+        return q.scalar() or 0
+
+    def build_response(self):
+        result, approximate = self.cached_result()
+        resultdict = make_response_dict(result)
+        if approximate:
+            resultdict[ResultKeys.approximate] = True
+        return jsonify(resultdict)
+
+    def compute_result(self):
+        """
+        Returns:
+            tuple: ``(count, approximate)``
+        """
+        count_mode = request.args.get(OutputKeys.count_mode,
+                                      CountModeValues.exact)
+        if count_mode not in CountModeValues._value_list:
+            raise apierror.InvalidQueryString(
+                querystring_key=OutputKeys.count_mode,
+                querystring_value=count_mode,
+                reason="Not a valid count mode, try one of {}.".format(
+                    list(CountModeValues._value_list)))
+        q = apply_rollup_filters(self.get_rollup_query(), request.args)
+        if q is not None:
+            # Exact, and cheap regardless of count_mode.
+            return self.process_rollup_query(q), False
+        q = apply_filters(self.get_query(), request.args)
+        if count_mode != CountModeValues.exact:
+            estimate = convenience.estimate_row_count(q)
+            if (count_mode == CountModeValues.estimate or estimate >=
+                    current_app.config['COUNT_ESTIMATE_THRESHOLD']):
+                return estimate, True
+        return self.process_query(q), False
+
 
 @add_to_apiv1
 class ListIvorn(ListQueryView):
@@ -169,15 +234,11 @@ class ListIvorn(ListQueryView):
     def get_query(self):
         return db_session.query(Voevent.ivorn)
 
-    def process_query(self, query):
+    def process_row(self, row):
         """
-        Grab the first entry from every tuple as a single list.
+        Return the bare IVORN, rather than a 1-element list.
         """
-        raw_results = query.all()
-        if len(raw_results):
-            return list(zip(*raw_results))[0]
-        else:
-            return raw_results
+        return row[0]
 
 
 @add_to_apiv1
@@ -196,9 +257,6 @@ class ListIvornReferenceCount(ListQueryView):
     def get_query(self):
         return query.ivorn_cites_to_others_count_q(db_session)
 
-    def process_query(self, query):
-        return [tuple(r) for r in query.all()]
-
 
 @add_to_apiv1
 class ListIvornCitedCount(ListQueryView):
@@ -216,9 +274,6 @@ class ListIvornCitedCount(ListQueryView):
     def get_query(self):
         return query.ivorn_cited_from_others_count_q(db_session)
 
-    def process_query(self, query):
-        return [tuple(r) for r in query.all()]
-
 
 @add_to_apiv1
 class MapAuthoredMonthCount(QueryView):
@@ -236,6 +291,9 @@ class MapAuthoredMonthCount(QueryView):
     def get_query(self):
         return query.authored_month_counts_q(db_session)
 
+    def get_rollup_query(self):
+        return query.authored_month_counts_rollup_q(db_session)
+
     def process_query(self, q):
         raw_results = q.all()
         converted_results = []
@@ -259,6 +317,9 @@ class MapRoleCount(QueryView):
     def get_query(self):
         return query.role_counts_q(db_session)
 
+    def get_rollup_query(self):
+        return query.role_counts_rollup_q(db_session)
+
     def process_query(self, q):
         return dict(q.all())
 
@@ -274,6 +335,9 @@ class MapStreamCount(QueryView):
     def get_query(self):
         return query.stream_counts_q(db_session)
 
+    def get_rollup_query(self):
+        return query.stream_counts_rollup_q(db_session)
+
     def process_query(self, q):
         return dict(q.all())
 
@@ -289,10 +353,56 @@ class MapStreamRoleCount(QueryView):
     def get_query(self):
         return query.stream_counts_role_breakdown_q(db_session)
 
+    def get_rollup_query(self):
+        return query.stream_counts_role_breakdown_rollup_q(db_session)
+
     def process_query(self, q):
         return convenience.to_nested_dict(q.all())
 
 
+@apiv1.route('/export/tar')
+def export_tar():
+    """
+    Result:
+        A tar archive of the matching XML packets (rather than a JSON dict).
+
+    Returns every packet matching the querystring, in database-id order,
+    named as in the voeventdb tarball dumps (i.e. by IVORN - e.g.
+    ``ivo://nasa.gsfc.gcn/SWIFT#BAT_GRB_Pos_657286-112`` is stored as
+    ``nasa.gsfc.gcn/SWIFT/BAT_GRB_Pos_657286-112.xml``).
+    Accepts the same query-filters as the other query endpoints, plus an
+    optional ``compression`` value (see :class:`.CompressionValues`).
+    Pagination keys are ignored.
+
+    The archive is streamed as it is read from the database, so exports of
+    any size are possible - but please filter down to what you need!
+    """
+    compression = request.args.get(OutputKeys.compression,
+                                   CompressionValues.none)
+    if compression not in CompressionValues._value_list:
+        raise apierror.InvalidQueryString(
+            querystring_key=OutputKeys.compression,
+            querystring_value=compression,
+            reason="Not a valid compression, try one of {}.".format(
+                list(CompressionValues._value_list)))
+    return httpcache.watermark_conditional(
+        db_session, functools.partial(_export_tar_response, compression))
+
+
+def _export_tar_response(compression):
+    tar_compression, mimetype, filename = _export_formats[compression]
+    q = db_session.query(Voevent.ivorn, Voevent.xml)
+    q = apply_filters(q, request.args)
+    q = q.order_by(Voevent.id)
+    q = q.execution_options(stream_results=True).yield_per(
+        current_app.config['STREAM_BATCH_SIZE'])
+    tar_stream = filestore.stream_tarball_from_ivorn_xml_tuples(
+        q, compression=tar_compression)
+    r = Response(stream_with_context(tar_stream), mimetype=mimetype)
+    r.headers['Content-Disposition'] = 'attachment; filename=' + filename
+    return r
+
+
 @apiv1.route('/packet/synopsis/')
 @apiv1.route('/packet/synopsis/<path:url_encoded_ivorn>')
 def packet_synopsis(url_encoded_ivorn=None):
@@ -338,20 +448,42 @@ def packet_synopsis(url_encoded_ivorn=None):
     in :ref:`URL-encoded <url-encoding>` form.
 
     """
-    ivorn = validate_ivorn(url_encoded_ivorn)
+    ivorn = decode_ivorn(url_encoded_ivorn)
+    return httpcache.packet_conditional(
+        db_session, ivorn, functools.partial(_packet_synopsis_response, ivorn))
 
-    voevent_row = db_session.query(Voevent).filter(
-        Voevent.ivorn == ivorn).one()
 
-    cites = db_session.query(Cite). \
-        filter(Cite.voevent_id == voevent_row.id).all()
-    coords = db_session.query(Coord). \
-        filter(Coord.voevent_id == voevent_row.id).all()
+def _packet_synopsis_response(ivorn):
+    cache = caching.packet_cache()
+    _, cache_key, _ = caching.packet_cache_keys(ivorn)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        result = json.loads(cached.decode('utf-8'))
+    else:
+        result = _packet_synopsis(ivorn)
+        cache.put(cache_key, json.dumps(result).encode('utf-8'))
+    return jsonify(make_response_dict(result))
+
 
-    v_dict = voevent_row.to_odict(exclude=('id', 'xml'))
+def _packet_synopsis(ivorn):
+    voevent_row = query.packet_synopsis_q(db_session).filter(
+        Voevent.ivorn == ivorn).first()
+    if voevent_row is None:
+        raise ivorn_not_found(ivorn)
+    return _synopsis_from_row(voevent_row)
 
-    cite_list = [c.to_odict(exclude=('id', 'voevent_id')) for c in cites]
-    coord_list = [c.to_odict(exclude=('id', 'voevent_id')) for c in coords]
+
+def _synopsis_from_row(voevent_row):
+    """
+    Build a synopsis dict from a row loaded via :func:`.packet_synopsis_q`.
+    """
+    cites = voevent_row.cites
+    v_dict = voevent_row.to_odict(exclude=('id', 'xml', 'xml_sha256'))
+
+    cite_list = [c.to_odict(exclude=('id', 'voevent_id', 'ref_voevent_id'))
+                 for c in cites]
+    coord_list = [c.to_odict(exclude=('id', 'voevent_id'))
+                  for c in voevent_row.coords]
 
     relevant_urls = lookup_relevant_urls(voevent_row, cites)
 
@@ -360,7 +492,53 @@ def packet_synopsis(url_encoded_ivorn=None):
               'coords': coord_list,
               'relevant_urls': relevant_urls,
               }
+    return result
+
 
+@apiv1.route('/packet/synopses', methods=['POST'])
+def packet_synopses():
+    """
+    Result:
+        Dict mapping each requested IVORN to its synopsis
+        (as for ``/packet/synopsis/``), or to null if not in the database.
+
+    Fetch synopses for many packets at once. POST a JSON-encoded dict,
+    listing the IVORNs (not URL-encoded)::
+
+        {"ivorns": ["ivo://nasa.gsfc.gcn/SWIFT#BAT_GRB_Pos_657286-112",
+                    ...]}
+
+    The number of IVORNs per request is limited (by default, to 100).
+    """
+    body = request.get_json(force=True, silent=True)
+    ivorns = body.get('ivorns') if isinstance(body, dict) else None
+    if (not isinstance(ivorns, list) or
+            not all(isinstance(i, six.string_types) for i in ivorns)):
+        raise apierror.InvalidRequestBody(
+            reason="expected a JSON dict, with 'ivorns' listing IVORN "
+                   "strings.")
+    max_batch = current_app.config['MAX_SYNOPSIS_BATCH']
+    if len(ivorns) > max_batch:
+        raise apierror.BatchSizeExceeded(len(ivorns), max_batch)
+
+    cache = caching.packet_cache()
+    result = {}
+    for ivorn in ivorns:
+        _, cache_key, _ = caching.packet_cache_keys(ivorn)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            result[ivorn] = json.loads(cached.decode('utf-8'))
+    missing = [i for i in ivorns if i not in result]
+    if missing:
+        rows = query.packet_synopsis_q(db_session).filter(
+            Voevent.ivorn.in_(missing)).all()
+        for voevent_row in rows:
+            synopsis = _synopsis_from_row(voevent_row)
+            _, cache_key, _ = caching.packet_cache_keys(voevent_row.ivorn)
+            cache.put(cache_key, json.dumps(synopsis).encode('utf-8'))
+            result[voevent_row.ivorn] = synopsis
+    for ivorn in missing:
+        result.setdefault(ivorn, None)
     return jsonify(make_response_dict(result))
 
 
@@ -381,10 +559,23 @@ def packet_xml(url_encoded_ivorn=None):
     # However, the werkzeug simple-server decodes these by default,
     # resulting in differing dev / production behaviour, which we handle here.
 
-    ivorn = validate_ivorn(url_encoded_ivorn)
-    xml = db_session.query(Voevent.xml).filter(
-        Voevent.ivorn == ivorn
-    ).scalar()
+    ivorn = decode_ivorn(url_encoded_ivorn)
+    return httpcache.packet_conditional(
+        db_session, ivorn, functools.partial(_packet_xml_response, ivorn))
+
+
+def _packet_xml_response(ivorn):
+    cache = caching.packet_cache()
+    cache_key, _, _ = caching.packet_cache_keys(ivorn)
+    xml = cache.get(cache_key)
+    if xml is None:
+        row = db_session.query(Voevent.xml).filter(
+            Voevent.ivorn == ivorn
+        ).first()
+        if row is None:
+            raise ivorn_not_found(ivorn)
+        xml = row.xml
+        cache.put(cache_key, xml)
     r = make_response(xml)
     r.mimetype = 'text/xml'
     return r
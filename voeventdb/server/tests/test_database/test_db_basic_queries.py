@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 import iso8601
 from voeventdb.server.database.models import Voevent
+from voeventdb.server.database.query import escape_like, keyset_batches
 import pytest
 
 
@@ -76,3 +77,34 @@ class TestBasicInsertsAndQueries:
             Voevent.author_datetime <= threshold_timestamp
         ).count()
         assert pkts_before_or_same_calc == pkts_before_or_same_db
+
+
+def test_keyset_batches(fixture_db_session, simple_populated_db):
+    s = fixture_db_session
+    dbinf = simple_populated_db
+    batches = list(keyset_batches(s.query(Voevent), batch_size=3))
+    assert all(len(b) <= 3 for b in batches)
+    assert [v.ivorn for b in batches for v in b] == dbinf.inserted_ivorns
+
+    batches = list(keyset_batches(s.query(Voevent.ivorn,
+                                          Voevent.author_datetime),
+                                  batch_size=4, by_author_datetime=True))
+    rows = [row for b in batches for row in b]
+    n_dated = s.query(Voevent).filter(
+        Voevent.author_datetime != None).count()
+    assert len(rows) == n_dated
+    assert [r.author_datetime for r in rows] == sorted(
+        r.author_datetime for r in rows)
+
+
+def test_escape_like(fixture_db_session, simple_populated_db):
+    s = fixture_db_session
+    # '_' is a wildcard unless escaped:
+    pattern = '%voevent_organization%'
+    assert s.query(Voevent).filter(Voevent.ivorn.like(pattern)).count() > 0
+    assert s.query(Voevent).filter(Voevent.ivorn.like(
+        '%{}%'.format(escape_like('voevent_organization')))).count() == 0
+    n_matches = s.query(Voevent).filter(
+        Voevent.ivorn.like('%voevent.organization%')).count()
+    assert n_matches == s.query(Voevent).filter(Voevent.ivorn.like(
+        '%{}%'.format(escape_like('voevent.organization')))).count()
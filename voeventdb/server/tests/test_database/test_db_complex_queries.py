@@ -7,6 +7,8 @@ from voeventdb.server.database.convenience import (
 )
 import voeventdb.server.database.convenience as convenience
 import voeventdb.server.database.query as query
+from voeventdb.server.database import migrations
+from voeventdb.server.database.models import Voevent
 
 import copy
 
@@ -68,6 +70,32 @@ class TestConvenienceFuncs:
 
 
 
+class TestRollups:
+    query_pairs = [
+        (query.authored_month_counts_q, query.authored_month_counts_rollup_q),
+        (query.role_counts_q, query.role_counts_rollup_q),
+        (query.stream_counts_q, query.stream_counts_rollup_q),
+        (query.stream_counts_role_breakdown_q,
+         query.stream_counts_role_breakdown_rollup_q),
+    ]
+
+    def check_rollups(self, session):
+        for live_q, rollup_q in self.query_pairs:
+            assert (sorted(tuple(r) for r in live_q(session).all()) ==
+                    sorted(tuple(r) for r in rollup_q(session).all()))
+
+    def test_rollups_match_live(self, fixture_db_session,
+                                simple_populated_db):
+        s = fixture_db_session
+        self.check_rollups(s)
+        # Deletes are subtracted:
+        s.delete(s.query(Voevent).first())
+        s.flush()
+        self.check_rollups(s)
+        assert migrations.rebuild_rollups(s) > 0
+        self.check_rollups(s)
+
+
 class TestCitationQueries:
     def test_ref_counts(self, fixture_db_session, simple_populated_db):
         s = fixture_db_session
@@ -3,9 +3,11 @@ from __future__ import absolute_import
 import pytest
 import voeventdb.server.tests.fixtures.fake as fake
 import voeventparse as vp
-from sqlalchemy import func
+from sqlalchemy import event, func
 from sqlalchemy.exc import IntegrityError
-from voeventdb.server.database.models import Voevent, Cite, Coord
+from voeventdb.server.database import convenience
+from voeventdb.server.database.models import (Voevent, Cite, Coord, Stream,
+                                              CiteDescription)
 from voeventdb.server.database.query import coord_cone_search_clause
 from voeventdb.server.tests.resources import (
     gaia_16bsg,
@@ -56,6 +58,21 @@ class TestBasicInsert:
             s.flush()
 
 
+def test_ingest_watermark(fixture_db_session):
+    s = fixture_db_session
+    assert convenience.ingest_watermark(s) == 0
+    s.add(Voevent.from_etree(swift_bat_grb_655721))
+    s.add(Voevent.from_etree(swift_xrt_grb_655721))
+    s.flush()
+    inserted = convenience.ingest_watermark(s)
+    assert inserted != 0
+    # Changes on deletion too, even of a packet below the max id:
+    s.delete(s.query(Voevent).filter(
+        Voevent.ivorn == swift_bat_grb_655721.attrib['ivorn']).one())
+    s.flush()
+    assert convenience.ingest_watermark(s) not in (0, inserted)
+
+
 def test_cite_load_from_etree(fixture_db_session):
     assert len(Cite.from_etree(swift_bat_grb_655721)) == 0
     assert len(Cite.from_etree(swift_xrt_grb_655721)) == 1
@@ -118,6 +135,97 @@ class TestCiteInserts:
         assert backref_voevent.ivorn == swift_xrt_grb_655721.attrib['ivorn']
 
 
+def test_cite_resolution(fixture_db_session):
+    """
+    Cites are resolved on insert, including when the cited packet arrives
+    after the citing packet.
+    """
+    s = fixture_db_session
+    s.add(Voevent.from_etree(swift_xrt_grb_655721))
+    s.flush()
+    cite = s.query(Cite).one()
+    assert cite.ref_voevent_id is None
+    s.add(Voevent.from_etree(swift_bat_grb_655721))
+    s.flush()
+    s.expire_all()
+    bat_voevent_id = s.query(Voevent.id).filter(
+        Voevent.ivorn == swift_bat_grb_655721.attrib['ivorn']).scalar()
+    assert s.query(Cite).one().ref_voevent_id == bat_voevent_id
+
+
+def test_interned_values(fixture_db_session):
+    """
+    Stream names / cite descriptions are stored once, in dimension-tables.
+    """
+    s = fixture_db_session
+    packets = fake.heartbeat_packets(n_packets=5)
+    s.add_all(Voevent.from_etree(p) for p in packets)
+    s.add(Voevent.from_etree(swift_xrt_grb_655721))
+    s.flush()
+    s.expire_all()
+    heartbeat_stream = packets[0].attrib['ivorn'].split('#')[0][6:]
+    assert s.query(Stream).count() == 2
+    assert s.query(Voevent).filter(
+        Voevent.stream == heartbeat_stream).count() == len(packets)
+    row = s.query(Voevent).filter(
+        Voevent.ivorn == swift_xrt_grb_655721.attrib['ivorn']).one()
+    assert row.stream == 'nasa.gsfc.gcn/SWIFT'
+    assert row.to_odict()['stream'] == row.stream
+    cite = row.cites[0]
+    assert cite.description == s.query(CiteDescription.value).scalar()
+    assert 'description_id' not in cite.to_odict()
+    # Updates are interned too:
+    row.stream = 'voeventdb.test/updated'
+    s.flush()
+    s.expire_all()
+    assert s.query(Voevent.stream).filter(
+        Voevent.id == row.id).scalar() == 'voeventdb.test/updated'
+    # Once interned, a later direct assignment of the key sticks:
+    row.stream = 'voeventdb.test/interned'
+    s.flush()
+    assert row.stream == 'voeventdb.test/interned'
+    heartbeat_stream_id = s.query(Stream.id).filter(
+        Stream.value == heartbeat_stream).scalar()
+    row.stream_id = heartbeat_stream_id
+    s.flush()
+    s.expire_all()
+    assert row.stream_id == heartbeat_stream_id
+    assert row.stream == heartbeat_stream
+
+
+def test_interned_values_eager_loaded(fixture_db_session):
+    """
+    Reading interned values from loaded rows doesn't cost a query per row.
+    """
+    s = fixture_db_session
+    s.add_all(Voevent.from_etree(p)
+              for p in fake.heartbeat_packets(n_packets=5))
+    s.add(Voevent.from_etree(swift_xrt_grb_655721))
+    s.flush()
+    s.expire_all()
+    rows = s.query(Voevent).all()
+    cites = s.query(Cite).all()
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = s.connection().engine
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        streams = [row.stream for row in rows]
+        descriptions = [cite.description for cite in cites]
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+    assert statements == []
+    assert 'nasa.gsfc.gcn/SWIFT' in streams
+    assert descriptions[0] is not None
+    # Filters test the key column, rather than correlating per row:
+    assert s.query(Voevent).filter(
+        Voevent.stream.in_(['nasa.gsfc.gcn/SWIFT'])).count() == 1
+    assert s.query(Voevent).filter(Voevent.stream != None).count() == 6
+
+
 class TestUtcTimescaleCoordInserts:
     """
     Check that coords get inserted correctly
@@ -0,0 +1,298 @@
+from __future__ import absolute_import
+import os
+import tempfile
+
+import pytest
+import six
+import voeventparse as vp
+import voeventdb.server.tests.fixtures.fake as fake
+import voeventdb.server.utils.filestore as filestore
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from voeventdb.server.database import bulk, convenience, db_utils, ingest
+from voeventdb.server.database.config import (default_admin_db_url,
+                                              testdb_temp_url)
+from voeventdb.server.database.models import Voevent, Cite, Coord, xml_digest
+from voeventdb.server.tests.resources import (
+    datapaths,
+    swift_bat_grb_655721,
+    swift_xrt_grb_655721,
+)
+
+
+@pytest.fixture
+def packet_tarball():
+    """
+    Write a tarball containing heartbeat packets plus a cite/coord example.
+    """
+    etrees = fake.heartbeat_packets(n_packets=10)
+    etrees.extend([swift_bat_grb_655721, swift_xrt_grb_655721])
+    temp_file = tempfile.NamedTemporaryFile(suffix='.tar.bz2', delete=False)
+    temp_file.close()
+    filestore.write_tarball((Voevent.from_etree(v) for v in etrees),
+                            temp_file.name)
+    yield temp_file.name, etrees
+    os.unlink(temp_file.name)
+
+
+@pytest.fixture
+def original_packet_tarball():
+    """
+    Write a tarball of packets exactly as received, i.e. not re-serialized.
+    """
+    raw_packets = []
+    for path in (datapaths.assasn_non_ascii_packet_filepath,
+                 datapaths.konus_lc_filepath,
+                 datapaths.swift_bat_grb_pos_v2_filepath):
+        with open(path, 'rb') as f:
+            raw_packets.append(f.read())
+    temp_file = tempfile.NamedTemporaryFile(suffix='.tar.bz2', delete=False)
+    temp_file.close()
+    filestore.write_tarball_from_ivorn_xml_tuples(
+        ((vp.loads(xml).attrib['ivorn'], xml) for xml in raw_packets),
+        temp_file.name)
+    yield temp_file.name, raw_packets
+    os.unlink(temp_file.name)
+
+
+def test_copy_text_escaping():
+    assert bulk._format_text(u'foo\tbar\nbaz\\') == b'foo\\tbar\\nbaz\\\\'
+    assert bulk._format_bytea(b'<x/>') == b'\\\\x3c782f3e'
+
+
+def test_packet_rows_match_orm(fixture_db_session):
+    rows = bulk.packet_rows_from_etree(swift_xrt_grb_655721)
+    orm_row = Voevent.from_etree(swift_xrt_grb_655721)
+    assert rows.voevent[bulk.voevent_columns.index('ivorn')] == orm_row.ivorn
+    assert rows.voevent[bulk.voevent_columns.index('xml')] == orm_row.xml
+    assert len(rows.cites) == len(orm_row.cites)
+    assert len(rows.coords) == len(orm_row.coords)
+
+
+def test_bulk_load_from_tarfile(fixture_db_session, packet_tarball):
+    s = fixture_db_session
+    tarball_path, etrees = packet_tarball
+    n_parsed, n_loaded = ingest.bulk_load_from_tarfile(s, tarball_path,
+                                                       pkts_per_commit=5)
+    assert n_parsed == len(etrees)
+    assert n_loaded == len(etrees)
+    assert s.query(Voevent).count() == len(etrees)
+
+    xrt_row = s.query(Voevent).filter(
+        Voevent.ivorn == swift_xrt_grb_655721.attrib['ivorn']).one()
+    assert xrt_row.xml == Voevent.from_etree(swift_xrt_grb_655721).xml
+    assert len(xrt_row.cites) == 1
+    assert xrt_row.cites[0].ref_ivorn == swift_bat_grb_655721.attrib['ivorn']
+    bat_row = s.query(Voevent).filter(
+        Voevent.ivorn == swift_bat_grb_655721.attrib['ivorn']).one()
+    # Resolved as it was loaded (same batch as the cited packet):
+    assert xrt_row.cites[0].ref_voevent_id == bat_row.id
+    assert s.query(Coord).count() == 2
+    assert s.query(Cite).count() == 1
+
+    # Regular ORM inserts should still work, i.e. id-sequence is consistent:
+    s.add(Voevent.from_etree(fake.heartbeat_packets(n_packets=1)[0]))
+    s.flush()
+
+
+@pytest.mark.parametrize('fast_parse', [False, True])
+def test_pipelined_load_from_tarfile(fixture_db_session, packet_tarball,
+                                     fast_parse):
+    s = fixture_db_session
+    tarball_path, etrees = packet_tarball
+    n_parsed, n_loaded = ingest.pipelined_load_from_tarfile(
+        s, tarball_path, n_workers=2, pkts_per_commit=5, queue_size=3,
+        fast_parse=fast_parse)
+    assert n_parsed == len(etrees)
+    assert n_loaded == len(etrees)
+    assert s.query(Voevent).count() == len(etrees)
+    assert s.query(Cite).count() == 1
+
+
+@pytest.mark.parametrize('loader', [ingest.load_from_tarfile,
+                                    ingest.bulk_load_from_tarfile])
+def test_fast_parse_stores_raw_xml(fixture_db_session,
+                                   original_packet_tarball, loader):
+    s = fixture_db_session
+    tarball_path, raw_packets = original_packet_tarball
+    n_parsed, n_loaded = loader(s, tarball_path, check_for_duplicates=False,
+                                fast_parse=True)
+    assert n_loaded == len(raw_packets)
+    for xml in raw_packets:
+        expected = Voevent.from_etree(vp.loads(xml))
+        row = s.query(Voevent).filter(Voevent.ivorn == expected.ivorn).one()
+        assert row.xml == xml
+        assert row.xml_sha256 == xml_digest(xml)
+        # Re-delivery via the regular path is recognised as a duplicate:
+        convenience.safe_insert_voevent(s, vp.loads(xml))
+    assert s.query(Voevent).count() == len(raw_packets)
+    result = ingest.verify_tarball(s, tarball_path)
+    assert result == (len(raw_packets), 0, [])
+
+
+@pytest.mark.parametrize('loader', [ingest.load_from_tarfile,
+                                    ingest.bulk_load_from_tarfile])
+def test_duplicate_tolerant_reload(fixture_db_session, packet_tarball, loader):
+    s = fixture_db_session
+    tarball_path, etrees = packet_tarball
+    # Pre-load a packet, so the first load hits a duplicate part-way through:
+    s.add(Voevent.from_etree(swift_bat_grb_655721))
+    s.flush()
+    n_parsed, n_loaded = loader(s, tarball_path, check_for_duplicates=True,
+                                pkts_per_commit=5)
+    assert n_parsed == len(etrees)
+    assert n_loaded == len(etrees) - 1
+    # Re-running the whole tarball should load nothing new:
+    n_parsed, n_loaded = loader(s, tarball_path, check_for_duplicates=True,
+                                pkts_per_commit=5)
+    assert n_parsed == len(etrees)
+    assert n_loaded == 0
+    assert s.query(Voevent).count() == len(etrees)
+    assert s.query(Cite).count() == 1
+    assert s.query(Coord).count() == 2
+
+
+def test_ivorns_present(fixture_db_session):
+    s = fixture_db_session
+    s.add(Voevent.from_etree(swift_bat_grb_655721))
+    s.flush()
+    present = convenience.ivorns_present(
+        s, [swift_bat_grb_655721.attrib['ivorn'],
+            swift_xrt_grb_655721.attrib['ivorn']])
+    assert present == set([swift_bat_grb_655721.attrib['ivorn']])
+
+
+def test_checkpointed_resume(fixture_db_session, packet_tarball):
+    s = fixture_db_session
+    tarball_path, etrees = packet_tarball
+    n_parsed, n_loaded = ingest.bulk_load_from_tarfile(
+        s, tarball_path, pkts_per_commit=5, resume=True)
+    assert n_loaded == len(etrees)
+    checkpoint = ingest.get_checkpoint(s, tarball_path)
+    assert checkpoint.complete
+    assert checkpoint.n_members == len(etrees)
+    assert checkpoint.n_loaded == len(etrees)
+
+    # Completed tarballs are skipped entirely:
+    assert ingest.load_from_tarfile(s, tarball_path, check_for_duplicates=False,
+                                    resume=True) == (0, 0)
+
+    # Simulate an interrupted load, by rewinding the checkpoint and removing
+    # the packets which would not yet have been committed:
+    members = list(filestore.tarfile_xml_generator(tarball_path))
+    n_committed = 7
+    for tarinf in members[n_committed:]:
+        ivorn = Voevent.from_etree(vp.loads(tarinf.xml)).ivorn
+        s.delete(s.query(Voevent).filter(Voevent.ivorn == ivorn).one())
+    checkpoint.complete = False
+    checkpoint.n_members = n_committed
+    checkpoint.n_loaded = n_committed
+    checkpoint.last_member_digest = ingest._member_digest(
+        members[n_committed - 1].xml)
+    s.flush()
+    n_parsed, n_loaded = ingest.load_from_tarfile(
+        s, tarball_path, check_for_duplicates=False, pkts_per_commit=2,
+        resume=True)
+    assert n_loaded == len(etrees) - n_committed
+    assert s.query(Voevent).count() == len(etrees)
+    checkpoint = ingest.get_checkpoint(s, tarball_path)
+    assert checkpoint.complete
+    assert checkpoint.n_loaded == len(etrees)
+
+    # Mismatched digest means the tarball has changed, so refuse to resume:
+    checkpoint.complete = False
+    checkpoint.last_member_digest = 'foobar'
+    s.flush()
+    with pytest.raises(RuntimeError):
+        ingest.load_from_tarfile(s, tarball_path, check_for_duplicates=False,
+                                 resume=True)
+
+
+def test_duplicate_check_race(fixture_db_session, packet_tarball,
+                              monkeypatch):
+    s = fixture_db_session
+    tarball_path, etrees = packet_tarball
+    ingest.load_from_tarfile(s, tarball_path, check_for_duplicates=False)
+    # Simulate a concurrent load inserting the packets just after we check:
+    ivorns_present = convenience.ivorns_present
+    n_checks = []
+
+    def racy_ivorns_present(session, ivorns):
+        n_checks.append(1)
+        if len(n_checks) == 1:
+            return set()
+        return ivorns_present(session, ivorns)
+
+    monkeypatch.setattr(convenience, 'ivorns_present', racy_ivorns_present)
+    n_parsed, n_loaded = ingest.load_from_tarfile(s, tarball_path,
+                                                  check_for_duplicates=True)
+    assert n_parsed == len(etrees)
+    assert n_loaded == 0
+    assert len(n_checks) == 2
+    assert s.query(Voevent).count() == len(etrees)
+
+
+def test_parallel_load_tarballs(packet_tarball):
+    # Job-processes commit via their own connections, so we can't use the
+    # usual rolled-back fixture session here.
+    tarball_path, etrees = packet_tarball
+    db_utils.create_empty_database(default_admin_db_url,
+                                   testdb_temp_url.database)
+    try:
+        engine = create_engine(testdb_temp_url)
+        with engine.begin() as connection:
+            db_utils.create_tables_and_indexes(connection)
+        # Second tarball contains a subset of the first; so check for dupes.
+        second_tarball = tarball_path + '.subset.tar.bz2'
+        filestore.write_tarball(
+            (Voevent.from_etree(v) for v in etrees[:3]), second_tarball)
+        missing_tarball = tarball_path + '.missing.tar.bz2'
+        paths = [tarball_path, second_tarball, missing_tarball]
+        results = list(ingest.load_tarballs(
+            testdb_temp_url, paths,
+            loader=ingest.bulk_load_from_tarfile,
+            n_jobs=2, check_for_duplicates=True))
+        os.unlink(second_tarball)
+        results = dict((r.tarfile_path, r) for r in results)
+        assert set(results) == set(paths)
+        assert results[missing_tarball].error is not None
+        assert results[tarball_path].error is None
+        assert results[tarball_path].n_parsed == len(etrees)
+        assert results[second_tarball].n_parsed == 3
+        n_loaded = sum(r.n_loaded for r in six.itervalues(results))
+        assert n_loaded == len(etrees)
+        s = Session(bind=engine)
+        assert s.query(Voevent).count() == len(etrees)
+        s.close()
+        engine.dispose()
+    finally:
+        db_utils.delete_database(default_admin_db_url,
+                                 testdb_temp_url.database)
+
+
+def test_verify_tarball(fixture_db_session, packet_tarball):
+    s = fixture_db_session
+    tarball_path, etrees = packet_tarball
+    ingest.load_from_tarfile(s, tarball_path, check_for_duplicates=False)
+    result = ingest.verify_tarball(s, tarball_path, batch_size=5)
+    assert result == (len(etrees), 0, [])
+
+    bat_ivorn = swift_bat_grb_655721.attrib['ivorn']
+    xrt_row = s.query(Voevent).filter(
+        Voevent.ivorn == swift_xrt_grb_655721.attrib['ivorn']).one()
+    xrt_row.xml_sha256 = 'foobar'
+    s.delete(s.query(Voevent).filter(Voevent.ivorn == bat_ivorn).one())
+    s.flush()
+    result = ingest.verify_tarball(s, tarball_path)
+    assert result == (len(etrees) - 2, 1, [xrt_row.ivorn])
+
+
+def test_verify_original_tarball(fixture_db_session, original_packet_tarball):
+    s = fixture_db_session
+    tarball_path, raw_packets = original_packet_tarball
+    # Sanity check - the fixture packets are not already normalised:
+    assert any(Voevent.from_etree(vp.loads(xml)).xml != xml
+               for xml in raw_packets)
+    ingest.load_from_tarfile(s, tarball_path, check_for_duplicates=False)
+    result = ingest.verify_tarball(s, tarball_path)
+    assert result == (len(raw_packets), 0, [])
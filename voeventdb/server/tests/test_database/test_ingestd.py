@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import pytest
+import voeventparse as vp
+from six.moves import queue
+import voeventdb.server.tests.fixtures.fake as fake
+from voeventdb.server.database import session_factory
+from voeventdb.server.database.ingestd import IngestServer, PacketBatcher
+from voeventdb.server.database.models import Voevent
+from voeventdb.server.utils import ingest_client
+from voeventdb.server.tests.resources import swift_bat_grb_655721
+
+
+@pytest.fixture
+def ingest_server(fixture_db_session):
+    socket_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(socket_dir, 'ingest.sock')
+    batcher = PacketBatcher(session_factory, max_batch=10, max_wait=0.2)
+    server = IngestServer(socket_path, batcher)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     kwargs=dict(poll_interval=0.05))
+    server_thread.start()
+    yield socket_path
+    server.shutdown()
+    server_thread.join()
+    server.server_close()
+    shutil.rmtree(socket_dir)
+
+
+def test_batched_insert(fixture_db_session):
+    s = fixture_db_session
+    batcher = PacketBatcher(session_factory, max_batch=10, max_wait=0.2)
+    batcher.start()
+    packets = fake.heartbeat_packets(n_packets=5)
+    threads = [threading.Thread(target=batcher.submit, args=(p,))
+               for p in packets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Duplicate with matching XML is skipped:
+    batcher.submit(packets[0])
+    # Duplicate with mismatched XML is rejected:
+    mismatched = fake.heartbeat_packets(n_packets=1)[0]
+    mismatched.Who.Description = 'Altered'
+    with pytest.raises(ValueError):
+        batcher.submit(mismatched)
+    batcher.stop()
+    assert s.query(Voevent).count() == len(packets)
+
+
+def test_socket_ingest(fixture_db_session, ingest_server):
+    s = fixture_db_session
+    ivorn = ingest_client.send_packet(vp.dumps(swift_bat_grb_655721),
+                                      ingest_server)
+    assert ivorn == swift_bat_grb_655721.attrib['ivorn']
+    assert s.query(Voevent).filter(Voevent.ivorn == ivorn).count() == 1
+    with pytest.raises(ingest_client.IngestRejected):
+        ingest_client.send_packet(b'<not-a-voevent/>', ingest_server)
+
+
+def test_client_daemon_down():
+    with pytest.raises(socket.error):
+        ingest_client.send_packet(b'<VOEvent/>',
+                                  os.path.join(tempfile.gettempdir(),
+                                               'no-such-daemon.sock'))
+
+
+def test_bounded_async_submit(fixture_db_session):
+    s = fixture_db_session
+    batcher = PacketBatcher(session_factory, max_batch=10, max_wait=0.2,
+                            max_queued=2)
+    packets = fake.heartbeat_packets(n_packets=3)
+    errors = []
+    # Writer not yet started, so the queue fills up:
+    batcher.submit_async(packets[0], errors.append)
+    batcher.submit_async(packets[1], errors.append)
+    with pytest.raises(queue.Full):
+        batcher.submit_async(packets[2], errors.append)
+    batcher.start()
+    batcher.stop()
+    assert errors == [None, None]
+    assert s.query(Voevent).count() == 2
@@ -0,0 +1,46 @@
+from __future__ import absolute_import
+
+import pytest
+import voeventdb.server.tests.fixtures.fake as fake
+from voeventdb.server.database import migrations
+from voeventdb.server.database.models import Cite, Voevent, xml_digest
+from voeventdb.server.tests.resources import (swift_bat_grb_655721,
+                                               swift_xrt_grb_655721)
+
+
+def test_backfill_xml_digests(fixture_db_session):
+    s = fixture_db_session
+    s.add_all(Voevent.from_etree(v)
+              for v in fake.heartbeat_packets(n_packets=10))
+    s.flush()
+    migrations.add_xml_digest_column(s.connection())  # Should be a no-op
+    s.query(Voevent).update({Voevent.xml_sha256: None})
+    n_updated = migrations.backfill_xml_digests(s, batch_size=3)
+    assert n_updated == 10
+    for row in s.query(Voevent):
+        assert row.xml_sha256 == xml_digest(row.xml)
+    assert migrations.backfill_xml_digests(s) == 0
+
+
+def test_backfill_cite_refs(fixture_db_session):
+    s = fixture_db_session
+    s.add(Voevent.from_etree(swift_bat_grb_655721))
+    s.add(Voevent.from_etree(swift_xrt_grb_655721))
+    s.flush()
+    migrations.add_cite_ref_column(s.connection())  # Should be a no-op
+    s.query(Cite).update({Cite.ref_voevent_id: None})
+    assert migrations.backfill_cite_refs(s, batch_size=1) == 0
+    bat_id = s.query(Voevent.id).filter(
+        Voevent.ivorn == swift_bat_grb_655721.attrib['ivorn']).scalar()
+    assert s.query(Cite.ref_voevent_id).scalar() == bat_id
+
+
+def test_check_schema(fixture_db_session):
+    s = fixture_db_session
+    migrations.check_schema(s.connection())  # Fresh database, up to date.
+    # (DDL is transactional, so this is rolled back with the fixture.)
+    s.execute('ALTER TABLE cite DROP COLUMN description_id')
+    s.execute('ALTER TABLE voevent_rollup ALTER COLUMN role TYPE text')
+    with pytest.raises(RuntimeError) as excinfo:
+        migrations.check_schema(s.connection())
+    assert 'compact-dimensions, rebuild-rollups' in str(excinfo.value)
@@ -0,0 +1,105 @@
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+
+import pytest
+import voeventparse as vp
+import voeventdb.server.tests.fixtures.fake as fake
+from sqlalchemy import func
+from voeventdb.server.database import migrations, segmentstore
+from voeventdb.server.database.models import Voevent
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = segmentstore.configure(str(tmpdir.join('segments')),
+                                   max_segment_size=4096)
+    yield store
+    segmentstore.configure(None)
+
+
+def test_put_get(store):
+    packets = [vp.dumps(v) for v in fake.heartbeat_packets(n_packets=20)]
+    locators = [store.put(xml) for xml in packets]
+    for locator, xml in zip(locators, packets):
+        assert segmentstore.is_locator(locator)
+        assert not segmentstore.is_locator(xml)
+        assert store.get(locator) == xml
+    store.sync()
+    # Small max_segment_size, so we should have rolled over:
+    assert len(os.listdir(store.store_dir)) > 2
+
+
+def test_concurrent_stores(store):
+    # Another process's store, appending to the same directory:
+    other = segmentstore.SegmentStore(store.store_dir,
+                                      max_segment_size=4096)
+    packets = [vp.dumps(v) for v in fake.heartbeat_packets(n_packets=20)]
+    locators = [(store if i % 3 else other).put(xml)
+                for i, xml in enumerate(packets)]
+    other.close()
+    for locator, xml in zip(locators, packets):
+        assert store.get(locator) == xml
+
+
+def _put_from_child(xml):
+    store = segmentstore.get_store()
+    locator = store.put(xml)
+    store.sync()
+    return locator
+
+
+def test_store_shared_with_forked_children(store):
+    packets = [vp.dumps(v) for v in fake.heartbeat_packets(n_packets=40)]
+    # Open the lock-file / current segment before forking:
+    locators = [store.put(packets[0])]
+    # (Pool children must inherit the configured store.)
+    if hasattr(multiprocessing, 'get_context'):
+        pool = multiprocessing.get_context('fork').Pool(processes=4)
+    else:
+        pool = multiprocessing.Pool(processes=4)
+    try:
+        locators.extend(pool.map(_put_from_child, packets[1:], chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+    locators.append(store.put(packets[-1]))
+    for locator, xml in zip(locators, packets + [packets[-1]]):
+        assert store.get(locator) == xml
+
+
+def test_corrupt_segment_detected(store):
+    xml = vp.dumps(fake.heartbeat_packets(n_packets=1)[0])
+    locator = store.put(xml)
+    segment_path = os.path.join(store.store_dir, 'segment-000001.dat')
+    with open(segment_path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'!')
+    store.close()
+    with pytest.raises(IOError):
+        store.get(locator)
+
+
+def test_move_to_store_and_back(fixture_db_session, store):
+    s = fixture_db_session
+    s.add_all(Voevent.from_etree(v)
+              for v in fake.heartbeat_packets(n_packets=10))
+    s.flush()
+    stored_size = func.sum(func.octet_length(Voevent.__table__.c.xml))
+    size_before = s.query(stored_size).scalar()
+    originals = dict(s.query(Voevent.ivorn, Voevent.xml))
+
+    n_updated, bytes_before, bytes_after = \
+        migrations.move_xml_to_segment_store(s, store, batch_size=3)
+    assert n_updated == 10
+    assert bytes_before == size_before
+    assert s.query(stored_size).scalar() == bytes_after < bytes_before
+    # Reads are transparent:
+    assert dict(s.query(Voevent.ivorn, Voevent.xml)) == originals
+    assert migrations.move_xml_to_segment_store(s, store)[0] == 0
+
+    n_updated, _, _ = migrations.move_xml_to_database(s, store)
+    assert n_updated == 10
+    assert s.query(stored_size).scalar() == size_before
+    assert dict(s.query(Voevent.ivorn, Voevent.xml)) == originals
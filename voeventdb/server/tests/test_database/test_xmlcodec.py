@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+
+import time
+
+import pytest
+import voeventparse as vp
+import voeventdb.server.tests.fixtures.fake as fake
+from sqlalchemy import func
+from voeventdb.server.database import migrations, xmlcodec
+from voeventdb.server.database.models import Voevent
+from voeventdb.server.utils import filestore
+
+zstandard = pytest.importorskip('zstandard')
+
+
+@pytest.fixture
+def compressed_db_session(fixture_db_session):
+    """
+    Fixture session with packets loaded, and an active compression dictionary.
+    """
+    s = fixture_db_session
+    s.add_all(Voevent.from_etree(v)
+              for v in fake.heartbeat_packets(n_packets=500))
+    s.flush()
+    migrations.train_xml_dictionary(s, dict_size=4096)
+    yield s
+    # The dictionary table is rolled back along with everything else:
+    xmlcodec.registry.reset()
+
+
+def test_raw_passthrough():
+    xml = vp.dumps(fake.heartbeat_packets(n_packets=1)[0])
+    assert not xmlcodec.is_compressed(xml)
+    assert xmlcodec.decode(xml) == xml
+
+
+def test_compressed_roundtrip(compressed_db_session):
+    s = compressed_db_session
+    stored_size = func.sum(func.octet_length(Voevent.__table__.c.xml))
+    size_before = s.query(stored_size).scalar()
+    originals = dict(s.query(Voevent.ivorn, Voevent.xml))
+
+    n_updated, bytes_before, bytes_after = migrations.recompress_xml(
+        s, batch_size=100)
+    assert n_updated == len(originals)
+    assert bytes_before == size_before
+    assert bytes_after < bytes_before
+    assert s.query(stored_size).scalar() == bytes_after
+    # Reads are transparent:
+    assert dict(s.query(Voevent.ivorn, Voevent.xml)) == originals
+    # Re-running is a no-op:
+    assert migrations.recompress_xml(s)[0] == 0
+
+    # New inserts are compressed too:
+    new_packet = fake.heartbeat_packets(n_packets=501)[-1]
+    new_row = Voevent.from_etree(new_packet)
+    s.add(new_row)
+    s.commit()
+    s.expire_all()
+    assert s.query(Voevent.xml).filter(
+        Voevent.ivorn == new_row.ivorn).scalar() == vp.dumps(new_packet)
+
+    # And back again:
+    n_updated, bytes_before, bytes_after = migrations.recompress_xml(
+        s, decompress=True)
+    assert n_updated == len(originals) + 1
+    assert s.query(stored_size).scalar() > bytes_before
+
+
+def test_registry_reload(compressed_db_session, monkeypatch):
+    s = compressed_db_session
+    active_id = xmlcodec.registry.active_id
+    # As if loaded by a long-running process, before the dictionary existed:
+    xmlcodec.registry.reset()
+    xmlcodec.registry.loaded = True
+    xmlcodec.registry.loaded_at = time.time()
+    s.commit()
+    s.connection()
+    assert xmlcodec.registry.active_id is None
+    # Re-checked once the reload interval has passed:
+    monkeypatch.setattr(xmlcodec, 'dictionary_reload_interval', 0)
+    s.commit()
+    s.connection()
+    assert xmlcodec.registry.active_id == active_id
+
+
+def test_write_tarball_decompresses(compressed_db_session, tmpdir):
+    s = compressed_db_session
+    migrations.recompress_xml(s)
+    rows = s.query(Voevent).order_by(Voevent.id).limit(5).all()
+    tarball_path = str(tmpdir.join('dump.tar.bz2'))
+    filestore.write_tarball(rows, tarball_path)
+    for tarinf, row in zip(filestore.tarfile_xml_generator(tarball_path), rows):
+        assert tarinf.xml == row.xml
+        assert not xmlcodec.is_compressed(tarinf.xml)
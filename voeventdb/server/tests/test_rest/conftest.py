@@ -6,12 +6,16 @@ from voeventdb.server.tests.fixtures.connection import (
 )
 
 from voeventdb.server.restapi.app import app
+from voeventdb.server.restapi.v1 import caching
 
 @pytest.fixture
 def flask_test_client(fixture_db_session):
     # print
     # print "setting up flask client"
     app.testing = True
+    # Cached data persists across test-databases, so:
+    caching.reset_packet_cache()
+    caching.reset_result_cache()
     client = app.test_client()
     app_context = app.test_request_context()
     app_context.push()
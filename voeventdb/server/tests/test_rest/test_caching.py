@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+import threading
+import time
+
+from flask import g, request
+from werkzeug.datastructures import MultiDict
+from voeventdb.server.restapi.app import app
+from voeventdb.server.restapi.v1.caching import (
+    ByteBoundedCache, WatermarkCache, cached_query_result,
+    querystring_cache_key)
+
+
+def test_byte_bounded_cache():
+    cache = ByteBoundedCache(max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'5678')
+    assert cache.get('a') == b'1234'  # Now most recently used.
+    cache.put('c', b'90')
+    assert cache.n_bytes == 10
+    assert cache.evictions == 0
+    cache.put('d', b'x')  # Evicts least-recently used, 'b'.
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.evictions == 1
+    assert cache.n_bytes == 7
+    cache.put('e', b'too large to cache')
+    assert cache.get('e') is None
+    cache.discard('a')
+    assert cache.n_bytes == 3
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 2
+
+
+def test_watermark_cache():
+    cache = WatermarkCache(max_entries=2, ttl=60, stale_ttl=60)
+    cache.put('a', 1, 'result-a')
+    assert cache.get('a', 1) == 'result-a'
+    # New packets ingested:
+    assert cache.get('a', 2) is None
+    assert cache.get_stale('a') == 'result-a'
+    assert cache.start_refresh('a')
+    assert not cache.start_refresh('a')
+    cache.end_refresh('a')
+    cache.put('b', 1, 'result-b')
+    cache.put('c', 1, 'result-c')
+    assert cache.get_stale('a') is None  # Evicted.
+
+    cache = WatermarkCache(ttl=0.01)
+    cache.put('a', 1, 'result-a')
+    time.sleep(0.02)
+    assert cache.get('a', 1) is None
+    assert cache.get_stale('a') is None
+
+
+def test_querystring_cache_key():
+    k1 = querystring_cache_key('count', MultiDict(
+        [('role', 'test'), ('stream', 'foo'), ('role', 'observation')]))
+    k2 = querystring_cache_key('count', MultiDict(
+        [('stream', 'foo'), ('role', 'observation'), ('role', 'test')]))
+    assert k1 == k2
+    k3 = querystring_cache_key('count', MultiDict(
+        [('stream', 'foo'), ('role', 'observation'), ('limit', '10')]),
+        ignore_keys=['limit'])
+    assert k3 != k1
+
+
+def test_cached_query_result_serves_stale_during_refresh():
+    cache = WatermarkCache(stale_ttl=60)
+    cache.put('a', 1, 'old-result')
+    release = threading.Event()
+    n_computed = []
+
+    def compute():
+        # Runs in a worker thread, within a copy of the request context:
+        assert request.path == '/refresh-test'
+        n_computed.append(1)
+        release.wait(10)
+        return 'new-result'
+
+    with app.test_request_context('/refresh-test'):
+        # Served immediately, while the refresh runs in the background:
+        assert cached_query_result(cache, 'a', 2, compute) == 'old-result'
+        assert g.served_stale
+        # A concurrent request doesn't start another refresh:
+        assert cached_query_result(cache, 'a', 2, compute) == 'old-result'
+    release.set()
+    deadline = time.time() + 10
+    while cache.get('a', 2) is None and time.time() < deadline:
+        time.sleep(0.01)
+    assert cache.get('a', 2) == 'new-result'
+    assert n_computed == [1]
+    deadline = time.time() + 10
+    while not cache.start_refresh('a') and time.time() < deadline:
+        time.sleep(0.01)  # Claim is released just after the put.
+    cache.end_refresh('a')
+    with app.test_request_context():
+        assert cached_query_result(cache, 'a', 2, compute) == 'new-result'
+        assert not g.get('served_stale')
+
+
+def test_cached_query_result_computes_without_stale_entry():
+    cache = WatermarkCache(stale_ttl=60)
+    with app.test_request_context():
+        assert cached_query_result(cache, 'a', 1, lambda: 'result') == 'result'
+        assert not g.get('served_stale')
+    assert cache.get('a', 1) == 'result'
@@ -3,16 +3,25 @@ import pytest
 from voeventdb.server.database.models import Voevent, Cite
 from voeventdb.server.restapi.v1.views import apiv1
 from voeventdb.server.restapi.v1.definitions import (
+    CompressionValues,
+    CountModeValues,
+    FormatValues,
     OrderValues,
+    OutputKeys,
     PaginationKeys,
     ResultKeys,
 )
 import voeventdb.server.restapi.v1.views as views
+from voeventdb.server.restapi.v1 import caching
 import voeventdb.server.restapi.v1.filters as filters
 from voeventdb.server.tests.fixtures.fake import heartbeat_packets
+from voeventdb.server.utils import filestore
 import voeventdb.server.restapi.default_config as rest_app_config
+from voeventdb.server.restapi.app import app
 import voeventparse as vp
 import json
+import tarfile
+from io import BytesIO
 import six
 
 if six.PY3:
@@ -105,6 +114,37 @@ class TestWithSimpleDatabase:
         rd = json.loads(rv.data.decode())
         assert rd[ResultKeys.result] == dbinf.n_inserts
 
+    def test_count_modes(self, simple_populated_db):
+        dbinf = simple_populated_db
+        count_url = url_for(apiv1.name + '.' + views.Count.view_name)
+        authored_until_dt = iso8601.parse_date(
+            dbinf.insert_packets[6].Who.Date.text)
+        n_qualifying = len([
+            p for p in dbinf.insert_packets
+            if iso8601.parse_date(p.Who.Date.text) <= authored_until_dt])
+        for mode in (CountModeValues.exact, CountModeValues.estimate):
+            rv = self.c.get(count_url + '?' + urlencode(
+                {OutputKeys.count_mode: mode,
+                 'authored_until': authored_until_dt.isoformat()}))
+            assert rv.status_code == 200
+            rd = json.loads(rv.data.decode())
+            assert isinstance(rd[ResultKeys.result], int)
+            if mode == CountModeValues.exact:
+                assert rd[ResultKeys.result] == n_qualifying
+                assert ResultKeys.approximate not in rd
+            else:
+                assert rd[ResultKeys.approximate] is True
+        # Answerable from the rollups, so always exact:
+        rv = self.c.get(count_url + '?' + urlencode(
+            {OutputKeys.count_mode: CountModeValues.estimate}))
+        rd = json.loads(rv.data.decode())
+        assert rd[ResultKeys.result] == dbinf.n_inserts
+        assert ResultKeys.approximate not in rd
+
+        rv = self.c.get(count_url + '?' + urlencode(
+            {OutputKeys.count_mode: 'guess'}))
+        assert rv.status_code == 400
+
     def test_ivornlist(self, simple_populated_db):
         dbinf = simple_populated_db
         ivorn_list_url = url_for(apiv1.name + '.' + views.ListIvorn.view_name)
@@ -136,6 +176,134 @@ class TestWithSimpleDatabase:
         rv = self.c.get(ivorn_list_url)
         assert rv.status_code == 400
 
+    def test_cursor_pagination(self, simple_populated_db):
+        dbinf = simple_populated_db
+        ivorn_list_url = url_for(apiv1.name + '.' + views.ListIvorn.view_name)
+        for order in OrderValues._value_list:
+            rv = self.c.get(ivorn_list_url + '?' + urlencode(
+                {PaginationKeys.order: order}))
+            full_listing = json.loads(rv.data.decode())[ResultKeys.result]
+            assert len(full_listing) == dbinf.n_inserts
+            walked = []
+            params = {PaginationKeys.order: order, PaginationKeys.limit: 3}
+            while True:
+                rv = self.c.get(ivorn_list_url + '?' + urlencode(params))
+                assert rv.status_code == 200
+                rd = json.loads(rv.data.decode())
+                walked.extend(rd[ResultKeys.result])
+                if rd[ResultKeys.next] is None:
+                    break
+                params[PaginationKeys.cursor] = rd[ResultKeys.next]
+            assert walked == full_listing
+
+        rv = self.c.get(ivorn_list_url + '?' + urlencode(
+            {PaginationKeys.cursor: 'foobar'}))
+        assert rv.status_code == 400
+        rv = self.c.get(ivorn_list_url + '?' + urlencode(
+            {PaginationKeys.limit: 1}))
+        cursor = json.loads(rv.data.decode())[ResultKeys.next]
+        rv = self.c.get(ivorn_list_url + '?' + urlencode(
+            {PaginationKeys.cursor: cursor, PaginationKeys.offset: 1}))
+        assert rv.status_code == 400
+        rv = self.c.get(ivorn_list_url + '?' + urlencode(
+            {PaginationKeys.cursor: cursor,
+             PaginationKeys.order: OrderValues.ivorn}))
+        assert rv.status_code == 400
+
+    def test_ndjson_stream(self, simple_populated_db, monkeypatch):
+        dbinf = simple_populated_db
+        ivorn_list_url = url_for(apiv1.name + '.' + views.ListIvorn.view_name)
+        rv = self.c.get(ivorn_list_url + '?' + urlencode(
+            {OutputKeys.format: FormatValues.ndjson}))
+        assert rv.status_code == 200
+        assert rv.mimetype == 'application/x-ndjson'
+        lines = rv.data.decode().splitlines()
+        assert [json.loads(l) for l in lines] == dbinf.inserted_ivorns
+
+        nrefs_url = url_for(apiv1.name + '.' +
+                            views.ListIvornReferenceCount.view_name)
+        big_limit_url = nrefs_url + '?' + urlencode(
+            {OutputKeys.format: FormatValues.ndjson,
+             PaginationKeys.limit: rest_app_config.MAX_QUERY_LIMIT + 1})
+        # Streams are capped like other list queries, unless configured:
+        rv = self.c.get(big_limit_url)
+        assert rv.status_code == 400
+        monkeypatch.setitem(app.config, 'MAX_STREAM_QUERY_LIMIT',
+                            rest_app_config.MAX_QUERY_LIMIT * 100)
+        rv = self.c.get(big_limit_url)
+        assert rv.status_code == 200
+        rows = [json.loads(l) for l in rv.data.decode().splitlines()]
+        assert len(rows) == dbinf.n_inserts
+        assert all(len(r) == 2 for r in rows)
+
+        rv = self.c.get(ivorn_list_url + '?' + urlencode(
+            {OutputKeys.format: 'xml'}))
+        assert rv.status_code == 400
+
+    def test_export_tar(self, simple_populated_db):
+        dbinf = simple_populated_db
+        export_url = url_for(apiv1.name + '.export_tar')
+        rv = self.c.get(export_url + '?' + urlencode(
+            {OutputKeys.compression: CompressionValues.gz}))
+        assert rv.status_code == 200
+        tf = tarfile.open(fileobj=BytesIO(rv.data), mode='r:gz')
+        assert tf.getnames() == [filestore.filename_from_ivorn(i)
+                                 for i in dbinf.inserted_ivorns]
+
+        rv = self.c.get(export_url + '?' + urlencode({'role': 'test'}))
+        assert rv.status_code == 200
+        tf = tarfile.open(fileobj=BytesIO(rv.data), mode='r')
+        n_test_packets = len([p for p in dbinf.insert_packets
+                              if p.attrib['role'] == 'test'])
+        assert len(tf.getnames()) == n_test_packets
+
+        rv = self.c.get(export_url + '?' + urlencode(
+            {OutputKeys.compression: 'zip'}))
+        assert rv.status_code == 400
+
+    def test_conditional_get(self, fixture_db_session, simple_populated_db):
+        dbinf = simple_populated_db
+        count_url = url_for(apiv1.name + '.' + views.Count.view_name)
+        rv = self.c.get(count_url)
+        assert rv.status_code == 200
+        etag = rv.headers['ETag']
+        assert rv.headers['Cache-Control'] == rest_app_config.QUERY_CACHE_CONTROL
+        rv = self.c.get(count_url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        rv = self.c.get(count_url, headers={
+            'If-Modified-Since': rv.headers['Last-Modified']})
+        assert rv.status_code == 304
+
+        # Ingest invalidates:
+        fixture_db_session.add(Voevent.from_etree(dbinf.remaining_packet))
+        fixture_db_session.flush()
+        rv = self.c.get(count_url, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert json.loads(rv.data.decode())[ResultKeys.result] == (
+            dbinf.n_inserts + 1)
+
+        ivorn = dbinf.inserted_ivorns[0]
+        xml_url = url_for(apiv1.name + '.packet_xml') + quote_plus(ivorn)
+        rv = self.c.get(xml_url)
+        assert rv.status_code == 200
+        packet_etag = rv.headers['ETag']
+        rv = self.c.get(xml_url, headers={'If-None-Match': packet_etag})
+        assert rv.status_code == 304
+
+        # Validators follow the stored content, and are only honoured for
+        # packets which are present:
+        row = fixture_db_session.query(Voevent).filter(
+            Voevent.ivorn == ivorn).one()
+        assert row.xml_sha256 in packet_etag
+        fixture_db_session.delete(row)
+        fixture_db_session.flush()
+        rv = self.c.get(xml_url, headers={'If-None-Match': packet_etag})
+        assert rv.status_code == 422
+        synopsis_url = url_for(apiv1.name + '.packet_synopsis') + quote_plus(
+            dbinf.absent_ivorn)
+        rv = self.c.get(synopsis_url, headers={'If-None-Match': '*'})
+        assert rv.status_code == 422
+
     def test_consistent_ordering(self, simple_populated_db):
         """
         Check that database results are orded consistently.
@@ -225,6 +393,31 @@ class TestWithSimpleDatabase:
         assert rv.mimetype == 'text/xml'
         assert rv.data.decode() == present_ivorn_xml_content.decode()
 
+    def test_batch_synopses(self, simple_populated_db):
+        dbinf = simple_populated_db
+        ep_url = url_for(apiv1.name + '.packet_synopses')
+        ivorns = list(dbinf.followup_packets[:2]) + [dbinf.absent_ivorn]
+        rv = self.c.post(ep_url, data=json.dumps({'ivorns': ivorns}),
+                         content_type='application/json')
+        assert rv.status_code == 200
+        result = json.loads(rv.data.decode())[ResultKeys.result]
+        assert set(result.keys()) == set(ivorns)
+        assert result[dbinf.absent_ivorn] is None
+        for ivorn in ivorns[:2]:
+            single = self.c.get(url_for(apiv1.name + '.packet_synopsis') +
+                                quote_plus(ivorn))
+            assert result[ivorn] == json.loads(
+                single.data.decode())[ResultKeys.result]
+
+        rv = self.c.post(ep_url, data='not json',
+                         content_type='application/json')
+        assert rv.status_code == 400
+        too_many = [dbinf.absent_ivorn] * (
+            rest_app_config.MAX_SYNOPSIS_BATCH + 1)
+        rv = self.c.post(ep_url, data=json.dumps({'ivorns': too_many}),
+                         content_type='application/json')
+        assert rv.status_code == 413
+
     def test_synopsis_view(self, simple_populated_db):
         # Null case, ivorn not in DB:
         ep_url = url_for(apiv1.name + '.packet_synopsis')
@@ -241,6 +434,13 @@ class TestWithSimpleDatabase:
         full = rd[ResultKeys.result]
         etree = simple_populated_db.packet_dict[ivorn_w_refs]
         assert len(full['refs']) == len(Cite.from_etree(etree))
+        assert 'xml_sha256' not in full['voevent']
+        # Repeat requests are served from the packet cache (content-hash,
+        # for the ETag, and synopsis):
+        n_hits = caching.packet_cache().stats()['hits']
+        rv = self.c.get(url)
+        assert json.loads(rv.data.decode())[ResultKeys.result] == full
+        assert caching.packet_cache().stats()['hits'] == n_hits + 2
 
         # Negative case, IVORN present but packet contains no references
         all_ivorns = set(simple_populated_db.packet_dict.keys())
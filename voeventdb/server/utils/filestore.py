@@ -88,6 +88,55 @@ def write_tarball_from_ivorn_xml_tuples(ivorn_xml_tuples, filepath):
     return packet_count
 
 
+class _ChunkBuffer(object):
+    """
+    Minimal write-only file-object, collecting writes until drained.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_tarball_from_ivorn_xml_tuples(ivorn_xml_tuples, compression=''):
+    """
+    Generate a tarball of packets incrementally, as a series of bytestrings.
+
+    Uses tarfile's 'stream' mode, so at most one packet (plus compressor
+    state) is held in memory at a time, however many packets are written.
+
+    Args:
+        ivorn_xml_tuples (iterable): [(ivorn,xml)]
+            An iterable (e.g. list) of tuples containing two entries -
+            an ivorn string and an xml bytestring.
+        compression (string): One of ``''`` (uncompressed), ``'gz'`` or
+            ``'bz2'``.
+    Yields:
+        bytes: Successive chunks of the tarball.
+    """
+    buf = _ChunkBuffer()
+    out = tarfile.open(fileobj=buf, mode='w|' + compression)
+    try:
+        for (ivorn, xml) in ivorn_xml_tuples:
+            out.addfile(*bytestring_to_tar_tuple(
+                filename_from_ivorn(ivorn),
+                xml
+            ))
+            data = buf.drain()
+            if data:
+                yield data
+    finally:
+        out.close()
+    yield buf.drain()
+
+
 class TarXML(namedtuple('TarXML', 'name xml')):
     """
     A namedtuple for pairing a filename and XML bytestring
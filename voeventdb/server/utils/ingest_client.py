@@ -0,0 +1,68 @@
+"""
+Client side of the ingest-daemon protocol (see ``voeventdb_ingestd.py``).
+
+Deliberately lightweight - no database or XML-parsing imports - so that
+forwarding a packet to a running daemon costs little more than interpreter
+start-up.
+
+The protocol is minimal: the client connects to the daemon's Unix socket,
+sends the raw packet bytes, then shuts down its side of the connection.
+Once the packet has been committed (or rejected) the daemon replies with a
+single line, either ``OK <ivorn>`` or ``ERROR <message>``, and closes the
+connection.
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import socket
+
+default_socket_path = os.environ.get(
+    'VOEVENTDB_INGEST_SOCKET',
+    os.path.expanduser('~/.voeventdb_ingest.sock'))
+
+
+class IngestRejected(Exception):
+    """
+    Raised when the daemon received a packet but could not ingest it.
+    """
+    pass
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def send_packet(xml, socket_path=default_socket_path, timeout=30.):
+    """
+    Forward a packet to the ingest daemon, and wait for it to be committed.
+
+    Args:
+        xml (bytes): Raw packet XML.
+        socket_path (str): Path of the daemon's Unix socket.
+        timeout (float): Seconds to wait for the daemon, both to connect and
+            for the reply.
+    Returns:
+        str: The IVORN of the ingested packet.
+    Raises:
+        socket.error: If the daemon is not running (or not responding).
+        IngestRejected: If the daemon rejected the packet.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(xml)
+        sock.shutdown(socket.SHUT_WR)
+        reply = _recv_all(sock).decode('utf-8').strip()
+    finally:
+        sock.close()
+    status, _, detail = reply.partition(' ')
+    if status == 'OK':
+        return detail
+    if status == 'ERROR':
+        raise IngestRejected(detail)
+    raise socket.error('Malformed reply from ingest daemon: {!r}'.format(reply))